@@ -1,12 +1,49 @@
 import os
+from datetime import timedelta
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (
+    Flask, render_template, stream_template, request, flash, redirect, session,
+    g, abort, jsonify, send_file, get_flashed_messages,
+)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
-
-from forms import UserAddForm, LoginForm, MessageForm, CSRFForm, EditProfile
-from models import db, dbx, User, Message
+from werkzeug.middleware.proxy_fix import ProxyFix
+from wtforms.validators import ValidationError
+
+from archive import archive_messages
+from autocomplete import UsernameAutocomplete
+from availability import Availability
+from cachedirs import default_cache_dir, private_cache_dir
+from capture import (
+    TrafficCapture, client_sender, compare_latency, http_sender,
+    login_sessions, read_capture, replay,
+)
+from forms import UserAddForm, LoginForm, MessageForm, EditProfile
+from graph import GraphCache
+from images import ImageProxy, IMAGE_SIZES
+from itsdangerous import BadSignature
+from microcache import Microcache
+from migrations import upgrade
+from models import db, dbx, batching, User, Message, Follow, TrendingMessage
+from notifications import (
+    NOTIFICATIONS_PER_PAGE, collapse_notifications, decode_cursor,
+    encode_cursor, mark_read, select_inbox,
+)
+from querycache import QueryCache
+from queryplans import check_plans
+from ratelimit import RateLimiter
+from readmodels import (
+    MessageCard, UserCard, UserDetail, select_message_cards,
+    select_user_cards, select_user_detail,
+)
+from search import MessageSearch
+from sessions import ServerSideSessionInterface, SESSION_STORES
+from suggestions import refresh_suggestions
+from timeline import LiveTimeline
 from werkzeug.exceptions import Unauthorized
 
 load_dotenv()
@@ -21,10 +58,152 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SQLALCHEMY_RECORD_QUERIES'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 
+# Sessions are kept server-side ('database', or 'memory' for a single
+# process); the cookie only holds the session id
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'database')
+
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 toolbar = DebugToolbarExtension(app)
 
+# Compiled templates are shared between workers through an on-disk bytecode
+# cache, which must be a directory only the app's user can write to (see
+# cachedirs.py). Every template is compiled once at startup rather than on
+# the first request that happens to need it; set JINJA_PRECOMPILE=false to
+# skip that, e.g. when `flask compile-templates` warms the cache as a deploy
+# step.
+app.config['JINJA_CACHE_DIR'] = os.environ.get(
+    'JINJA_CACHE_DIR', default_cache_dir('warbler-jinja'))
+app.config['JINJA_PRECOMPILE'] = (
+    os.environ.get('JINJA_PRECOMPILE', 'true').lower() in ('1', 'true'))
+
+# Long list pages are sent as they render: the header and nav go out before
+# the list's query has even run, and rows are fetched in batches
+app.config['STREAM_TEMPLATES'] = True
+app.config['STREAM_BATCH_SIZE'] = 100
+
+app.jinja_options = {
+    **app.jinja_options,
+    'bytecode_cache': FileSystemBytecodeCache(
+        private_cache_dir(app.config['JINJA_CACHE_DIR'])),
+}
+
+# Token-bucket limits per client IP and per user; use the 'database' backend
+# when running several workers so they share buckets
+app.config['RATELIMIT_BACKEND'] = os.environ.get('RATELIMIT_BACKEND', 'memory')
+app.config['RATELIMITS'] = {
+    'login': '10/minute',
+    'signup': '5/minute',
+    'check_availability': '60/minute',
+    'add_message': '30/minute',
+    'like_unlike_message': '120/minute',
+    'start_following': '60/minute',
+    'stop_following': '60/minute',
+}
+
+# Set TRUSTED_PROXIES to the number of reverse proxies in front of the app,
+# each adding the address it got the request from to X-Forwarded-For, so
+# that a request's remote address (which rate limits are per) is the
+# client's rather than the nearest proxy's. Leave it at 0 if clients can
+# reach the app directly, since they can send the header with any address.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+# Message search uses PostgreSQL full-text search, or an in-memory index on
+# other databases; set SEARCH_BACKEND to 'database' or 'memory' to choose
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND')
+app.config['SEARCH_PAGE_SIZE'] = 20
+
+# Most usernames the search box suggests as you type, from a per-worker
+# index of usernames; other workers' changes show up within AUTOCOMPLETE_TTL
+# seconds
+app.config['AUTOCOMPLETE_LIMIT'] = 10
+app.config['AUTOCOMPLETE_TTL'] = 300
+
+# Optional per-worker cache of follow lists, so follow buttons and the home
+# feed don't query the follows table on every page. Other workers' follows
+# show up within GRAPH_CACHE_TTL seconds.
+app.config['GRAPH_CACHE_ENABLED'] = (
+    os.environ.get('GRAPH_CACHE_ENABLED', '').lower() in ('1', 'true'))
+app.config['GRAPH_CACHE_MAX_BYTES'] = 16 * 2**20
+app.config['GRAPH_CACHE_TTL'] = 60
+
+# Optional per-worker cache of the results of some read queries (the users
+# list, profile details), dropped as this worker writes to the tables they
+# read. Other workers' writes show up within QUERY_CACHE_TTL seconds.
+app.config['QUERY_CACHE_ENABLED'] = (
+    os.environ.get('QUERY_CACHE_ENABLED', '').lower() in ('1', 'true'))
+app.config['QUERY_CACHE_MAX_BYTES'] = 32 * 2**20
+app.config['QUERY_CACHE_TTL'] = 30
+
+# Database connections per worker for the async pages in asgi.py, shared by
+# however many requests a worker has waiting on the database
+app.config['ASYNC_DB_POOL_SIZE'] = 20
+
+# Avatars and header images are served resized from a local cache, rather
+# than linked straight to the (often huge) originals on other sites
+app.config['IMAGE_PROXY_ENABLED'] = (
+    os.environ.get('IMAGE_PROXY_ENABLED', 'true').lower() in ('1', 'true'))
+app.config['IMAGE_CACHE_DIR'] = os.environ.get(
+    'IMAGE_CACHE_DIR', default_cache_dir('warbler-images'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = 512 * 2**20
+app.config['IMAGE_MAX_AGE'] = 365 * 24 * 60 * 60
+
+# New messages are pushed to open home pages by the ASGI app (asgi.py).
+# 'memory' only reaches pages connected to the worker the message was posted
+# to; use 'database' (PostgreSQL LISTEN / NOTIFY) when running several.
+app.config['LIVE_TIMELINE_BACKEND'] = os.environ.get(
+    'LIVE_TIMELINE_BACKEND', 'memory')
+
+# Signup and profile edits check usernames and e-mails are free before
+# hashing the password, through a per-worker Bloom filter of taken ones;
+# other workers' signups get into it within AVAILABILITY_BLOOM_TTL seconds
+app.config['AVAILABILITY_BLOOM_ENABLED'] = True
+app.config['AVAILABILITY_BLOOM_TTL'] = 300
+
+# Messages older than this many days are archived by `flask archive-messages`:
+# home feeds and profiles leave them out (they're still shown on their own),
+# and on PostgreSQL their partitions can be moved to a cheaper tablespace
+app.config['MESSAGE_ARCHIVE_DAYS'] = 365
+app.config['MESSAGE_ARCHIVE_TABLESPACE'] = os.environ.get(
+    'MESSAGE_ARCHIVE_TABLESPACE')
+
+# Set TRAFFIC_CAPTURE_DIR to record requests (without anything identifying
+# beyond user ids) for `flask replay-traffic`
+app.config['TRAFFIC_CAPTURE_DIR'] = os.environ.get('TRAFFIC_CAPTURE_DIR')
+app.config['TRAFFIC_CAPTURE_MAX_BYTES'] = 64 * 2**20
+
+# Anonymous visitors are served the home, login and signup pages from a
+# cache for a few seconds; 'database' shares it between workers
+app.config['MICROCACHE_BACKEND'] = os.environ.get(
+    'MICROCACHE_BACKEND', 'memory')
+app.config['MICROCACHE_TTL'] = 10
+app.config['MICROCACHE_ENDPOINTS'] = ('homepage', 'login', 'signup')
+
+app.wsgi_app = ProxyFix(
+    app.wsgi_app,
+    x_for=app.config['TRUSTED_PROXIES'],
+    x_proto=app.config['TRUSTED_PROXIES'],
+)
+
 db.init_app(app)
+limiter = RateLimiter(app)
+message_search = MessageSearch(app)
+usernames = UsernameAutocomplete(app)
+availability = Availability(app)
+image_proxy = ImageProxy(app)
+live_timeline = LiveTimeline(app)
+traffic_capture = TrafficCapture(app)
+microcache = Microcache(app)
+query_cache = QueryCache(app)
+
+if app.config['GRAPH_CACHE_ENABLED']:
+    User.graph_cache = GraphCache(
+        User.load_follow_ids,
+        max_bytes=app.config['GRAPH_CACHE_MAX_BYTES'],
+        ttl=app.config['GRAPH_CACHE_TTL'],
+    )
+
+app.session_interface = ServerSideSessionInterface(
+    SESSION_STORES[app.config['SESSION_BACKEND']]())
 
 
 ##############################################################################
@@ -35,30 +214,115 @@ db.init_app(app)
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
+    # Static files and images don't need the user, so don't read the session
+    # for them
+    if request.endpoint in ('static', 'proxied_image'):
+        g.user = None
+
+    elif CURR_USER_KEY in session:
         g.user = db.session.get(User, session[CURR_USER_KEY])
 
+        if g.user and g.user.deleted_at:
+            g.user = None
+
     else:
         g.user = None
 
 
 @app.before_request
-def add_csrf_form_to_g():
-    """Add a CSRF form to g."""
+def add_request_url_to_g():
+    """Add the url the request came from to g."""
 
-    g.csrf_form = CSRFForm()
+    g.request_url = request.url
 
 
 @app.before_request
-def add_request_url_to_g():
-    """Add the url the request came from to g."""
+def start_batching():
+    """Batch the references of the objects this request loads (see
+    models.entity_loader), until it's torn down."""
 
-    g.request_url = request.url
+    g.batching = batching()
+    g.batching.__enter__()
+
+
+@app.teardown_request
+def end_batching(exc):
+    if "batching" in g:
+        g.pop("batching").__exit__(None, None, None)
+
+
+# Templates call csrf_token() only where they render a form; Flask-WTF makes
+# the token at most once per request, so pages without forms never touch it
+app.jinja_env.globals['csrf_token'] = generate_csrf
+
+
+def csrf_valid():
+    """Does the submitted form carry a valid CSRF token?
+
+    Checks just the token, without building a WTForms form.
+    """
+
+    if not app.config.get('WTF_CSRF_ENABLED', True):
+        return True
+
+    try:
+        validate_csrf(request.form.get('csrf_token'))
+
+    except ValidationError:
+        return False
+
+    return True
+
+
+def precompile_templates():
+    """Compile every template into the environment and bytecode caches."""
+
+    names = app.jinja_env.list_templates(extensions=['jinja', 'html'])
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return names
+
+
+def render_page(template_name, **context):
+    """Render a page, streaming it out as it renders if that's enabled.
+
+    A streamed page renders after the session has been saved, so anything
+    the page does to the session is done up front: its flashed messages are
+    taken out, and passed in as `flashes`, and its CSRF token is made (the
+    template's `csrf_token()` then returns the same one, kept in g).
+
+    A streamed page keeps its request context pushed until it's sent, which
+    Flask 3.0's test client can't handle when it follows a redirect to one
+    (it pops the contexts out of order): such tests pass `buffered=True`.
+    """
+
+    if app.config['STREAM_TEMPLATES']:
+        context['flashes'] = get_flashed_messages(with_categories=True)
+        generate_csrf()
+
+        return stream_template(template_name, **context)
+
+    return render_template(template_name, **context)
+
+
+def stream_rows(q):
+    """Lazily iterate over the rows of `q`.
+
+    The query only runs once the template starts looping over it, and rows
+    come from a server-side cursor a batch at a time, so memory use doesn't
+    grow with the length of the list.
+    """
+
+    q = q.execution_options(yield_per=app.config['STREAM_BATCH_SIZE'])
+    yield from dbx(q)
 
 
 def do_login(user):
     """Log in user."""
 
+    session.regenerate()
     session[CURR_USER_KEY] = user.id
 
 
@@ -70,6 +334,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@limiter.limit()
 def signup():
     """Handle user signup.
 
@@ -88,6 +353,14 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Before hashing the password, which is the slow part
+        unavailable = availability.unavailable(
+            username=form.username.data, email=form.email.data)
+
+        if unavailable:
+            flash_unavailable(unavailable, "Username already taken")
+            return render_template('users/signup.jinja', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -110,7 +383,34 @@ def signup():
         return render_template('users/signup.jinja', form=form)
 
 
+def flash_unavailable(fields, username_taken):
+    """Flash that the username and/or e-mail in `fields` are taken."""
+
+    if "username" in fields:
+        flash(username_taken, 'danger')
+
+    if "email" in fields:
+        flash("E-mail already in use", 'danger')
+
+
+@app.get('/signup/availability')
+@limiter.limit(methods=("GET",))
+def check_availability():
+    """JSON of whether the 'username' and 'email' params are free, for the
+    signup form: {"username": true, "email": false}."""
+
+    values = {
+        field: request.args[field].strip()
+        for field in ("username", "email")
+        if request.args.get(field, "").strip()
+    }
+    unavailable = availability.unavailable(**values)
+
+    return jsonify({field: field not in unavailable for field in values})
+
+
 @app.route('/login', methods=["GET", "POST"])
+@limiter.limit()
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -140,9 +440,7 @@ def login():
 def logout():
     """Handle logout of user and redirect to homepage."""
 
-    form = g.csrf_form
-
-    if form.validate_on_submit():
+    if csrf_valid():
         do_logout()
         flash('Logged out!')
         return redirect('/login')
@@ -153,6 +451,13 @@ def logout():
 ##############################################################################
 # General user routes:
 
+def get_active_user_or_404(user_id):
+    """Get the user with `user_id`, 404ing if missing or soft-deleted."""
+
+    q = db.select(User).filter_by(id=user_id, deleted_at=None)
+    return db.one_or_404(q)
+
+
 @app.get('/users')
 def list_users():
     """Page with listing of users.
@@ -166,15 +471,37 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        q = db.select(User).order_by(User.id.desc())
+    q = select_user_cards()
+
+    if search:
+        users = stream_rows(q.filter(User.username.like(f"%{search}%")))
+
+    elif query_cache.enabled:
+        users = query_cache.all(q.order_by(User.id.desc()))
 
     else:
-        q = db.select(User).filter(User.username.like(f"%{search}%"))
+        users = stream_rows(q.order_by(User.id.desc()))
+
+    return render_page(
+        'users/index.jinja',
+        users=UserCard.from_rows(users),
+        following_ids=frozenset(g.user.following_ids()),
+    )
 
-    users = dbx(q).scalars().all()
 
-    return render_template('users/index.jinja', users=users)
+@app.get('/users/autocomplete')
+def autocomplete_users():
+    """JSON list of users whose usernames start with the 'q' param.
+
+    Answered from an in-memory index, for the search box's suggestions.
+    """
+
+    if not g.user:
+        raise Unauthorized()
+
+    prefix = request.args.get('q', '').strip()
+
+    return jsonify(usernames.complete(prefix) if prefix else [])
 
 
 @app.get('/users/<int:user_id>')
@@ -185,9 +512,23 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = db.get_or_404(User, user_id)
+    row = query_cache.one_or_none(select_user_detail(user_id))
+
+    if row is None:
+        abort(404)
 
-    return render_template('users/show.jinja', user=user)
+    user = UserDetail._make(row)
+    q = (
+        select_message_cards(g.user.id)
+        .where(Message.user_id == user.id)
+        .where(Message.recent())
+    )
+
+    return render_page(
+        'users/show.jinja',
+        user=user,
+        messages=MessageCard.from_rows(stream_rows(q)),
+    )
 
 
 @app.get('/users/<int:user_id>/likes')
@@ -212,8 +553,19 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = db.get_or_404(User, user_id)
-    return render_template('users/following.jinja', user=user)
+    user = get_active_user_or_404(user_id)
+    q = (
+        select_user_cards()
+        .join(Follow, Follow.user_being_followed_id == User.id)
+        .where(Follow.user_following_id == user.id)
+    )
+
+    return render_page(
+        'users/following.jinja',
+        user=user,
+        users=UserCard.from_rows(stream_rows(q)),
+        following_ids=frozenset(g.user.following_ids()),
+    )
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -224,43 +576,56 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = db.get_or_404(User, user_id)
-    return render_template('users/followers.jinja', user=user)
+    user = get_active_user_or_404(user_id)
+    q = (
+        select_user_cards()
+        .join(Follow, Follow.user_following_id == User.id)
+        .where(Follow.user_being_followed_id == user.id)
+    )
+
+    return render_page(
+        'users/followers.jinja',
+        user=user,
+        users=UserCard.from_rows(stream_rows(q)),
+        following_ids=frozenset(g.user.following_ids()),
+    )
 
 
 @app.post('/users/follow/<int:follow_id>')
+@limiter.limit()
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
     Redirect to following page for the current for the current user.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not csrf_valid():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = db.get_or_404(User, follow_id)
+    if not g.user.follow(follow_id):
+        abort(404)
 
-    g.user.follow(followed_user)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.post('/users/stop-following/<int:follow_id>')
+@limiter.limit()
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
     Redirect to following page for the current for the current user.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not csrf_valid():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = db.get_or_404(User, follow_id)
+    if not g.user.unfollow(follow_id):
+        abort(404)
 
-    g.user.unfollow(followed_user)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -277,6 +642,12 @@ def edit_profile():
     form = EditProfile(obj=g.user)
 
     if form.validate_on_submit():
+        unavailable = availability.unavailable(
+            g.user.id, username=form.username.data, email=form.email.data)
+
+        if unavailable:
+            flash_unavailable(unavailable, "Username already taken!")
+            return render_template("/users/edit.jinja", form=form)
 
         if User.authenticate(g.user.username, form.password.data):
 
@@ -306,16 +677,19 @@ def edit_profile():
 def delete_user():
     """Delete user.
 
+    The account is soft-deleted and hidden immediately; its rows are removed
+    later by the `purge-deleted-users` command.
+
     Redirect to signup page.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not csrf_valid():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     do_logout()
 
-    db.session.delete(g.user)
+    g.user.soft_delete()
     db.session.commit()
 
     flash("Account deleted!")
@@ -327,6 +701,7 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@limiter.limit()
 def add_message():
     """Add a message:
 
@@ -342,6 +717,9 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+
+        live_timeline.publish(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -349,6 +727,62 @@ def add_message():
     return render_template('messages/create.jinja', form=form)
 
 
+@app.get('/messages/trending')
+def show_trending():
+    """Show the most popular recent messages.
+
+    Reads the scores precomputed by the `refresh-trending` command.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    q = (
+        db.select(Message)
+        .join(TrendingMessage)
+        .join(Message.user)
+        .where(User.deleted_at.is_(None))
+        .order_by(TrendingMessage.score.desc())
+        .limit(100)
+    )
+
+    messages = dbx(q).scalars().all()
+
+    return render_template('messages/trending.jinja', messages=messages)
+
+
+@app.get('/messages/search')
+def search_messages():
+    """Search messages by text, best matches first.
+
+    Takes the search in 'q' and, for later pages, the 'after' cursor from
+    the previous page.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    search = request.args.get('q', '').strip()
+    messages, next_cursor = [], None
+
+    if search:
+        try:
+            messages, next_cursor = message_search.search(
+                search, after=request.args.get('after'))
+
+        except ValueError:
+            abort(400)
+
+    return render_template(
+        'messages/search.jinja',
+        search=search,
+        messages=messages,
+        next_cursor=next_cursor,
+    )
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -358,27 +792,32 @@ def show_message(message_id):
         return redirect("/")
 
     msg = db.get_or_404(Message, message_id)
+
+    if msg.user.deleted_at:
+        abort(404)
+
     return render_template('messages/show.jinja', message=msg)
 
 
 @app.post('/messages/<int:message_id>/like')
+@limiter.limit()
 def like_unlike_message(message_id):
     """Like/unlike message with `message_id` for the logged in user"""
 
-    if (not g.user or not g.csrf_form.validate_on_submit()):
+    if (not g.user or not csrf_valid()):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = db.get_or_404(Message, message_id)
+    toggle = g.user.like_unlike_msg(message_id)
+    db.session.commit()
 
-    if msg.user_id == g.user.id:
+    if toggle.owner_id is None:
+        abort(404)
+
+    if toggle.owner_id == g.user.id:
         flash("Cannot like your own message!")
         return redirect("/")
 
-    g.user.like_unlike_msg(msg)
-
-    db.session.commit()
-
     # NOTE request.referrer relies on the app knowing your broswer history
     # unsupported in some cases
     return redirect(f"{request.form['request_url']}")
@@ -392,7 +831,7 @@ def delete_message(message_id):
     Redirect to user page on success.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not csrf_valid():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
@@ -408,6 +847,79 @@ def delete_message(message_id):
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Notifications
+
+
+@app.get('/notifications')
+def show_notifications():
+    """Show the user's notifications, newest first, and mark them read.
+
+    Takes the 'before' cursor from the previous page for later pages.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = request.args.get('before')
+
+    try:
+        q = select_inbox(g.user.id, decode_cursor(before) if before else None)
+
+    except ValueError:
+        abort(400)
+
+    notifications = dbx(q).all()
+    next_cursor = (
+        encode_cursor(notifications[-1])
+        if len(notifications) == NOTIFICATIONS_PER_PAGE else None
+    )
+
+    if g.user.unread_notifications or any(
+            n.read_at is None for n in notifications):
+        mark_read(g.user.id)
+
+    return render_template(
+        'users/notifications.jinja',
+        notifications=notifications,
+        next_cursor=next_cursor,
+    )
+
+
+##############################################################################
+# Images
+
+
+@app.get('/images/<size>')
+def proxied_image(size):
+    """Show a user's image resized to `size`, from the image cache.
+
+    Redirect to the original if it can't be fetched or read.
+    """
+
+    if size not in IMAGE_SIZES:
+        abort(404)
+
+    try:
+        url = image_proxy.unsign(request.args.get('src', ''))
+
+    except BadSignature:
+        abort(404)
+
+    path = image_proxy.thumbnail(url, size)
+
+    if path is None:
+        return redirect(url)
+
+    response = send_file(
+        path, mimetype='image/jpeg', max_age=app.config['IMAGE_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+
+    return response
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -421,30 +933,215 @@ def homepage():
     """
 
     if g.user:
-        followed_users = [followed.id for followed in g.user.following]
+        followed_users = list(g.user.following_ids())
         q = (
-            db.select(Message)
-            .where(
-                (Message.user_id == g.user.id) |
-                (Message.user_id.in_(followed_users))
-            )
-            .order_by(Message.timestamp.desc())
+            select_message_cards(g.user.id)
+            .where(Message.user_id.in_([g.user.id, *followed_users]))
+            .where(Message.recent())
             .limit(100)
         )
 
-        messages = dbx(q).scalars().all()
+        messages = list(MessageCard.from_rows(dbx(q)))
 
-        return render_template('home.jinja', messages=messages)
+        return render_template(
+            'home.jinja',
+            messages=messages,
+            suggestions=g.user.suggested_users(),
+        )
 
     else:
         return render_template('home-anon.jinja')
 
 
+@app.get('/timeline/events')
+def timeline_events():
+    """Stream of new messages for the home page, which only the ASGI app
+    serves (see asgi.py).
+
+    Here, No Content: that tells the page's EventSource not to reconnect.
+    """
+
+    return "", 204
+
+
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request the view didn't set caching
+    headers for itself."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if response.cache_control.max_age is None:
+        response.cache_control.no_store = True
 
     return response
+
+
+if app.config['JINJA_PRECOMPILE']:
+    precompile_templates()
+
+
+##############################################################################
+# Background jobs (run from cron / a scheduler)
+
+
+@app.cli.command('purge-deleted-users')
+@click.option('--batch-size', default=1000, show_default=True)
+def purge_deleted_users(batch_size):
+    """Purge soft-deleted users and their content in bounded batches."""
+
+    purged = User.purge_deleted(batch_size=batch_size)
+    click.echo(f"Purged {purged} deleted user(s).")
+
+
+@app.cli.command('refresh-trending')
+@click.option('--window-hours', type=float)
+@click.option('--half-life-hours', type=float)
+@click.option('--lag-seconds', type=float,
+              help="Longest a transaction liking a message may run.")
+def refresh_trending(window_hours, half_life_hours, lag_seconds):
+    """Decay trending scores and fold in likes since the last refresh."""
+
+    options = {}
+    if window_hours:
+        options['window'] = timedelta(hours=window_hours)
+    if half_life_hours:
+        options['half_life'] = timedelta(hours=half_life_hours)
+    if lag_seconds is not None:
+        options['lag'] = timedelta(seconds=lag_seconds)
+
+    TrendingMessage.refresh(**options)
+    click.echo("Trending messages refreshed.")
+
+
+@app.cli.command('archive-messages')
+@click.option('--days', type=int, help="Archive messages older than this.")
+@click.option('--tablespace', help="Move archived partitions here.")
+def archive_old_messages(days, tablespace):
+    """Archive old messages, and add partitions for new ones."""
+
+    days = days or app.config['MESSAGE_ARCHIVE_DAYS']
+    archive = archive_messages(
+        timedelta(days=days),
+        tablespace=tablespace or app.config['MESSAGE_ARCHIVE_TABLESPACE'],
+    )
+
+    if archive is None:
+        click.echo("No more messages to archive.")
+    else:
+        click.echo(f"Archived messages before #{archive.before_id}.")
+
+
+@app.cli.command('collapse-notifications')
+@click.option('--batch-size', default=10_000, show_default=True)
+def collapse_notification_events(batch_size):
+    """Fold new likes and follows into users' notifications."""
+
+    folded = collapse_notifications(batch_size=batch_size)
+    click.echo(f"Collapsed {folded} notification event(s).")
+
+
+@app.cli.command('reindex-messages')
+def reindex_messages():
+    """Rebuild the message search index from the messages table."""
+
+    count = message_search.index.rebuild()
+    click.echo(f"Reindexed {count} message(s).")
+
+
+@app.cli.command('refresh-suggestions')
+@click.option('--full', is_flag=True, help="Recompute every user.")
+@click.option('--batch-size', default=1000, show_default=True)
+def refresh_follow_suggestions(full, batch_size):
+    """Recompute who-to-follow suggestions for users whose graph changed."""
+
+    refreshed = refresh_suggestions(full=full, batch_size=batch_size)
+    click.echo(f"Refreshed suggestions for {refreshed} user(s).")
+
+
+@app.cli.command('compile-templates')
+def compile_templates():
+    """Warm the shared Jinja bytecode cache, e.g. as a deploy step."""
+
+    names = precompile_templates()
+    click.echo(f"Compiled {len(names)} template(s).")
+
+
+@app.cli.command('purge-sessions')
+@click.option('--batch-size', default=1000, show_default=True)
+def purge_sessions(batch_size):
+    """Delete expired server-side sessions in bounded batches."""
+
+    purged = app.session_interface.store.purge_expired(batch_size=batch_size)
+    click.echo(f"Purged {purged} expired session(s).")
+
+
+##############################################################################
+# Schema
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Apply pending schema migrations (see migrations.py)."""
+
+    applied = upgrade()
+    click.echo(f"Applied {len(applied)} migration(s).")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail if a core query's plan doesn't use its index (PostgreSQL)."""
+
+    problems = check_plans()
+
+    for name, used in problems.items():
+        click.echo(
+            f"{name}: uses {', '.join(sorted(used)) or 'no index'}", err=True)
+
+    if problems:
+        raise click.ClickException(
+            f"{len(problems)} core query plan(s) missing their index.")
+
+    click.echo("All core query plans use their indexes.")
+
+
+##############################################################################
+# Load testing
+
+
+@app.cli.command('replay-traffic')
+@click.argument('capture_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--url', help="Local server to send to; default in-process.")
+@click.option('--speed', default=1.0, show_default=True,
+              help="Times the original pace; 0 for no waits.")
+@click.option('--concurrency', default=1, show_default=True,
+              help="Requests at once; raise it with --url.")
+def replay_traffic(capture_dir, url, speed, concurrency):
+    """Replay captured requests and compare latency by endpoint.
+
+    Run against a copy of the database the traffic was captured from.
+    """
+
+    entries = read_capture(capture_dir)
+    users = dict.fromkeys(e["user"] for e in entries if e["user"] is not None)
+    sessions = login_sessions(app, users, CURR_USER_KEY)
+    send = http_sender(url) if url else client_sender(app)
+
+    results = replay(
+        entries,
+        send,
+        sessions,
+        cookie_name=app.config['SESSION_COOKIE_NAME'],
+        speed=speed,
+        concurrency=concurrency,
+    )
+
+    click.echo(
+        f"{'endpoint':<24}{'count':>7}{'p50 was':>10}{'p50 now':>10}"
+        f"{'p95 was':>10}{'p95 now':>10}{'change':>9}{'status':>8}")
+
+    for endpoint, row in compare_latency(entries, results).items():
+        count, p50_was, p95_was, p50_now, p95_now, changed = row
+        change = (p50_now - p50_was) / p50_was if p50_was else 0
+        click.echo(
+            f"{endpoint:<24}{count:>7}{p50_was:>10.1f}{p50_now:>10.1f}"
+            f"{p95_was:>10.1f}{p95_now:>10.1f}{change:>+9.0%}{changed:>8}")
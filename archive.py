@@ -0,0 +1,174 @@
+"""Archiving old messages.
+
+On PostgreSQL the messages table is partitioned by ranges of ids, a
+MESSAGE_PARTITION_SIZE-id partition after another, plus a default partition
+for any ids beyond the last one. Message ids only grow, so a partition holds
+messages from one stretch of time.
+
+`archive_messages()` (run daily by `flask archive-messages`) does two things:
+
+- adds partitions so there's always an empty one ahead for new messages,
+  rather than having them land in the default partition;
+- archives the partitions whose messages are all older than the horizon:
+  it records where recent messages start (a MessageArchive row), and can
+  move archived partitions and their indexes to a cheaper tablespace.
+
+Feed and profile queries filter on `Message.recent()`, so PostgreSQL reads
+only the partitions of recent messages for them, however many archived ones
+pile up. Archived messages are otherwise untouched: they're still shown by
+id, liked and searched, and can be deleted.
+
+Other databases have no partitions: there, archiving just records the first
+recent message's id.
+"""
+
+import re
+from collections import namedtuple
+
+from models import db, dbx, Message, MessageArchive, MESSAGE_PARTITION_SIZE
+
+# `start` and `end` are None for MINVALUE / MAXVALUE
+Partition = namedtuple("Partition", ["name", "start", "end", "tablespace"])
+
+RANGE_BOUNDS = re.compile(r"FROM \((\w+)\) TO \((\w+)\)")
+
+
+def _bound(value):
+    return None if value in ("MINVALUE", "MAXVALUE") else int(value)
+
+
+def message_partitions():
+    """The messages table's range partitions (not the default one), in
+    order. PostgreSQL only."""
+
+    rows = dbx(db.text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), t.spcname"
+        " FROM pg_inherits i"
+        " JOIN pg_class c ON c.oid = i.inhrelid"
+        " LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace"
+        " WHERE i.inhparent = 'messages'::regclass"
+    ))
+
+    partitions = []
+
+    for name, bounds, tablespace in rows:
+        match = RANGE_BOUNDS.search(bounds)
+
+        if match:
+            start, end = map(_bound, match.groups())
+            partitions.append(Partition(name, start, end, tablespace))
+
+    return sorted(
+        partitions,
+        key=lambda p: float("-inf") if p.start is None else p.start)
+
+
+def add_partitions(size=MESSAGE_PARTITION_SIZE):
+    """Add partitions until there's room for `size` more messages beyond
+    the newest; returns the names of those added. PostgreSQL only."""
+
+    partitions = message_partitions()
+    if partitions and partitions[-1].end is None:
+        # Open-ended: there's always room
+        return []
+
+    newest = dbx(db.select(db.func.max(Message.id))).scalar() or 0
+    start = max([p.end for p in partitions] or [1])
+
+    # Ids in the default partition can't be given a partition of their own
+    # later, so new partitions start after them
+    in_default = dbx(db.text("SELECT max(id) FROM messages_default")).scalar()
+    if in_default is not None:
+        start = max(start, in_default + 1)
+
+    added = []
+
+    while start <= newest + size:
+        name = f"messages_p{start}"
+        dbx(db.text(
+            f"CREATE TABLE {name} PARTITION OF messages"
+            f" FOR VALUES FROM ({start}) TO ({start + size})"
+        ))
+        added.append(name)
+        start += size
+
+    return added
+
+
+def move_to_tablespace(partition, tablespace):
+    """Move an archived partition and its indexes to `tablespace`.
+
+    Locks the partition (only) while its files are copied.
+    """
+
+    indexes = dbx(
+        db.text(
+            "SELECT indexrelid::regclass::text FROM pg_index"
+            " WHERE indrelid = to_regclass(:name)"
+        ),
+        {"name": partition.name},
+    ).scalars().all()
+
+    dbx(db.text(f"ALTER TABLE {partition.name} SET TABLESPACE {tablespace}"))
+
+    for index in indexes:
+        dbx(db.text(f"ALTER INDEX {index} SET TABLESPACE {tablespace}"))
+
+
+def archive_messages(age, size=MESSAGE_PARTITION_SIZE, tablespace=None):
+    """Archive messages older than `age` (a timedelta).
+
+    On PostgreSQL only whole partitions are archived, so messages in the
+    same partition as the first recent one stay recent. Archived partitions
+    are moved to `tablespace`, if given.
+
+    Returns the new MessageArchive, or None if nothing more was archived.
+    """
+
+    postgresql = db.session.get_bind().dialect.name == "postgresql"
+
+    # By the database's clock, which stamped the messages
+    now = dbx(db.select(db.func.current_timestamp(type_=db.DateTime)))
+    horizon = now.scalar().replace(tzinfo=None) - age
+
+    if postgresql:
+        add_partitions(size)
+
+    first_recent = dbx(
+        db.select(db.func.min(Message.id)).where(Message.timestamp >= horizon)
+    ).scalar()
+
+    if first_recent is None:
+        first_recent = (
+            dbx(db.select(db.func.max(Message.id))).scalar() or 0) + 1
+
+    before_id = first_recent
+
+    if postgresql:
+        partitions = message_partitions()
+
+        # The start of the partition the first recent message is in
+        before_id = max(
+            [p.start for p in partitions
+             if p.start is not None and p.start <= first_recent]
+            or [0])
+
+        if tablespace:
+            for partition in partitions:
+                if (partition.end is not None
+                        and partition.end <= before_id
+                        and partition.tablespace != tablespace):
+                    move_to_tablespace(partition, tablespace)
+
+    archived_before = dbx(
+        db.select(db.func.max(MessageArchive.before_id))).scalar() or 0
+
+    if before_id <= archived_before:
+        db.session.commit()
+        return None
+
+    archive = MessageArchive(before_id=before_id, horizon=horizon)
+    db.session.add(archive)
+    db.session.commit()
+
+    return archive
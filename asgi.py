@@ -0,0 +1,420 @@
+"""ASGI serving mode: the busiest read pages on asyncio.
+
+    $ uvicorn asgi:application --workers 4
+
+A sync worker waiting on the database for a page can't do anything else.
+Here the home feed and the following / followers pages are served by
+coroutines that query through an async engine (asyncpg), so one worker can
+have hundreds of them waiting on the database at once. Each reads everything
+its page shows up front, as read models, then renders the usual template
+from that in the Flask app's context.
+
+It also serves the home page's stream of new messages (see timeline.py),
+which a sync worker couldn't hold open for every viewer.
+
+Everything else goes to the unchanged Flask app, run in a thread pool by
+asgiref's WsgiToAsgi: other pages, writes, and these pages when the visitor
+isn't logged in, or when rendering would have to write their session (no
+CSRF token yet, or flashed messages to show).
+"""
+
+import asyncio
+import re
+import sys
+from io import BytesIO
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import g, render_template, request
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import app, CURR_USER_KEY, live_timeline
+from models import Follow, FOLLOW_DIRECTIONS, Message, User
+from readmodels import (
+    MessageCard, UserCard, UserDetail, Viewer,
+    select_message_cards, select_user_cards, select_user_detail,
+)
+from sessions import DatabaseSessionStore
+from timeline import message_event
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def create_engine(url):
+    """Async engine for the same database as sync `url`."""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+
+    # SQLite engines don't keep a pool of connections to size
+    if backend != "sqlite":
+        return create_async_engine(
+            url, pool_size=app.config['ASYNC_DB_POOL_SIZE'])
+
+    return create_async_engine(url)
+
+
+engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+AsyncSession = async_sessionmaker(engine)
+flask_app = WsgiToAsgi(app)
+
+TIMELINE_EVENTS_PATH = "/timeline/events"
+
+
+##############################################################################
+# Pages. Each returns (template name, context), or None to leave the request
+# to the Flask app.
+
+
+async def home(db_session, viewer):
+    """Home feed: the latest messages of the viewer and whom they follow."""
+
+    q = (
+        select_message_cards(viewer.id)
+        .where(Message.user_id.in_([viewer.id, *viewer.following_ids]))
+        .where(Message.recent())
+        .limit(100)
+    )
+    messages = list(MessageCard.from_rows(await db_session.execute(q)))
+
+    q = User.select_suggested(select_user_cards(), viewer.id)
+    suggestions = list(UserCard.from_rows(await db_session.execute(q)))
+
+    return 'home.jinja', {"messages": messages, "suggestions": suggestions}
+
+
+def follow_list(direction):
+    """Page of the users a user is following / followed by."""
+
+    this, other = FOLLOW_DIRECTIONS[direction]
+
+    async def page(db_session, viewer, user_id):
+        row = (await db_session.execute(select_user_detail(user_id))).first()
+
+        if row is None:
+            return None
+
+        q = (
+            select_user_cards()
+            .join(Follow, other == User.id)
+            .where(this == user_id)
+        )
+        users = list(UserCard.from_rows(await db_session.execute(q)))
+
+        return f'users/{direction}.jinja', {
+            "user": UserDetail._make(row),
+            "users": users,
+            "following_ids": viewer.following_ids,
+        }
+
+    return page
+
+
+PAGES = [
+    (re.compile(r"/"), home),
+    (re.compile(r"/users/(\d+)/following"), follow_list("following")),
+    (re.compile(r"/users/(\d+)/followers"), follow_list("followers")),
+]
+
+
+##############################################################################
+# Serving
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if scope["type"] == "http" and scope["method"] == "GET":
+        if scope["path"] == TIMELINE_EVENTS_PATH:
+            if await stream_timeline(scope, receive, send):
+                return
+
+        for pattern, page in PAGES:
+            match = pattern.fullmatch(scope["path"])
+
+            if match:
+                response = await serve(page, scope, *map(int, match.groups()))
+
+                if response is not None:
+                    return await send_response(send, response)
+
+                break
+
+    await flask_app(scope, receive, send)
+
+
+async def serve(page, scope, *args):
+    """Response of `page` to a logged-in viewer, or None."""
+
+    environ = wsgi_environ(scope)
+
+    async with AsyncSession() as db_session:
+        session_data, viewer = await load_login(db_session, environ)
+
+        if (
+            viewer is None
+            or "csrf_token" not in session_data
+            or "_flashes" in session_data
+        ):
+            return None
+
+        result = await page(db_session, viewer, *args)
+        if result is None:
+            return None
+
+    template_name, context = result
+
+    return render(environ, session_data, viewer, template_name, context)
+
+
+async def stream_timeline(scope, receive, send):
+    """Stream new messages for the logged-in viewer's home page as
+    Server-Sent Events, until the client disconnects.
+
+    False, having sent nothing, if nobody's logged in.
+    """
+
+    environ = wsgi_environ(scope)
+    incoming = app.request_class(environ)
+
+    after = incoming.headers.get("Last-Event-ID", incoming.args.get("after"))
+    after = int(after) if after and after.isdigit() else None
+
+    async with AsyncSession() as db_session:
+        _session_data, viewer = await load_login(db_session, environ)
+
+    if viewer is None:
+        return False
+
+    subscription = live_timeline.subscribe([viewer.id, *viewer.following_ids])
+
+    try:
+        missed = []
+
+        # Messages posted since the page was made, or the stream was lost
+        if after is not None:
+            q = (
+                select_message_cards(viewer.id)
+                .where(Message.user_id.in_(subscription.author_ids))
+                .where(Message.id > after)
+                .order_by(None)
+                .order_by(Message.id.desc())
+                .limit(100)
+            )
+
+            async with AsyncSession() as db_session:
+                rows = await db_session.execute(q)
+                missed = list(MessageCard.from_rows(rows))[::-1]
+
+        with app.request_context(environ):
+            missed = [(m.id, message_event(m)) for m in missed]
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-store"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+
+        # No database connection is held while the stream waits
+        await send_events(subscription, missed, after or 0, receive, send)
+
+    finally:
+        live_timeline.unsubscribe(subscription)
+
+    return True
+
+
+async def send_events(subscription, missed, last_id, receive, send):
+    """Send `missed` events, then the subscription's as they come, with a
+    comment every so often to keep the connection open."""
+
+    async def send_event(message_id, event):
+        await send({
+            "type": "http.response.body",
+            "body": f"id: {message_id}\ndata: {event}\n\n".encode(),
+            "more_body": True,
+        })
+
+    for message_id, event in missed:
+        await send_event(message_id, event)
+        last_id = message_id
+
+    disconnected = asyncio.ensure_future(
+        wait_for_disconnect(receive, subscription))
+
+    try:
+        while not subscription.overflowed:
+            try:
+                async with asyncio.timeout(live_timeline.keepalive):
+                    item = await subscription.queue.get()
+
+            except TimeoutError:
+                await send({
+                    "type": "http.response.body",
+                    "body": b": keepalive\n\n",
+                    "more_body": True,
+                })
+                continue
+
+            # The client went away
+            if item is None:
+                return
+
+            message_id, event = item
+
+            # Already sent from the database?
+            if message_id > last_id:
+                await send_event(message_id, event)
+                last_id = message_id
+
+    finally:
+        disconnected.cancel()
+
+    # Fell behind and missed events: end the stream, so the client
+    # reconnects and gets them from the database
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def wait_for_disconnect(receive, subscription):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+    subscription.end()
+
+
+async def load_login(db_session, environ):
+    """(session data, Viewer) of a request; the Viewer is None if nobody's
+    logged in."""
+
+    cookies = app.request_class(environ).cookies
+    sid = cookies.get(app.session_interface.get_cookie_name(app))
+    session_data = await load_session(db_session, sid) if sid else {}
+
+    if CURR_USER_KEY not in session_data:
+        return session_data, None
+
+    viewer = await load_viewer(db_session, session_data[CURR_USER_KEY])
+
+    return session_data, viewer
+
+
+async def load_session(db_session, sid):
+    """Contents of session `sid` (empty if there's no such session)."""
+
+    interface = app.session_interface
+
+    if isinstance(interface.store, DatabaseSessionStore):
+        data = await db_session.scalar(interface.store.select_data(sid))
+    else:
+        data = interface.store.load(sid)
+
+    return interface.serializer.loads(data) if data else {}
+
+
+async def load_viewer(db_session, user_id):
+    """Viewer of active user `user_id`, or None."""
+
+    row = (await db_session.execute(select_user_detail(user_id))).first()
+
+    if row is None:
+        return None
+
+    q = User.select_follow_ids("following", user_id)
+    following_ids = frozenset(await db_session.scalars(q))
+
+    return Viewer(*row, following_ids)
+
+
+def render(environ, session_data, viewer, template_name, context):
+    """Render a page as the Flask app would, from data already loaded."""
+
+    with app.request_context(environ) as ctx:
+        ctx.session.fill(session_data)
+        g.user = viewer
+        g.request_url = request.url
+
+        response = app.make_response(render_template(template_name, **context))
+        return app.process_response(response)
+
+
+async def send_response(send, response):
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in response.headers.to_wsgi_list()
+        ],
+    })
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+
+async def lifespan(receive, send):
+    listener = None
+
+    while True:
+        message = await receive()
+
+        if message["type"] == "lifespan.startup":
+            listener = asyncio.ensure_future(
+                live_timeline.backend.listen(engine))
+            await send({"type": "lifespan.startup.complete"})
+
+        elif message["type"] == "lifespan.shutdown":
+            if listener is not None:
+                listener.cancel()
+
+            await engine.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def wsgi_environ(scope):
+    """WSGI environ of a GET request's ASGI HTTP scope."""
+
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+
+        if name in environ:
+            value = f"{environ[name]},{value}"
+
+        environ[name] = value
+
+    return environ
@@ -0,0 +1,161 @@
+"""Username autocomplete for the search box.
+
+Usernames live in a sorted list in memory, so completing a prefix is a binary
+search and a short scan, with no database query. The list is loaded when
+the app starts, kept in step with signups, username changes and account
+deletions made through this worker's ORM, and loaded again once it's older
+than AUTOCOMPLETE_TTL seconds, so changes made through other workers show
+up within that time.
+"""
+
+import threading
+import time
+from bisect import bisect_left, insort
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import object_session
+
+from models import db, dbx, on_commit, User
+
+
+class UsernameIndex:
+    """Sorted (lowercased username, username, user id) entries. Per process.
+
+    Matching is case-insensitive; results come back in alphabetical order.
+    Lookups load the entries first if they're older than `ttl` seconds (or
+    haven't been loaded).
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._entries = []
+        self._by_id = {}
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def add(self, user_id, username):
+        """Add a user, or update their username if they're already in."""
+
+        with self._lock:
+            if self._built_at is None:
+                return
+
+            self._remove(user_id)
+
+            entry = (username.lower(), username, user_id)
+            insort(self._entries, entry)
+            self._by_id[user_id] = entry
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        entry = self._by_id.pop(user_id, None)
+
+        if entry:
+            del self._entries[bisect_left(self._entries, entry)]
+
+    def rebuild(self):
+        """Load every active user from scratch; returns how many there are."""
+
+        q = db.select(User.username, User.id).filter_by(deleted_at=None)
+
+        with self._lock:
+            entries = sorted(
+                (username.lower(), username, user_id)
+                for username, user_id in dbx(q)
+            )
+
+            self._entries = entries
+            self._by_id = {entry[2]: entry for entry in entries}
+            self._built_at = time.monotonic()
+
+            return len(entries)
+
+    def complete(self, prefix, limit):
+        """Up to `limit` (user_id, username) pairs starting with `prefix`."""
+
+        built_at = self._built_at
+
+        if built_at is None or (
+                self.ttl is not None
+                and time.monotonic() - built_at >= self.ttl):
+            self.rebuild()
+
+        prefix = prefix.lower()
+        matches = []
+
+        with self._lock:
+            i = bisect_left(self._entries, (prefix,))
+
+            while i < len(self._entries) and len(matches) < limit:
+                key, username, user_id = self._entries[i]
+
+                if not key.startswith(prefix):
+                    break
+
+                matches.append((user_id, username))
+                i += 1
+
+        return matches
+
+
+class UsernameAutocomplete:
+    """Keeps a UsernameIndex of the app's users up to date."""
+
+    def __init__(self, app=None):
+        self.index = UsernameIndex()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AUTOCOMPLETE_LIMIT', 10)
+        app.config.setdefault('AUTOCOMPLETE_TTL', 300)
+
+        self.limit = app.config['AUTOCOMPLETE_LIMIT']
+        self.index.ttl = app.config['AUTOCOMPLETE_TTL']
+
+        db.event.listen(User, "after_insert", self._user_added)
+        # Before, not after: soft_delete sets deleted_at to a SQL expression,
+        # whose history is gone once the UPDATE has run
+        db.event.listen(User, "before_update", self._user_updated)
+        db.event.listen(User, "after_delete", self._user_deleted)
+
+        # Loaded now, so no request waits for it. If the users table can't
+        # be read yet (no database, or it isn't migrated) the first lookup
+        # loads it instead.
+        with app.app_context():
+            try:
+                self.index.rebuild()
+            except DBAPIError:
+                pass
+            finally:
+                # Workers forked after this mustn't share its connections
+                db.engine.dispose()
+
+    def _user_added(self, mapper, connection, user):
+        on_commit(object_session(user), self.index.add, user.id, user.username)
+
+    def _user_updated(self, mapper, connection, user):
+        attrs = db.inspect(user).attrs
+        deleted_at = attrs.deleted_at.history
+        session = object_session(user)
+
+        if deleted_at.added and deleted_at.added[0] is not None:
+            on_commit(session, self.index.remove, user.id)
+
+        elif deleted_at.has_changes() or attrs.username.history.has_changes():
+            on_commit(session, self.index.add, user.id, user.username)
+
+    def _user_deleted(self, mapper, connection, user):
+        on_commit(object_session(user), self.index.remove, user.id)
+
+    def complete(self, prefix):
+        """Users whose names start with `prefix`, as dicts for JSON."""
+
+        return [
+            {"id": user_id, "username": username}
+            for user_id, username in self.index.complete(prefix, self.limit)
+        ]
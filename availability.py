@@ -0,0 +1,186 @@
+"""Username and e-mail availability, checked before any password hashing.
+
+Signup and profile edits used to find a taken username or e-mail only when
+the INSERT / UPDATE failed, after bcrypt had already spent a quarter of a
+second hashing. They now ask here first.
+
+A Bloom filter of every taken username and e-mail answers most checks for
+free values without a query; anything it may have seen is checked against
+the users table's unique indexes. The filter is loaded on the first check,
+kept in step with signups and profile changes made through the ORM, and
+loaded again once it's older than AVAILABILITY_BLOOM_TTL seconds.
+
+It's per process, so a value taken through another worker since the filter
+was loaded looks free here until then: the unique constraints (and the
+views' handling of IntegrityError) still turn the duplicate away, just after
+the hashing, but /signup/availability may call it free in the meantime.
+Values can't be taken out of a Bloom filter, so a purged user's username
+stays in it until the next rebuild; it just costs a query to find it free.
+"""
+
+import math
+import threading
+import time
+from hashlib import blake2b
+
+from sqlalchemy.orm import object_session
+
+from models import db, dbx, on_commit, User
+
+FIELDS = ("username", "email")
+
+
+class BloomFilter:
+    """Set membership with no false negatives and about `error_rate` false
+    positives, up to `capacity` values."""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+
+class TakenValues:
+    """Bloom filter of taken usernames and e-mails. Per process.
+
+    Sized for twice the users there are when it's (re)built, and built
+    again on the next check once it's full or older than `ttl` seconds.
+    """
+
+    def __init__(self, min_capacity, error_rate, ttl=None):
+        self.min_capacity = min_capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self._filter = None
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def add(self, field, value):
+        with self._lock:
+            if self._filter is None:
+                return
+
+            self._filter.add(f"{field}:{value}")
+
+            if self._filter.count > self._filter.capacity:
+                self._filter = None
+
+    def rebuild(self):
+        """Load every user's username and e-mail; returns how many users."""
+
+        return self._load().count // len(FIELDS)
+
+    def _load(self):
+
+        # Soft-deleted users keep theirs until they're purged
+        rows = dbx(db.select(User.username, User.email)).all()
+        capacity = max(self.min_capacity, 2 * len(FIELDS) * len(rows))
+        bloom = BloomFilter(capacity, self.error_rate)
+
+        for username, email in rows:
+            bloom.add(f"username:{username}")
+            bloom.add(f"email:{email}")
+
+        with self._lock:
+            self._filter = bloom
+            self._built_at = time.monotonic()
+
+        return bloom
+
+    def may_contain(self, field, value):
+        """False if `value` is certainly not taken for `field`."""
+
+        # add() drops a full filter from another thread, so use one
+        # reference throughout
+        with self._lock:
+            bloom, built_at = self._filter, self._built_at
+
+        if bloom is None or (
+                self.ttl is not None
+                and time.monotonic() - built_at >= self.ttl):
+            bloom = self._load()
+
+        return f"{field}:{value}" in bloom
+
+
+class Availability:
+    """Checks whether usernames and e-mails are free to use."""
+
+    def __init__(self, app=None):
+        self.taken = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AVAILABILITY_BLOOM_ENABLED', True)
+        app.config.setdefault('AVAILABILITY_BLOOM_MIN_CAPACITY', 100_000)
+        app.config.setdefault('AVAILABILITY_BLOOM_ERROR_RATE', 0.01)
+        app.config.setdefault('AVAILABILITY_BLOOM_TTL', 300)
+
+        if not app.config['AVAILABILITY_BLOOM_ENABLED']:
+            return
+
+        self.taken = TakenValues(
+            app.config['AVAILABILITY_BLOOM_MIN_CAPACITY'],
+            app.config['AVAILABILITY_BLOOM_ERROR_RATE'],
+            app.config['AVAILABILITY_BLOOM_TTL'],
+        )
+
+        db.event.listen(User, "after_insert", self._user_changed)
+        db.event.listen(User, "after_update", self._user_changed)
+
+    def _user_changed(self, mapper, connection, user):
+        attrs = db.inspect(user).attrs
+        session = object_session(user)
+
+        for field in FIELDS:
+            if getattr(attrs, field).history.added:
+                on_commit(
+                    session, self.taken.add, field, getattr(user, field))
+
+    def unavailable(self, user_id=None, **values):
+        """Which of the `values` given (username=..., email=...) are taken,
+        by a user other than `user_id`; as a set of field names."""
+
+        maybe_taken = {
+            field: value for field, value in values.items()
+            if value and (
+                self.taken is None or self.taken.may_contain(field, value))
+        }
+
+        if not maybe_taken:
+            return set()
+
+        q = db.select(*(
+            db.exists().where(
+                getattr(User, field) == value,
+                User.id != user_id if user_id is not None else db.true(),
+            ).label(field)
+            for field, value in maybe_taken.items()
+        ))
+        row = dbx(q).one()
+
+        return {field for field in maybe_taken if getattr(row, field)}
@@ -0,0 +1,1154 @@
+"""Benchmarks for Warbler's hot paths.
+
+Like the tests, these need a throwaway database (some benchmarks recreate the
+tables and fill them with synthetic data). In your shell:
+
+    $ DATABASE_URL=postgresql:///warbler_test python3 bench.py
+
+Pass benchmark names to run just those:
+
+    $ DATABASE_URL=postgresql:///warbler_test python3 bench.py card_render
+"""
+
+import asyncio
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from flask import g, render_template, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSessionInterface
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from PIL import Image
+
+from flask_wtf import FlaskForm
+from flask_wtf.csrf import generate_csrf, validate_csrf
+
+import asgi
+from archive import add_partitions, archive_messages, message_partitions
+from app import (
+    app, CURR_USER_KEY, availability, image_proxy, live_timeline, microcache,
+    query_cache, usernames,
+)
+from graph import FollowGraph, GraphCache
+from images import HTTPFetcher, ThumbnailCache
+from microcache import MemoryPageStore
+from models import (
+    db, dbx, User, Follow, Like, Message, Notification, NotificationEvent,
+    TrendingMessage, _is_following, _load_expected_first,
+)
+from notifications import (
+    NOTIFICATIONS_PER_PAGE, collapse_notifications, select_inbox)
+from ratelimit import RATELIMIT_BACKENDS
+from readmodels import (
+    UserCard, select_message_cards, select_user_cards, select_user_detail)
+from sessions import SESSION_STORES
+from suggestions import suggest
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    """Register `fn` as a benchmark; it returns a dict of results."""
+
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def timed(fn, repeat=5, number=1):
+    """Best wall-clock time of `repeat` rounds of `number` calls, in ms."""
+
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return best * 1000
+
+
+def fake_message(i, user):
+    """Stand-in for a Message with what the card templates read."""
+
+    return SimpleNamespace(
+        id=i,
+        text=f"Message number {i}",
+        timestamp=datetime(2024, 1, 1),
+        user=user,
+        user_id=user.id,
+        like_count=i % 7,
+        is_liked_by_user=lambda user_id: i % 2 == 0,
+    )
+
+
+##############################################################################
+# Templates
+
+
+@benchmark
+def template_cold_start():
+    """Compile all templates the way a fresh worker would.
+
+    Compares compiling from source with loading from a warm on-disk bytecode
+    cache.
+    """
+
+    names = app.jinja_env.list_templates(extensions=['jinja'])
+
+    def compile_all(bytecode_cache):
+        env = app.jinja_env.overlay(cache_size=0)
+        env.bytecode_cache = bytecode_cache
+        for name in names:
+            env.get_template(name)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = FileSystemBytecodeCache(cache_dir)
+        compile_all(cache)
+
+        return {
+            "templates": len(names),
+            "from_source_ms": timed(lambda: compile_all(None)),
+            "from_bytecode_ms": timed(lambda: compile_all(cache)),
+        }
+
+
+@benchmark
+def card_render(cards=1000):
+    """Per-card cost of the like/unlike partial: {% include %} vs. macro."""
+
+    partial = (
+        '<div>{% if message.user_id != viewer_id %}'
+        '<form action="/messages/{{ message.id }}/like">'
+        '{{ message.like_count }}</form>{% endif %}</div>'
+    )
+    env = Environment(loader=DictLoader({
+        "partial.jinja": partial,
+        "macro.jinja": f"{{% macro card(message) %}}{partial}{{% endmacro %}}",
+        "include.jinja": (
+            "{% for message in messages %}"
+            "{% include 'partial.jinja' %}{% endfor %}"),
+        "import.jinja": (
+            "{% from 'macro.jinja' import card with context %}"
+            "{% for message in messages %}{{ card(message) }}{% endfor %}"),
+    }))
+
+    user = SimpleNamespace(id=1, username="u1", image_url="")
+    messages = [fake_message(i, user) for i in range(cards)]
+
+    def render(name):
+        return timed(lambda: env.get_template(name).render(
+            messages=messages, viewer_id=2))
+
+    return {
+        "cards": cards,
+        "include_us_per_card": render("include.jinja") * 1000 / cards,
+        "macro_us_per_card": render("import.jinja") * 1000 / cards,
+    }
+
+
+@benchmark
+def home_render(cards=100):
+    """Render the logged-in home page with `cards` messages."""
+
+    user = SimpleNamespace(
+        id=1,
+        username="u1",
+        image_url="",
+        header_image_url="",
+        num_messages=0,
+        num_following=0,
+        num_followers=0,
+    )
+    author = SimpleNamespace(id=2, username="u2", image_url="")
+    messages = [fake_message(i, author) for i in range(cards)]
+
+    with app.test_request_context("/"):
+        g.user = user
+        g.request_url = "/"
+
+        ms = timed(lambda: render_template('home.jinja', messages=messages))
+
+    return {"cards": cards, "ms": ms, "us_per_card": ms * 1000 / cards}
+
+
+##############################################################################
+# Sessions
+
+
+@benchmark
+def session_lookup(number=1000):
+    """Cookie size and per-request session cost: signed cookie vs. stores."""
+
+    data = {
+        CURR_USER_KEY: 1,
+        "csrf_token": secrets.token_hex(20),
+        "_flashes": [("success", "Hello, someone!")],
+    }
+
+    signer = SecureCookieSessionInterface().get_signing_serializer(app)
+    cookie = signer.dumps(data)
+    results = {
+        "signed_cookie_bytes": len(cookie),
+        "server_side_cookie_bytes": len(secrets.token_urlsafe(18)),
+        "signed_cookie_us": timed(
+            lambda: signer.loads(cookie), number=number) * 1000,
+    }
+
+    db.create_all()
+    serializer = TaggedJSONSerializer()
+    later = datetime.now() + timedelta(hours=1)
+
+    for name, store_class in SESSION_STORES.items():
+        store = store_class()
+        store.save("bench", serializer.dumps(data), later)
+        results[f"{name}_store_us"] = timed(
+            lambda: serializer.loads(store.load("bench")),
+            number=number,
+        ) * 1000
+        store.delete("bench")
+
+    return results
+
+
+##############################################################################
+# CSRF
+
+
+@benchmark
+def csrf_overhead(number=1000):
+    """Per-request CSRF cost: an eager CSRF form vs. lazy tokens.
+
+    The old before_request hook built a form (making a token) on every
+    request; now requests that render no form and accept no POST pay
+    nothing, and POSTs check the token without building a form.
+    """
+
+    class CSRFForm(FlaskForm):
+        """The form the old hook built for every request."""
+
+    def eager():
+        with app.test_request_context("/"):
+            CSRFForm()
+
+    def lazy():
+        with app.test_request_context("/"):
+            pass
+
+    with app.test_request_context("/"):
+        token = generate_csrf()
+        raw_token = session["csrf_token"]
+
+    def post(check):
+        def run():
+            with app.test_request_context(
+                    "/", method="POST", data={"csrf_token": token}):
+                session["csrf_token"] = raw_token
+                check()
+        return run
+
+    def form_check():
+        assert CSRFForm().validate_on_submit()
+
+    def token_check():
+        validate_csrf(token)
+
+    enabled = app.config.get('WTF_CSRF_ENABLED', True)
+    app.config['WTF_CSRF_ENABLED'] = True
+
+    try:
+        return {
+            "get_eager_form_us": timed(eager, number=number) * 1000,
+            "get_lazy_us": timed(lazy, number=number) * 1000,
+            "post_form_us": timed(post(form_check), number=number) * 1000,
+            "post_token_us": timed(post(token_check), number=number) * 1000,
+        }
+
+    finally:
+        app.config['WTF_CSRF_ENABLED'] = enabled
+
+
+##############################################################################
+# Rate limiting
+
+
+@benchmark
+def ratelimit_overhead(number=1000, clients=1000):
+    """Cost of one rate-limit check per backend, spread over `clients` keys."""
+
+    db.create_all()
+    results = {}
+
+    for name, backend_class in RATELIMIT_BACKENDS.items():
+        backend = backend_class()
+        keys = iter(range(10**9))
+
+        def hit():
+            backend.hit(f"bench:ip:{next(keys) % clients}", 10**6, 1)
+
+        results[f"{name}_us"] = timed(hit, number=number) * 1000
+
+    return results
+
+
+##############################################################################
+# Pages
+
+
+def seed_users(count):
+    """Recreate the tables with `count` users; returns their ids."""
+
+    db.drop_all()
+    db.create_all()
+
+    dbx(db.insert(User), [
+        {
+            "username": f"user{i}",
+            "email": f"user{i}@example.com",
+            "password": "not-a-real-hash",
+        }
+        for i in range(count)
+    ])
+    db.session.commit()
+
+    return dbx(db.select(User.id).order_by(User.id)).scalars().all()
+
+
+@benchmark
+def followers_page(followers=20000):
+    """Time to first byte and total time of a huge followers page."""
+
+    celebrity, *fans = seed_users(followers + 1)
+    dbx(db.insert(Follow), [
+        {"user_being_followed_id": celebrity, "user_following_id": fan}
+        for fan in fans
+    ])
+    db.session.commit()
+
+    results = {"followers": followers}
+
+    for streamed in (False, True):
+        app.config['STREAM_TEMPLATES'] = streamed
+        mode = "streamed" if streamed else "buffered"
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = celebrity
+
+            start = time.perf_counter()
+            resp = client.get(
+                f"/users/{celebrity}/followers", buffered=False)
+            chunks = iter(resp.response)
+            next(chunks)
+            first_byte = time.perf_counter()
+            for _chunk in chunks:
+                pass
+            resp.close()
+            end = time.perf_counter()
+
+        results[f"{mode}_ttfb_ms"] = (first_byte - start) * 1000
+        results[f"{mode}_total_ms"] = (end - start) * 1000
+
+    db.session.remove()
+    return results
+
+
+@benchmark
+def list_rows(users=20000):
+    """Per-row cost of a user list: full User entities vs. UserCards."""
+
+    seed_users(users)
+
+    def entities():
+        q = db.select(User).filter_by(deleted_at=None)
+        rows = dbx(q).scalars().all()
+        db.session.expunge_all()
+        return rows
+
+    def cards():
+        return list(UserCard.from_rows(dbx(select_user_cards())))
+
+    results = {"rows": users}
+
+    for name, load in [("entity", entities), ("card", cards)]:
+        results[f"{name}_us_per_row"] = timed(load) * 1000 / users
+
+        tracemalloc.start()
+        rows = load()
+        results[f"{name}_bytes_per_row"] = (
+            tracemalloc.get_traced_memory()[0] // users)
+        tracemalloc.stop()
+        del rows
+
+    db.session.remove()
+    return results
+
+
+@benchmark
+def username_autocomplete(users=100000, number=1000):
+    """Prefix lookup of usernames: in-memory index vs. a LIKE query."""
+
+    user_ids = seed_users(users)
+    usernames.index.rebuild()
+    prefixes = iter([f"user{i % 1000}" for i in range(10**6)])
+
+    like = (
+        db.select(User.id, User.username)
+        .where(User.username.like(db.bindparam("prefix") + "%"))
+        .order_by(User.username)
+        .limit(usernames.limit)
+    )
+
+    results = {
+        "users": users,
+        "index_us": timed(
+            lambda: usernames.complete(next(prefixes)), number=number) * 1000,
+        "like_query_us": timed(
+            lambda: dbx(like, {"prefix": next(prefixes)}).all(),
+            number=number,
+        ) * 1000,
+    }
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_ids[0]
+
+        results["endpoint_us"] = timed(
+            lambda: client.get(
+                "/users/autocomplete", query_string={"q": next(prefixes)}),
+            number=number,
+        ) * 1000
+
+    db.session.remove()
+    return results
+
+
+##############################################################################
+# Follow graph
+
+
+def synthetic_follows(users, follows, seed=0):
+    """`follows` random follows among `users` users, skewed so that a few
+    accounts have many followers; returns (followers, followed) arrays."""
+
+    rng = random.Random(seed)
+    followers = array("i", (rng.randrange(users) for _ in range(follows)))
+    followed = array(
+        "i", (int(users * rng.random() ** 3) for _ in range(follows)))
+
+    return followers, followed
+
+
+@benchmark
+def follow_suggestions(users=100000, follows=1000000, sample=1000):
+    """Who-to-follow over a synthetic graph with a million follows.
+
+    Builds the CSR graph, compares its size with a dict of sets, and times
+    suggestions for a sample of users to project a full refresh.
+    """
+
+    followers, followed = synthetic_follows(users, follows)
+
+    start = time.perf_counter()
+    graph = FollowGraph(range(users), followers, followed)
+    build_s = time.perf_counter() - start
+
+    tracemalloc.start()
+    as_sets = {}
+    for follower, followee in zip(followers, followed):
+        as_sets.setdefault(follower, set()).add(followee)
+    sets_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del as_sets
+
+    boosts = {user_id: 0.5 for user_id in range(0, users, 10)}
+    nodes = iter(random.Random(1).sample(range(users), sample * 5))
+    per_user_ms = timed(
+        lambda: suggest(graph, next(nodes), boosts), number=sample)
+
+    return {
+        "users": users,
+        "follows": graph.num_follows,
+        "build_s": build_s,
+        "csr_mb": graph.nbytes / 2**20,
+        "dict_of_sets_mb": sets_bytes / 2**20,
+        "suggest_us_per_user": per_user_ms * 1000,
+        "full_refresh_compute_s": per_user_ms * users / 1000,
+    }
+
+
+@benchmark
+def graph_cache(users=10000, follows=200000, number=10000):
+    """"Does A follow B?" from the graph cache vs. an EXISTS query."""
+
+    user_ids = seed_users(users)
+    followers, followed = synthetic_follows(users, follows)
+    dbx(db.insert(Follow), [
+        {
+            "user_following_id": user_ids[follower],
+            "user_being_followed_id": user_ids[followee],
+        }
+        for follower, followee in {*zip(followers, followed)}
+        if follower != followee
+    ])
+    db.session.commit()
+
+    # Page views skew toward a few busy users, as follows do
+    rng = random.Random(2)
+    pairs = iter([
+        (user_ids[int(users * rng.random() ** 3)], rng.choice(user_ids))
+        for _ in range(number * 10)
+    ])
+
+    cache = GraphCache(User.load_follow_ids)
+    User.graph_cache = cache
+    try:
+        cached_ms = timed(
+            lambda: _is_following(*next(pairs)), number=number)
+    finally:
+        User.graph_cache = None
+
+    query_ms = timed(lambda: _is_following(*next(pairs)), number=number)
+    stats = cache.stats()
+
+    db.session.remove()
+    return {
+        "users": users,
+        "cached_us": cached_ms * 1000,
+        "exists_query_us": query_ms * 1000,
+        "cache_entries": stats["entries"],
+        "cache_kb": stats["bytes"] / 1024,
+        "hit_rate": stats["hit_rate"],
+    }
+
+
+##############################################################################
+# Serving modes
+
+
+@benchmark
+def serving_modes(
+        users=1000, follows=20000, requests=400, concurrency=50,
+        db_latencies_ms=(0, 100)):
+    """Home feed throughput with `concurrency` requests in flight.
+
+    Sync mode is the Flask app on 4 threads, standing in for 4 sync workers;
+    async mode is a single asgi.py event loop. Each is also run with a
+    pg_sleep per request, standing in for a slow database.
+    """
+
+    user_ids = seed_users(users)
+    followers, followed = synthetic_follows(users, follows)
+    dbx(db.insert(Follow), [
+        {
+            "user_following_id": user_ids[follower],
+            "user_being_followed_id": user_ids[followee],
+        }
+        for follower, followee in {*zip(followers, followed)}
+        if follower != followee
+    ])
+    dbx(db.insert(Message), [
+        {"text": f"Message {i}", "user_id": user_ids[i % users]}
+        for i in range(users * 10)
+    ])
+    db.session.commit()
+
+    if db.engine.dialect.name == "postgresql":
+        dbx(db.text("ANALYZE"))
+        db.session.commit()
+
+    sids = []
+    interface = app.session_interface
+    for user_id in user_ids[:concurrency]:
+        sid = secrets.token_urlsafe(18)
+        interface.store.save(
+            sid,
+            interface.serializer.dumps(
+                {CURR_USER_KEY: user_id, "csrf_token": secrets.token_hex()}),
+            datetime.now() + timedelta(hours=1),
+        )
+        sids.append(sid)
+
+    cookie = interface.get_cookie_name(app)
+    streamed = app.config['STREAM_TEMPLATES']
+    app.config['STREAM_TEMPLATES'] = False
+    sleep = db.text("SELECT pg_sleep(:seconds)")
+
+    def run_sync(latency):
+        def slow_database():
+            dbx(sleep, {"seconds": latency})
+
+        def get(sid):
+            with app.test_client() as client:
+                client.set_cookie(cookie, sid)
+                assert client.get("/").status_code == 200
+
+        app.before_request_funcs[None].insert(0, slow_database)
+        try:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(
+                    get, (sids[i % concurrency] for i in range(requests))))
+        finally:
+            app.before_request_funcs[None].remove(slow_database)
+
+    async def run_async(latency):
+        async def slow_home(db_session, viewer):
+            await db_session.execute(sleep, {"seconds": latency})
+            return await asgi.home(db_session, viewer)
+
+        async def get(sid):
+            scope = {
+                "type": "http",
+                "method": "GET",
+                "path": "/",
+                "query_string": b"",
+                "headers": [(b"cookie", f"{cookie}={sid}".encode())],
+            }
+            sent = []
+
+            async def receive():
+                return {"type": "http.request", "body": b""}
+
+            async def send(message):
+                sent.append(message)
+
+            await asgi.application(scope, receive, send)
+            assert sent[0]["status"] == 200
+
+        async def worker(n):
+            for i in range(n, requests, concurrency):
+                await get(sids[i % concurrency])
+
+        pattern, home = asgi.PAGES[0]
+        asgi.PAGES[0] = (pattern, slow_home)
+        try:
+            await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        finally:
+            asgi.PAGES[0] = (pattern, home)
+            await asgi.engine.dispose()
+
+    results = {"requests": requests, "concurrency": concurrency}
+
+    for latency_ms in db_latencies_ms:
+        latency = latency_ms / 1000
+
+        start = time.perf_counter()
+        run_sync(latency)
+        results[f"sync_{latency_ms}ms_db_req_per_s"] = (
+            requests / (time.perf_counter() - start))
+
+        start = time.perf_counter()
+        asyncio.run(run_async(latency))
+        results[f"async_{latency_ms}ms_db_req_per_s"] = (
+            requests / (time.perf_counter() - start))
+
+    app.config['STREAM_TEMPLATES'] = streamed
+    db.session.remove()
+
+    return results
+
+
+##############################################################################
+# Image proxy
+
+
+@benchmark
+def thumbnails(width=2400, height=1600, number=200):
+    """A card's avatar: the original photo vs. the proxy's resized copy.
+
+    The origin is a local server, so fetch times leave out the network.
+    """
+
+    out = BytesIO()
+    noise = Image.effect_noise((width, height), 64).convert("RGB")
+    noise.save(out, "JPEG", quality=90)
+    photo = out.getvalue()
+
+    class Origin(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(photo)))
+            self.end_headers()
+            self.wfile.write(photo)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/photo.jpg"
+
+    fetcher, cache = image_proxy.fetcher, image_proxy.cache
+    cache_dir = tempfile.TemporaryDirectory()
+    image_proxy.fetcher = HTTPFetcher(allow_private=True)
+    image_proxy.cache = ThumbnailCache(cache_dir.name, 2**30)
+
+    with app.test_request_context():
+        proxy_url = image_proxy.thumbnail_url(url, "avatar")
+
+    client = app.test_client()
+
+    def get(url):
+        resp = client.get(url)
+        data = resp.data
+        resp.close()
+        return data
+
+    try:
+        start = time.perf_counter()
+        thumbnail = get(proxy_url)
+        first_ms = (time.perf_counter() - start) * 1000
+
+        return {
+            "origin_bytes": len(photo),
+            "thumbnail_bytes": len(thumbnail),
+            "fetch_origin_ms": timed(lambda: image_proxy.fetcher(url)),
+            "first_thumbnail_ms": first_ms,
+            "cached_thumbnail_ms": timed(
+                lambda: get(proxy_url), number=number),
+        }
+
+    finally:
+        image_proxy.fetcher, image_proxy.cache = fetcher, cache
+        cache_dir.cleanup()
+        server.shutdown()
+        server.server_close()
+
+
+##############################################################################
+# Live timeline
+
+
+@benchmark
+def timeline_streams(streams=10000):
+    """Idle timeline streams in one worker, and a new message's fan-out.
+
+    Every stream follows the same author; a new message is sent to all.
+    """
+
+    async def run():
+        delivered = 0
+        all_delivered = asyncio.Event()
+        disconnect = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal delivered
+
+            if message["body"].startswith(b"id:"):
+                delivered += 1
+
+                if delivered == streams:
+                    all_delivered.set()
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        subscriptions = [
+            live_timeline.subscribe([1]) for _ in range(streams)]
+        tasks = [
+            asyncio.ensure_future(
+                asgi.send_events(subscription, [], 0, receive, send))
+            for subscription in subscriptions
+        ]
+        await asyncio.sleep(0.1)
+
+        per_stream = (tracemalloc.get_traced_memory()[0] - before) / streams
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        live_timeline.hub.dispatch(1, 1, '{"text": "hello"}')
+        await all_delivered.wait()
+        fan_out_ms = (time.perf_counter() - start) * 1000
+
+        disconnect.set()
+        await asyncio.gather(*tasks)
+
+        for subscription in subscriptions:
+            live_timeline.unsubscribe(subscription)
+
+        return per_stream, fan_out_ms
+
+    per_stream, fan_out_ms = asyncio.run(run())
+
+    return {
+        "streams": streams,
+        "bytes_per_idle_stream": per_stream,
+        "fan_out_ms": fan_out_ms,
+    }
+
+
+##############################################################################
+# Batch loading
+
+
+@benchmark
+def entity_loaders(messages=100):
+    """Trending page of messages by different authors: queries and time,
+    with and without the entity loaders batching authors."""
+
+    viewer, *authors = seed_users(messages + 1)
+    dbx(db.insert(Message), [
+        {"text": f"Message {i}", "user_id": author}
+        for i, author in enumerate(authors)
+    ])
+    message_ids = dbx(db.select(Message.id)).scalars().all()
+    for message_id in message_ids:
+        db.session.add(Like(user_id=viewer, message_id=message_id))
+    db.session.commit()
+    TrendingMessage.refresh(lag=timedelta(0))
+    db.session.commit()
+
+    queries = 0
+
+    def count(*args):
+        nonlocal queries
+        queries += 1
+
+    def get_trending():
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer
+
+            client.get("/messages/trending").close()
+            db.session.remove()
+
+    results = {"messages": messages}
+    db.event.listen(db.engine, "before_cursor_execute", count)
+
+    for batched in (True, False):
+        mode = "batched" if batched else "unbatched"
+
+        if not batched:
+            db.event.remove(Session, "do_orm_execute", _load_expected_first)
+
+        queries = 0
+        get_trending()
+        results[f"{mode}_queries"] = queries
+        results[f"{mode}_ms"] = timed(get_trending)
+
+    db.event.listen(Session, "do_orm_execute", _load_expected_first)
+    db.event.remove(db.engine, "before_cursor_execute", count)
+
+    return results
+
+
+##############################################################################
+# Availability
+
+
+@benchmark
+def duplicate_signups(users=100000):
+    """Rejecting a taken username: by the failed INSERT after hashing, as
+    signup used to, or by the availability check first; and checking a free
+    one with and without the Bloom filter."""
+
+    seed_users(users)
+    taken = availability.taken
+    build_ms = timed(taken.rebuild, repeat=1)
+
+    def insert_duplicate():
+        try:
+            User.signup("user1", "new@example.com", "password")
+            db.session.flush()
+        except IntegrityError:
+            pass
+        db.session.rollback()
+
+    def check_free():
+        availability.unavailable(username="nobody", email="new@example.com")
+
+    def check_free_without_filter():
+        availability.taken = None
+        try:
+            check_free()
+        finally:
+            availability.taken = taken
+
+    return {
+        "users": users,
+        "filter_kb": len(taken._filter.bits) // 1024,
+        "build_ms": build_ms,
+        "insert_duplicate_ms": timed(insert_duplicate),
+        "check_taken_ms": timed(
+            lambda: availability.unavailable(username="user1"), number=100),
+        "check_free_ms": timed(check_free, number=100),
+        "check_free_unfiltered_ms": timed(
+            check_free_without_filter, number=100),
+    }
+
+
+##############################################################################
+# Archived messages
+
+
+@benchmark
+def archived_messages(messages=1_000_000, users=1000, partition_size=50_000):
+    """Home feed and profile queries over two years of messages, half of
+    them archived: reading only recent partitions, and reading them all.
+    PostgreSQL only."""
+
+    if db.engine.dialect.name != "postgresql":
+        return {"skipped": "needs PostgreSQL"}
+
+    with patch("models.MESSAGE_PARTITION_SIZE", partition_size):
+        user_ids = seed_users(users)
+
+    # Oldest first, as they'd have been posted
+    insert = db.text(
+        "INSERT INTO messages (text, user_id, timestamp)"
+        " SELECT 'Message ' || i, :first_user + i % :users,"
+        " now() - interval '730 days' + i * :step * interval '1 second'"
+        " FROM generate_series(:start, :stop - 1) AS i"
+    )
+    step = 730 * 24 * 60 * 60 / messages
+
+    for start in range(0, messages, partition_size):
+        add_partitions(partition_size)
+        dbx(insert, {
+            "first_user": user_ids[0],
+            "users": users,
+            "step": step,
+            "start": start,
+            "stop": min(start + partition_size, messages),
+        })
+        db.session.commit()
+
+    dbx(db.text("ANALYZE"))
+    db.session.commit()
+
+    archive = archive_messages(timedelta(days=365), size=partition_size)
+    viewer, followed = user_ids[0], user_ids[1:51]
+
+    def feed(recent):
+        q = (
+            select_message_cards(viewer)
+            .where(Message.user_id.in_([viewer, *followed]))
+            .where(Message.recent() if recent else db.true())
+            .limit(100)
+        )
+        dbx(q).all()
+
+    def profile(recent):
+        q = (
+            select_message_cards(viewer)
+            .where(Message.user_id == followed[0])
+            .where(Message.recent() if recent else db.true())
+        )
+        dbx(q).all()
+
+    return {
+        "messages": messages,
+        "partitions": len(message_partitions()),
+        "archived": archive.before_id - 1,
+        "feed_recent_ms": timed(lambda: feed(True), number=10),
+        "feed_all_ms": timed(lambda: feed(False), number=10),
+        "profile_recent_ms": timed(lambda: profile(True), number=10),
+        "profile_all_ms": timed(lambda: profile(False), number=10),
+    }
+
+
+##############################################################################
+# Notifications
+
+
+@benchmark
+def notification_inbox(likers=2000, messages=50, likes_each=10):
+    """A popular user's notifications page: grouping their like events when
+    it's read, against reading the inbox the collapser precomputed."""
+
+    owner, *fans = seed_users(likers + 1)
+    dbx(db.insert(Message), [
+        {"text": f"Message {i}", "user_id": owner} for i in range(messages)
+    ])
+    message_ids = dbx(db.select(Message.id)).scalars().all()
+
+    rng = random.Random(0)
+    likes = [
+        {"user_id": fan, "message_id": message_id}
+        for fan in fans
+        for message_id in rng.sample(message_ids, likes_each)
+    ]
+    dbx(db.insert(Like), likes)
+    dbx(db.insert(NotificationEvent), [
+        {
+            "user_id": owner,
+            "kind": "like",
+            "actor_id": like["user_id"],
+            "message_id": like["message_id"],
+        }
+        for like in likes
+    ])
+    db.session.commit()
+
+    grouped = (
+        db.select(
+            NotificationEvent.kind,
+            NotificationEvent.message_id,
+            db.func.count(NotificationEvent.actor_id.distinct()),
+            db.func.max(NotificationEvent.created_at).label("latest"),
+        )
+        .where(NotificationEvent.user_id == owner)
+        .group_by(NotificationEvent.kind, NotificationEvent.message_id)
+        .order_by(db.text("latest DESC"))
+        .limit(NOTIFICATIONS_PER_PAGE)
+    )
+    unread = db.select(db.func.count()).select_from(grouped.subquery())
+
+    grouped_ms = timed(lambda: dbx(grouped).all())
+    count_ms = timed(lambda: dbx(unread).scalar())
+
+    start = time.perf_counter()
+    collapse_notifications()
+    collapse_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "events": len(likes),
+        "notifications": dbx(
+            db.select(db.func.count(Notification.id))).scalar(),
+        "collapse_ms": collapse_ms,
+        "grouped_page_ms": grouped_ms,
+        "inbox_page_ms": timed(lambda: dbx(select_inbox(owner)).all()),
+        "unread_count_query_ms": count_ms,
+    }
+
+
+##############################################################################
+# Microcache
+
+
+@benchmark
+def anonymous_pages(number=200, burst=20):
+    """Anonymous visitors' home and login pages, each from a new visitor,
+    rendered every time and from the microcache; and how many renders a
+    burst of visitors to an expired page costs."""
+
+    seed_users(1)
+    csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+    app.config['WTF_CSRF_ENABLED'] = True
+
+    def visit(path):
+        # Flask-WTF keeps each visitor's token in g, so each gets its own
+        # app context
+        with app.app_context(), app.test_client() as client:
+            client.get(path).close()
+
+    endpoints = microcache.endpoints
+    login = app.view_functions["login"]
+    results = {}
+
+    try:
+        for name, path in (("home", "/"), ("login", "/login")):
+            microcache.endpoints = frozenset()
+            results[f"{name}_rendered_ms"] = timed(
+                lambda: visit(path), number=number)
+
+            microcache.endpoints = endpoints
+            microcache.store = MemoryPageStore()
+            results[f"{name}_cached_ms"] = timed(
+                lambda: visit(path), number=number)
+
+        renders = []
+
+        def counted_login():
+            renders.append(1)
+            return login()
+
+        microcache.store = MemoryPageStore()
+        app.view_functions["login"] = counted_login
+
+        with ThreadPoolExecutor(burst) as pool:
+            list(pool.map(visit, ["/login"] * burst))
+
+        results["burst_visitors"] = burst
+        results["burst_renders"] = len(renders)
+
+    finally:
+        app.view_functions["login"] = login
+        app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+        microcache.endpoints = endpoints
+
+    return results
+
+
+##############################################################################
+# Query cache
+
+
+@benchmark
+def query_cache_reads(users=1000, number=200, write_every=20):
+    """The users list and a profile's details, from the database and from
+    the query cache; and the hit rate of profile views when every
+    `write_every`th request follows someone."""
+
+    user_ids = seed_users(users)
+    users_list = select_user_cards().order_by(User.id.desc())
+    enabled = query_cache.enabled
+    results = {}
+
+    try:
+        for name, q in (
+            ("users_list", users_list),
+            ("profile", select_user_detail(user_ids[0])),
+        ):
+            query_cache.enabled = False
+            results[f"{name}_db_ms"] = timed(
+                lambda: query_cache.all(q), number=number)
+
+            query_cache.enabled = True
+            query_cache.clear()
+            results[f"{name}_cached_ms"] = timed(
+                lambda: query_cache.all(q), number=number)
+
+        query_cache.clear()
+        query_cache.hits = query_cache.misses = query_cache.bypasses = 0
+        follower = db.session.get(User, user_ids[-1])
+
+        for i in range(number * 5):
+            if i % write_every == 0:
+                follower.follow(user_ids[i % (users - 1)])
+                db.session.commit()
+
+            query_cache.one_or_none(
+                select_user_detail(user_ids[i % 10]))
+
+        results["mixed_hit_rate"] = round(query_cache.stats()["hit_rate"], 3)
+
+    finally:
+        query_cache.enabled = enabled
+        query_cache.clear()
+
+    return results
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        results = BENCHMARKS[name]()
+        stats = ", ".join(
+            f"{key}={value:.3f}" if isinstance(value, float)
+            else f"{key}={value}"
+            for key, value in results.items()
+        )
+        print(f"{name}: {stats}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main(sys.argv[1:])
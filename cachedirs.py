@@ -0,0 +1,41 @@
+"""Directories for the app's on-disk caches.
+
+The app trusts what it finds in its caches: Jinja runs the bytecode in its
+cache, and the image proxy serves whatever files are in its. So a cache
+directory must be the app's own. Defaults under the shared temp directory
+are named per user, and any directory is made with mode 0700 if it's missing
+and refused if it's owned by someone else or others can write to it.
+"""
+
+import os
+import stat
+import tempfile
+
+
+class UnsafeCacheDir(Exception):
+    """A cache directory others could write files into."""
+
+
+def default_cache_dir(name):
+    """Path of this user's `name` cache under the temp directory."""
+
+    return os.path.join(tempfile.gettempdir(), f"{name}-{os.getuid()}")
+
+
+def private_cache_dir(path):
+    """Make directory `path` if it's missing, and check that only this user
+    can write to it; returns `path`."""
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    # lstat, so a symlink to somewhere else doesn't pass for the directory
+    st = os.lstat(path)
+
+    if (not stat.S_ISDIR(st.st_mode)
+            or st.st_uid != os.getuid()
+            or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise UnsafeCacheDir(
+            f"{path} must be a directory owned by this user that nobody else"
+            " can write to")
+
+    return path
@@ -0,0 +1,364 @@
+"""Traffic capture and replay, to test changes against the real workload.
+
+With TRAFFIC_CAPTURE_DIR set, each worker appends a line of JSON per request
+to its own log in that directory: when it started, the endpoint, path, user
+id, parameters, status and how long the response took to send. Nothing else
+about the client is kept -- no IP address, headers or cookies -- and any
+parameter that isn't a number is replaced by a keyed hash of the same
+length, so repeated searches still repeat but their text isn't stored.
+Passwords and CSRF tokens are dropped, and logins, signups and profile edits
+aren't recorded at all. TRAFFIC_CAPTURE_MAX_BYTES caps the directory as a
+whole: a worker's log is rotated once it reaches an eighth of that, and
+whenever a worker opens a log it first deletes the oldest logs in the
+directory (whichever worker wrote them) to make room for it.
+
+`flask replay-traffic DIR` sends the captured requests again, in order, at
+their original pace or faster, to this app in-process or to a local server
+(which must share its session store, i.e. the 'database' backend); each
+recorded user gets a logged-in session. Point it at a copy of the database
+the log was captured from, since requests name users and messages by id,
+and it reports how the latency of each endpoint changed.
+"""
+
+import glob
+import json
+import os
+import secrets
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from datetime import datetime, timedelta
+from hashlib import blake2b
+
+from flask import g, request, session
+from flask_wtf.csrf import generate_csrf
+from werkzeug.datastructures import MultiDict
+
+# Not worth replaying, or can't be: they need passwords, or never end
+EXCLUDED_ENDPOINTS = frozenset({
+    'static',
+    'proxied_image',
+    'signup',
+    'login',
+    'logout',
+    'edit_profile',
+    'delete_user',
+    'timeline_events',
+})
+
+DROPPED_PARAMS = frozenset({'password', 'csrf_token'})
+
+# How many logs TRAFFIC_CAPTURE_MAX_BYTES is split between
+CAPTURE_LOGS = 8
+
+
+class TrafficCapture:
+    """Appends a record of each request to a per-worker log."""
+
+    def __init__(self, app=None):
+        self.directory = None
+        self._file = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRAFFIC_CAPTURE_DIR', None)
+        app.config.setdefault('TRAFFIC_CAPTURE_MAX_BYTES', 64 * 2**20)
+
+        self.directory = app.config['TRAFFIC_CAPTURE_DIR']
+        self.max_bytes = app.config['TRAFFIC_CAPTURE_MAX_BYTES']
+        self._key = blake2b(
+            app.config['SECRET_KEY'].encode(),
+            person=b"capture",
+        ).digest()
+
+        app.before_request(self._start)
+        app.after_request(self._record)
+
+    def pseudonym(self, value):
+        """`value` if it's a number, otherwise a keyed hash of its length."""
+
+        if value.isdigit():
+            return value
+
+        digest = blake2b(value.encode(), key=self._key).hexdigest()
+        return (digest * (len(value) // len(digest) + 1))[:len(value)]
+
+    def _start(self):
+        if self.directory is not None:
+            g.capture_start = (time.time(), time.perf_counter())
+
+    def _record(self, response):
+        if (self.directory is None
+                or "capture_start" not in g
+                or request.endpoint in EXCLUDED_ENDPOINTS
+                or request.endpoint is None):
+            return response
+
+        started_at, start = g.capture_start
+        user = g.get("user")
+        entry = {
+            "t": round(started_at, 3),
+            "method": request.method,
+            "endpoint": request.endpoint,
+            "path": request.path,
+            "user": user.id if user else None,
+            "args": self._params(request.args),
+            "form": self._params(request.form),
+            "status": response.status_code,
+        }
+
+        # Timed once the body's been sent, which for streamed pages is when
+        # most of the work happens
+        def write():
+            entry["ms"] = round((time.perf_counter() - start) * 1000, 2)
+            self.write(entry)
+
+        response.call_on_close(write)
+
+        return response
+
+    def _params(self, params):
+        return [
+            [name, self.pseudonym(value)]
+            for name, value in params.items(multi=True)
+            if name not in DROPPED_PARAMS
+        ]
+
+    def write(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        log_bytes = self.max_bytes // CAPTURE_LOGS
+
+        with self._lock:
+            if self._file is not None:
+                if os.fstat(self._file.fileno()).st_nlink == 0:
+                    # Deleted by another worker to make room
+                    self._file.close()
+                    self._file = None
+
+                elif self._file.tell() + len(line) > log_bytes:
+                    self._file.close()
+                    self._file = None
+
+                    with suppress(FileNotFoundError):
+                        os.replace(
+                            self._path, f"{self._path}.{time.time_ns()}")
+
+            if self._file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._path = os.path.join(
+                    self.directory, f"traffic-{os.getpid()}.log")
+                self._prune(self.max_bytes - log_bytes)
+                self._file = open(self._path, "a")
+
+            self._file.write(line)
+            self._file.flush()
+
+    def _prune(self, max_bytes):
+        """Delete the least recently written logs in the directory until
+        they add up to at most `max_bytes`."""
+
+        logs = []
+
+        for path in glob.glob(os.path.join(self.directory, "traffic-*.log*")):
+            with suppress(FileNotFoundError):
+                stat = os.stat(path)
+                logs.append((stat.st_mtime_ns, path, stat.st_size))
+
+        total = sum(size for _mtime, _path, size in logs)
+
+        for _mtime, path, size in sorted(logs):
+            if total <= max_bytes:
+                break
+
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+            total -= size
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(directory):
+    """Every worker's captured requests in `directory`, oldest first."""
+
+    entries = []
+
+    for path in glob.glob(os.path.join(directory, "traffic-*.log*")):
+        with open(path) as f:
+            entries.extend(json.loads(line) for line in f if line.strip())
+
+    entries.sort(key=lambda entry: entry["t"])
+
+    return entries
+
+
+def login_sessions(app, user_ids, user_key):
+    """Make a session for each user, logged in under `user_key`; returns
+    {user id: (session id, CSRF token)}."""
+
+    interface = app.session_interface
+    expires_at = datetime.now() + timedelta(days=1)
+    sessions = {}
+
+    for user_id in user_ids:
+        # A fresh app context too: Flask-WTF keeps the token it made in g
+        with app.app_context(), app.test_request_context():
+            csrf_token = generate_csrf()
+            data = {**session, user_key: user_id}
+
+        sid = secrets.token_urlsafe(18)
+        interface.store.save(
+            sid, interface.serializer.dumps(data), expires_at)
+        sessions[user_id] = (sid, csrf_token)
+
+    return sessions
+
+
+def client_sender(app):
+    """Send a request to `app` in-process; returns the response status."""
+
+    def send(method, path, query, form, cookie):
+        with app.test_client() as client:
+            if cookie:
+                name, _, value = cookie.partition("=")
+                client.set_cookie(name, value)
+
+            response = client.open(
+                path,
+                method=method,
+                query_string=MultiDict(query),
+                data=MultiDict(form),
+            )
+            response.get_data()
+            response.close()
+
+            return response.status_code
+
+    return send
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+def http_sender(base_url, timeout=30):
+    """Send a request to the server at `base_url`; returns its status."""
+
+    opener = urllib.request.build_opener(_NoRedirect)
+
+    def send(method, path, query, form, cookie):
+        url = base_url.rstrip("/") + path
+        if query:
+            url += "?" + urllib.parse.urlencode([tuple(p) for p in query])
+
+        req = urllib.request.Request(
+            url,
+            method=method,
+            data=(
+                urllib.parse.urlencode([tuple(p) for p in form]).encode()
+                if form else None
+            ),
+            headers={"Cookie": cookie} if cookie else {},
+        )
+
+        try:
+            with opener.open(req, timeout=timeout) as response:
+                response.read()
+                return response.status
+
+        except urllib.error.HTTPError as err:
+            err.read()
+            return err.code
+
+    return send
+
+
+def replay(entries, send, sessions, cookie_name="session", speed=1.0,
+           concurrency=8):
+    """Send captured requests again, as they were first sent.
+
+    Requests start in their original order, `speed` times as fast as they
+    came in (or with no waits, if 0), with up to `concurrency` at once.
+    Returns (status, ms) for each entry.
+    """
+
+    def run(entry):
+        form = entry["form"]
+        cookie = None
+
+        if entry["user"] is not None:
+            sid, csrf_token = sessions[entry["user"]]
+            cookie = f"{cookie_name}={sid}"
+
+            if entry["method"] != "GET":
+                form = [*form, ["csrf_token", csrf_token]]
+
+        start = time.perf_counter()
+        status = send(
+            entry["method"], entry["path"], entry["args"], form, cookie)
+
+        return status, round((time.perf_counter() - start) * 1000, 2)
+
+    if not entries:
+        return []
+
+    first = entries[0]["t"]
+    started = time.perf_counter()
+    futures = []
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for entry in entries:
+            if speed:
+                wait = (entry["t"] - first) / speed - (
+                    time.perf_counter() - started)
+                if wait > 0:
+                    time.sleep(wait)
+
+            futures.append(pool.submit(run, entry))
+
+    return [future.result() for future in futures]
+
+
+def compare_latency(entries, results):
+    """Per endpoint: (count, recorded and replayed median and 95th
+    percentile ms, replayed responses whose status differed)."""
+
+    by_endpoint = {}
+
+    for entry, (status, ms) in zip(entries, results):
+        recorded, replayed, changed = by_endpoint.setdefault(
+            entry["endpoint"], ([], [], [0]))
+        recorded.append(entry["ms"])
+        replayed.append(ms)
+        changed[0] += status != entry["status"]
+
+    return {
+        endpoint: (
+            len(recorded),
+            _percentile(recorded, 50), _percentile(recorded, 95),
+            _percentile(replayed, 50), _percentile(replayed, 95),
+            changed[0],
+        )
+        for endpoint, (recorded, replayed, changed) in sorted(
+            by_endpoint.items())
+    }
+
+
+def _percentile(values, percent):
+    if len(values) == 1:
+        return values[0]
+
+    return statistics.quantiles(values, n=100)[percent - 1]
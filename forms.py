@@ -47,10 +47,6 @@ class LoginForm(FlaskForm):
     )
 
 
-class CSRFForm(FlaskForm):
-    """CSRF form used to log out"""
-
-
 class EditProfile(FlaskForm):
     """Form for editing a profile"""
 
@@ -0,0 +1,398 @@
+"""Local copies of users' avatar and header images, resized to fit.
+
+Profile images are links to other sites, and pages used to show them as is:
+every card on a list page pulled a full-size photo (often megabytes) from
+someone else's server to show it at 70px. Instead, templates link images
+through the `thumbnail` filter:
+
+    <img src="{{ user.image_url|thumbnail('avatar') }}">
+
+which points at /images/avatar?src=<signed url>. The first time any size of
+an image is asked for, the proxy fetches the original once, makes every size
+in IMAGE_SIZES from it, and keeps them in a bounded on-disk cache keyed by a
+hash of the url (least recently used files go first when it's full). They
+are served from there with headers that let browsers cache them for good; a
+changed profile image has a different url, so a different proxy link.
+
+Links are signed, so the proxy only fetches urls the app itself linked to,
+and the default fetcher won't fetch from private or local addresses (it
+checks the address it actually connected to, so a name that resolves to a
+public address once and a private one the next time gets nowhere). Images
+it can't fetch or read redirect to the original url.
+"""
+
+import hashlib
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+from io import BytesIO
+from urllib.parse import urlsplit
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.request import (
+    HTTPHandler, HTTPRedirectHandler, HTTPSHandler, ProxyHandler, Request,
+    build_opener,
+)
+
+from flask import url_for
+from itsdangerous import Signer
+from PIL import Image, ImageOps
+
+from cachedirs import default_cache_dir, private_cache_dir
+
+# Size name: (width, height) of the cropped copy. Twice the size they're
+# shown at (see style.css), for high-density screens.
+IMAGE_SIZES = {
+    # .card-image (70px), .timeline-image (48px) and the navbar (32px)
+    "avatar": (144, 144),
+    # #profile-avatar (200px)
+    "profile": (400, 400),
+    # .card-hero: a card's width, 36% as tall
+    "hero": (720, 260),
+}
+
+JPEG_QUALITY = 85
+
+REMOTE_SCHEMES = ("http://", "https://")
+
+
+class ImageFetchError(Exception):
+    """An origin image couldn't be fetched."""
+
+
+class _CheckedRedirectHandler(HTTPRedirectHandler):
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        self.fetcher.check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def _connect_global(address, *args, **kwargs):
+    """socket.create_connection, refusing to talk to a non-global address.
+
+    The check is on the connected socket's peer, not on an earlier lookup of
+    the name, so DNS can't answer differently in between.
+    """
+
+    sock = socket.create_connection(address, *args, **kwargs)
+    peer = ipaddress.ip_address(sock.getpeername()[0].split("%")[0])
+    peer = getattr(peer, "ipv4_mapped", None) or peer
+
+    if not peer.is_global:
+        sock.close()
+        raise ImageFetchError(f"Private address: {address[0]} ({peer})")
+
+    return sock
+
+
+class _GlobalHTTPConnection(HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_global
+
+
+class _GlobalHTTPSConnection(HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_global
+
+
+class _GlobalHTTPHandler(HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_GlobalHTTPConnection, req)
+
+
+class _GlobalHTTPSHandler(HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_GlobalHTTPSConnection, req,
+                            context=self._context)
+
+
+class HTTPFetcher:
+    """Fetches origin images over http(s).
+
+    Refuses to connect to private, loopback and link-local addresses
+    (redirects included) unless `allow_private`, so that links to them can't
+    be used to reach internal services. Proxies from the environment aren't
+    used: the address checked has to be the origin's.
+    """
+
+    def __init__(self, timeout=5, max_bytes=10 * 2**20, allow_private=False):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.allow_private = allow_private
+
+        handlers = [_CheckedRedirectHandler(self)]
+
+        if not allow_private:
+            handlers += [
+                ProxyHandler({}), _GlobalHTTPHandler(), _GlobalHTTPSHandler()]
+
+        self._opener = build_opener(*handlers)
+
+    def check_url(self, url):
+        """Raise ImageFetchError if `url` mustn't be fetched.
+
+        Addresses are checked as they're connected to (see _connect_global).
+        """
+
+        parts = urlsplit(url)
+
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ImageFetchError(f"Not an http(s) url: {url}")
+
+    def __call__(self, url):
+        """The body of `url`."""
+
+        self.check_url(url)
+        request = Request(url, headers={"User-Agent": "warbler-images"})
+
+        try:
+            with self._opener.open(request, timeout=self.timeout) as response:
+                data = response.read(self.max_bytes + 1)
+
+        except OSError as e:
+            raise ImageFetchError(f"Can't fetch {url}: {e}") from e
+
+        if len(data) > self.max_bytes:
+            raise ImageFetchError(f"Larger than {self.max_bytes}B: {url}")
+
+        return data
+
+
+IMAGE_FETCHERS = {
+    "http": HTTPFetcher,
+}
+
+
+def make_thumbnails(data, sizes):
+    """{size name: JPEG bytes} of image `data` cropped to each of `sizes`.
+
+    Raises OSError (or a subclass) if `data` isn't an image Pillow reads.
+    """
+
+    with Image.open(BytesIO(data)) as image:
+        # JPEGs can decode straight to a fraction of their size
+        largest = max(max(size) for size in sizes.values())
+        image.draft("RGB", (largest, largest))
+
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        else:
+            image = image.convert("RGB")
+
+        thumbnails = {}
+
+        for name, size in sizes.items():
+            out = BytesIO()
+            thumbnail = ImageOps.fit(image, size, Image.Resampling.LANCZOS)
+            thumbnail.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True)
+            thumbnails[name] = out.getvalue()
+
+        return thumbnails
+
+
+class ThumbnailCache:
+    """Resized images in a directory, at most `max_bytes` of them.
+
+    A hit bumps the file's modification time, and when the cache is full the
+    files modified longest ago are deleted. Several workers can share the
+    directory: files are written by rename, so none is seen half-written.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+        private_cache_dir(directory)
+
+    def path(self, key, size):
+        return os.path.join(self.directory, key[:2], f"{key}-{size}.jpg")
+
+    def get(self, key, size):
+        """Path of the cached file, or None."""
+
+        path = self.path(key, size)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def put(self, key, thumbnails):
+        """Cache {size name: bytes} of the image `key`."""
+
+        written = 0
+
+        for size, data in thumbnails.items():
+            path = self.path(key, size)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            written += len(data)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += written
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _files(self):
+        """(path, size, mtime) of every cached file."""
+
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+
+            for file in os.scandir(entry.path):
+                if not file.name.endswith(".jpg"):
+                    continue
+
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+
+                yield file.path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        """Delete the least recently used files, down to 90% of max_bytes."""
+
+        # Other workers write here too, so recount rather than trust _size
+        files = sorted(self._files(), key=lambda file: file[2])
+        self._size = sum(size for _, size, _ in files)
+
+        for path, size, _ in files:
+            if self._size <= self.max_bytes * 0.9:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self._size -= size
+
+
+class ImageProxy:
+    """Fetches, resizes and caches images that templates link through it."""
+
+    def __init__(self, app=None):
+        self.cache = None
+        self.fetcher = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IMAGE_PROXY_ENABLED', True)
+        app.config.setdefault('IMAGE_FETCHER', 'http')
+        app.config.setdefault('IMAGE_FETCH_TIMEOUT', 5)
+        app.config.setdefault('IMAGE_MAX_ORIGIN_BYTES', 10 * 2**20)
+        app.config.setdefault(
+            'IMAGE_CACHE_DIR', default_cache_dir('warbler-images'))
+        app.config.setdefault('IMAGE_CACHE_MAX_BYTES', 512 * 2**20)
+        app.config.setdefault('IMAGE_FAILURE_TTL', 300)
+
+        self.enabled = app.config['IMAGE_PROXY_ENABLED']
+        self.failure_ttl = app.config['IMAGE_FAILURE_TTL']
+
+        self.fetcher = IMAGE_FETCHERS[app.config['IMAGE_FETCHER']](
+            timeout=app.config['IMAGE_FETCH_TIMEOUT'],
+            max_bytes=app.config['IMAGE_MAX_ORIGIN_BYTES'],
+        )
+        self.cache = ThumbnailCache(
+            app.config['IMAGE_CACHE_DIR'],
+            app.config['IMAGE_CACHE_MAX_BYTES'],
+        )
+        self.signer = Signer(app.secret_key, salt="image-proxy")
+
+        # url key: when to try fetching it again
+        self._failed = {}
+
+        # Requests for the same image wait for one fetch rather than each
+        # fetching it
+        self._locks = [threading.Lock() for _ in range(64)]
+
+        app.add_template_filter(self.thumbnail_url, "thumbnail")
+
+    def thumbnail_url(self, url, size):
+        """Link to `url` resized to `size` (the url itself if it's not an
+        image on another site, or the proxy is off)."""
+
+        if not (self.enabled and url and url.startswith(REMOTE_SCHEMES)):
+            return url
+
+        src = self.signer.sign(url).decode()
+
+        return url_for("proxied_image", size=size, src=src)
+
+    def unsign(self, src):
+        """Url of a thumbnail link's `src`; BadSignature if it's forged."""
+
+        return self.signer.unsign(src).decode()
+
+    def thumbnail(self, url, size):
+        """Path of `url` resized to `size`, or None if it can't be had.
+
+        If it's evicted as soon as it's made, its bytes come back instead,
+        as a file object.
+        """
+
+        key = hashlib.sha256(url.encode()).hexdigest()
+
+        path = self.cache.get(key, size)
+        if path:
+            return path
+
+        with self._locks[int(key[:8], 16) % len(self._locks)]:
+            # Made while we waited?
+            path = self.cache.get(key, size)
+            if path:
+                return path
+
+            if self._failed.get(key, 0) > time.monotonic():
+                return None
+
+            try:
+                thumbnails = make_thumbnails(self.fetcher(url), IMAGE_SIZES)
+
+            except (ImageFetchError, OSError, Image.DecompressionBombError):
+                self._failed_fetch(key)
+                return None
+
+            self._failed.pop(key, None)
+            self.cache.put(key, thumbnails)
+
+            # Eviction, by this put or another worker's, may have got to it
+            return self.cache.get(key, size) or BytesIO(thumbnails[size])
+
+    def _failed_fetch(self, key):
+        now = time.monotonic()
+
+        if len(self._failed) >= 10000:
+            self._failed = {
+                k: until for k, until in self._failed.items() if until > now}
+
+        self._failed[key] = now + self.failure_ttl
@@ -0,0 +1,226 @@
+"""Microcache of whole pages for anonymous visitors.
+
+The anonymous home page and the login and signup pages are the same for
+every visitor who isn't logged in, so for MICROCACHE_TTL seconds the first
+visitor's page is served to the rest, without running the view or the other
+before_request hooks. Only GET requests without a query string, to the
+MICROCACHE_ENDPOINTS, are cached, keyed by path and the values of the
+MICROCACHE_VARY_HEADERS; a visitor whose session holds anything more than
+a CSRF token (a login, flashed messages) is always served afresh.
+
+The one difference between visitors' pages is their CSRF token: pages are
+rendered with a placeholder in its place, and each visitor's own token is
+put in as the page is sent.
+
+While a page is being rendered, other requests for it in the same worker
+wait for it rather than rendering it too, so a burst of visitors to an
+expired page costs one render per worker.
+
+Pages are kept per worker ('memory'), or in the database ('database'), for
+all workers to share.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, g, request, session
+from flask_wtf.csrf import generate_csrf
+
+from models import db, dialect_insert, CachedPage
+
+Page = namedtuple("Page", ["status", "content_type", "body"])
+
+CSRF_PLACEHOLDER = "microcache-csrf-token"
+
+# Session keys an anonymous visitor's cached page doesn't depend on
+ANONYMOUS_SESSION_KEYS = frozenset({"csrf_token"})
+
+
+class MemoryPageStore:
+    """Pages in a dict, per process; the oldest are dropped beyond
+    `max_pages`."""
+
+    def __init__(self, max_pages=1000):
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        page, expires_at = self._pages.get(key, (None, 0))
+
+        return page if expires_at > now else None
+
+    def set(self, key, page, expires_at):
+        with self._lock:
+            self._pages.pop(key, None)
+            self._pages[key] = (page, expires_at)
+
+            if len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+
+
+class DatabasePageStore:
+    """Pages in the `cached_pages` table, shared by all workers.
+
+    Uses its own connections, like the session store, so it never commits
+    what the request did in `db.session`.
+    """
+
+    def get(self, key, now):
+        q = db.select(
+            CachedPage.status, CachedPage.content_type, CachedPage.body,
+        ).where(CachedPage.key == key, CachedPage.expires_at > now)
+
+        with db.engine.connect() as conn:
+            row = conn.execute(q).first()
+
+        return Page(*row) if row else None
+
+    def set(self, key, page, expires_at):
+        with db.engine.begin() as conn:
+            insert = dialect_insert(CachedPage, conn.dialect.name).values(
+                key=key, expires_at=expires_at, **page._asdict())
+            conn.execute(insert.on_conflict_do_update(
+                index_elements=[CachedPage.key],
+                set_={
+                    "status": insert.excluded.status,
+                    "content_type": insert.excluded.content_type,
+                    "body": insert.excluded.body,
+                    "expires_at": insert.excluded.expires_at,
+                },
+            ))
+
+
+MICROCACHE_BACKENDS = {
+    "memory": MemoryPageStore,
+    "database": DatabasePageStore,
+}
+
+
+class Microcache:
+    """Serves anonymous visitors' pages from a short-lived cache."""
+
+    def __init__(self, app=None):
+        self.store = None
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MICROCACHE_ENABLED', True)
+        app.config.setdefault('MICROCACHE_BACKEND', 'memory')
+        app.config.setdefault('MICROCACHE_TTL', 10)
+        app.config.setdefault('MICROCACHE_ENDPOINTS', ())
+        app.config.setdefault('MICROCACHE_VARY_HEADERS', ())
+        app.config.setdefault('MICROCACHE_WAIT', 5)
+
+        self.store = MICROCACHE_BACKENDS[app.config['MICROCACHE_BACKEND']]()
+        self.ttl = app.config['MICROCACHE_TTL']
+        self.endpoints = frozenset(app.config['MICROCACHE_ENDPOINTS'])
+        self.vary_headers = tuple(app.config['MICROCACHE_VARY_HEADERS'])
+        self.wait = app.config['MICROCACHE_WAIT']
+
+        if not app.config['MICROCACHE_ENABLED']:
+            return
+
+        # Registered ahead of the app's own hooks, so a hit skips them
+        app.before_request(self._serve)
+        app.after_request(self._store)
+        app.teardown_request(self._finish)
+
+    def key(self):
+        """The cache key of this request, or None if it can't be cached."""
+
+        if (request.method not in ("GET", "HEAD")
+                or request.endpoint not in self.endpoints
+                or request.query_string
+                or set(session) - ANONYMOUS_SESSION_KEYS):
+            return None
+
+        headers = "|".join(
+            request.headers.get(name, "") for name in self.vary_headers)
+
+        return f"{request.path}|{headers}"
+
+    def _serve(self):
+        key = self.key()
+        if key is None:
+            return None
+
+        page = self.store.get(key, time.time())
+
+        if page is None:
+            with self._lock:
+                rendered = self._rendering.get(key)
+                if rendered is None:
+                    self._rendering[key] = threading.Event()
+                    g.microcache_render = key
+
+            # Someone else is rendering it: wait for theirs
+            if rendered is not None and rendered.wait(self.wait):
+                page = self.store.get(key, time.time())
+
+        if page is None:
+            g.microcache_key = key
+            g.csrf_token = CSRF_PLACEHOLDER
+            return None
+
+        response = self._response(page)
+        response.headers["X-Microcache"] = "HIT"
+
+        return response
+
+    def _response(self, page):
+        response = current_app.response_class(
+            page.body, status=page.status, content_type=page.content_type)
+        self._fill_csrf_token(response)
+
+        return response
+
+    def _store(self, response):
+        key = g.pop("microcache_key", None)
+        if key is None:
+            return response
+
+        g.pop("csrf_token", None)
+        response.headers["X-Microcache"] = "MISS"
+
+        # Pages that flashed a message or logged someone in, say, aren't
+        # the same for everyone
+        if (response.status_code == 200
+                and not response.direct_passthrough
+                and not session.modified):
+            page = Page(
+                response.status_code,
+                response.content_type,
+                response.get_data(),
+            )
+            self.store.set(key, page, time.time() + self.ttl)
+
+        self._fill_csrf_token(response)
+
+        return response
+
+    def _fill_csrf_token(self, response):
+        """Put this visitor's CSRF token in place of the placeholder."""
+
+        body = response.get_data()
+        placeholder = CSRF_PLACEHOLDER.encode()
+
+        if placeholder in body:
+            response.set_data(
+                body.replace(placeholder, generate_csrf().encode()))
+
+    def _finish(self, exc):
+        """Let requests waiting on this one's render go on, however it
+        ended."""
+
+        key = g.pop("microcache_render", None)
+
+        if key is not None:
+            with self._lock:
+                rendered = self._rendering.pop(key)
+            rendered.set()
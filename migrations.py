@@ -0,0 +1,358 @@
+"""Versioned schema migrations.
+
+The schema is built by migrations, starting from the tables the app first
+shipped with (`BASELINE`). A migration is a function registered with
+`@migration(version)`; `upgrade()` runs the ones not yet recorded in the
+schema_migrations table, in version order, recording each as it finishes,
+so it brings an empty database, or one at any earlier version, up to the
+models' schema. A migration interrupted part way is run again from the
+start, so each must be safe to re-run, and be a no-op on tables that are
+already up to date (as `db.create_all()` makes them in the tests).
+
+On PostgreSQL, `create_index` builds indexes with CREATE INDEX CONCURRENTLY,
+which doesn't block writes to the table, so upgrades can run against the
+live database.
+"""
+
+from sqlalchemy import Column, ForeignKey, Identity, MetaData, Table
+from sqlalchemy import DateTime, Integer, String, Text, UniqueConstraint
+from sqlalchemy.schema import CreateIndex
+
+from models import (
+    db, dbx, CachedPage, FollowChange, FollowSuggestion, Message,
+    MessageArchive, Notification, NotificationEvent, RateLimitBucket,
+    SchemaMigration, ServerSession, TrendingMessage, MESSAGE_PARTITION_SIZE,
+)
+
+# The tables as the app first shipped them, before any migration. Frozen:
+# later changes go in migrations, never here.
+BASELINE = MetaData()
+
+Table(
+    "users", BASELINE,
+    Column("id", Integer, Identity(), primary_key=True),
+    Column("email", String(50), nullable=False, unique=True),
+    Column("username", String(30), nullable=False, unique=True),
+    Column("image_url", String(255), nullable=False),
+    Column("header_image_url", String(255), nullable=False),
+    Column("bio", Text, nullable=False),
+    Column("location", String(30), nullable=False),
+    Column("password", String(100), nullable=False),
+)
+
+Table(
+    "follows", BASELINE,
+    Column(
+        "user_being_followed_id", Integer,
+        ForeignKey("users.id", ondelete="cascade"), primary_key=True),
+    Column(
+        "user_following_id", Integer,
+        ForeignKey("users.id", ondelete="cascade"), primary_key=True),
+    UniqueConstraint("user_being_followed_id", "user_following_id"),
+)
+
+Table(
+    "messages", BASELINE,
+    Column("id", Integer, Identity(), primary_key=True),
+    Column("text", String(140), nullable=False),
+    Column("timestamp", DateTime, nullable=False),
+    Column(
+        "user_id", Integer,
+        ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+)
+
+Table(
+    "likes", BASELINE,
+    Column(
+        "user_id", Integer,
+        ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+    Column(
+        "message_id", Integer,
+        ForeignKey("messages.id", ondelete="CASCADE"), primary_key=True),
+    UniqueConstraint("user_id", "message_id"),
+)
+
+MIGRATIONS = {}
+
+
+def migration(version):
+    """Register the decorated function as migration number `version`."""
+
+    def register(fn):
+        if version in MIGRATIONS:
+            raise ValueError(f"Duplicate migration version {version}")
+
+        MIGRATIONS[version] = fn
+        return fn
+
+    return register
+
+
+def pending():
+    """(version, migration) pairs not applied yet, in order."""
+
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    applied = set(dbx(db.select(SchemaMigration.version)).scalars())
+
+    return [
+        (version, fn)
+        for version, fn in sorted(MIGRATIONS.items())
+        if version not in applied
+    ]
+
+
+def upgrade():
+    """Apply pending migrations; returns the versions applied."""
+
+    applied = []
+
+    for version, fn in pending():
+        fn()
+
+        db.session.add(SchemaMigration(version=version, name=fn.__name__))
+        db.session.commit()
+        applied.append(version)
+
+    return applied
+
+
+def add_column(table_name, column_name, definition):
+    """Add a column to an existing table, in the session's transaction,
+    unless it's already there; returns whether it was added."""
+
+    conn = db.session.connection()
+    columns = db.inspect(conn).get_columns(table_name)
+
+    if column_name in {column["name"] for column in columns}:
+        return False
+
+    name = conn.dialect.identifier_preparer.quote(column_name)
+    dbx(db.text(f"ALTER TABLE {table_name} ADD COLUMN {name} {definition}"))
+
+    return True
+
+
+def create_index(table_name, index_name):
+    """Create a models index on an existing table, unless it's already there.
+
+    On PostgreSQL the index is built concurrently, outside any transaction.
+    An invalid index left by an interrupted concurrent build is dropped and
+    built again. Partitioned tables (messages) can't have indexes built
+    concurrently, so on those the build blocks writes.
+    """
+
+    table = db.metadata.tables[table_name]
+    index = next(i for i in table.indexes if i.name == index_name)
+
+    # The session's transaction could hold locks the build would wait on
+    db.session.commit()
+
+    with db.engine.connect() as conn:
+        concurrently = conn.dialect.name == "postgresql" and conn.execute(
+            db.text(
+                "SELECT relkind <> 'p' FROM pg_class"
+                " WHERE oid = to_regclass(:name)"
+            ),
+            {"name": table_name},
+        ).scalar()
+
+        conn.commit()
+
+        if not concurrently:
+            index.create(conn, checkfirst=True)
+            conn.commit()
+            return
+
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+
+        invalid = conn.execute(
+            db.text(
+                "SELECT NOT indisvalid FROM pg_index"
+                " WHERE indexrelid = to_regclass(:name)"
+            ),
+            {"name": index_name},
+        ).scalar()
+
+        if invalid:
+            name = conn.dialect.identifier_preparer.quote(index_name)
+            conn.execute(db.text(f"DROP INDEX CONCURRENTLY {name}"))
+
+        options = index.dialect_options["postgresql"]
+        options["concurrently"] = True
+        try:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+        finally:
+            options["concurrently"] = False
+
+
+##############################################################################
+# Migrations. Append new ones; never renumber or edit applied ones.
+
+
+@migration(1)
+def create_baseline_tables():
+    """The tables the app first shipped with, for a new database."""
+
+    BASELINE.create_all(db.engine, checkfirst=True)
+
+
+@migration(2)
+def soft_delete_users():
+    """When a user was deleted; their rows are purged later."""
+
+    add_column("users", "deleted_at", "TIMESTAMP")
+
+
+@migration(3)
+def count_likes():
+    """When each like was made, and each message's like count.
+
+    Existing likes are dated from their message, the earliest they could
+    have been made, rather than all looking brand new to trending.
+    """
+
+    if add_column("likes", "timestamp", "TIMESTAMP"):
+        dbx(db.text(
+            'UPDATE likes SET "timestamp" = ('
+            ' SELECT messages."timestamp" FROM messages'
+            " WHERE messages.id = likes.message_id)"))
+
+        if db.engine.dialect.name == "postgresql":
+            dbx(db.text(
+                'ALTER TABLE likes ALTER COLUMN "timestamp"'
+                " SET DEFAULT CURRENT_TIMESTAMP,"
+                ' ALTER COLUMN "timestamp" SET NOT NULL'))
+
+    if add_column("messages", "like_count", "INTEGER NOT NULL DEFAULT 0"):
+        dbx(db.text(
+            "UPDATE messages SET like_count = ("
+            " SELECT count(*) FROM likes"
+            " WHERE likes.message_id = messages.id)"
+            " WHERE EXISTS ("
+            " SELECT 1 FROM likes WHERE likes.message_id = messages.id)"))
+
+
+@migration(4)
+def create_trending_messages():
+    """Precomputed trending scores."""
+
+    TrendingMessage.__table__.create(db.engine, checkfirst=True)
+
+
+@migration(5)
+def create_sessions():
+    """The database session store's table."""
+
+    ServerSession.__table__.create(db.engine, checkfirst=True)
+
+
+@migration(6)
+def create_rate_limits():
+    """The shared rate limiter backend's table."""
+
+    RateLimitBucket.__table__.create(db.engine, checkfirst=True)
+
+
+@migration(7)
+def index_message_text():
+    """Full-text index of messages, for search (PostgreSQL only)."""
+
+    if db.engine.dialect.name == "postgresql":
+        create_index("messages", "ix_messages_text_search")
+
+
+@migration(8)
+def create_follow_suggestions():
+    """Stored follow suggestions, and who to refresh them for."""
+
+    FollowSuggestion.__table__.create(db.engine, checkfirst=True)
+    FollowChange.__table__.create(db.engine, checkfirst=True)
+
+
+@migration(9)
+def index_hot_paths():
+    """Indexes for profiles, the home feed, follow lists, likes, trending."""
+
+    create_index("messages", "ix_messages_user_id_timestamp")
+    create_index("messages", "ix_messages_timestamp")
+    create_index("likes", "ix_likes_message_id")
+    create_index("follows", "ix_follows_user_following_id")
+
+
+@migration(10)
+def partition_messages():
+    """Messages in id-range partitions on PostgreSQL (see archive.py).
+
+    The existing table becomes the first partition, so no rows are copied;
+    but it's locked while it's checked against its range, as are the likes
+    while their foreign key is checked again. Run it at a quiet time.
+    """
+
+    MessageArchive.__table__.create(db.engine, checkfirst=True)
+
+    if db.engine.dialect.name != "postgresql":
+        return
+
+    kind = dbx(db.text(
+        "SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass"
+    )).scalar()
+
+    if kind == "p":
+        return
+
+    newest = dbx(db.select(db.func.max(Message.id))).scalar() or 0
+    end = (newest // MESSAGE_PARTITION_SIZE + 1) * MESSAGE_PARTITION_SIZE
+
+    # Foreign keys to messages, to point at the partitioned table instead
+    references = dbx(db.text(
+        "SELECT conrelid::regclass::text, conname,"
+        " pg_get_constraintdef(oid) FROM pg_constraint"
+        " WHERE confrelid = 'messages'::regclass AND contype = 'f'"
+    )).all()
+
+    for table_name, name, _definition in references:
+        dbx(db.text(f"ALTER TABLE {table_name} DROP CONSTRAINT {name}"))
+
+    dbx(db.text("ALTER TABLE messages RENAME TO messages_p0"))
+    dbx(db.text(
+        "ALTER TABLE messages_p0"
+        " RENAME CONSTRAINT messages_pkey TO messages_p0_pkey"))
+    dbx(db.text(
+        "ALTER TABLE messages_p0 ALTER COLUMN id DROP IDENTITY IF EXISTS"))
+
+    for index in Message.__table__.indexes:
+        partition_index = index.name.replace("ix_messages", "messages_p0")
+        dbx(db.text(
+            f"ALTER INDEX IF EXISTS {index.name}"
+            f" RENAME TO {partition_index}"))
+
+    # Creates the partitioned table, its indexes and default partition
+    Message.__table__.create(db.session.connection())
+    dbx(db.text(
+        f"ALTER TABLE messages ALTER COLUMN id RESTART WITH {newest + 1}"))
+
+    # Its indexes become the partitioned indexes' partitions
+    dbx(db.text(
+        "ALTER TABLE messages ATTACH PARTITION messages_p0"
+        f" FOR VALUES FROM (MINVALUE) TO ({end})"))
+
+    for table_name, name, definition in references:
+        dbx(db.text(
+            f"ALTER TABLE {table_name} ADD CONSTRAINT {name} {definition}"))
+
+
+@migration(11)
+def add_notifications():
+    """Notification events and inboxes, and users' unread counts."""
+
+    NotificationEvent.__table__.create(db.engine, checkfirst=True)
+    Notification.__table__.create(db.engine, checkfirst=True)
+
+    add_column("users", "unread_notifications", "INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(12)
+def create_cached_pages():
+    """The shared microcache backend's table."""
+
+    CachedPage.__table__.create(db.engine, checkfirst=True)
@@ -1,8 +1,16 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.util import identity_key
 
 bcrypt = Bcrypt()
 
@@ -18,6 +26,23 @@ DEFAULT_HEADER_IMAGE_URL = (
     "rb-4.0.3&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=for" +
     "mat&fit=crop&w=2070&q=80")
 
+TRENDING_WINDOW = timedelta(days=1)
+TRENDING_HALF_LIFE = timedelta(hours=6)
+TRENDING_MIN_SCORE = 0.01
+# How long a transaction that likes a message may run (see
+# TrendingMessage.refresh)
+TRENDING_LIKE_LAG = timedelta(minutes=1)
+
+# PostgreSQL text search configuration used to index and query messages
+SEARCH_CONFIG = "english"
+
+# On PostgreSQL, messages are stored in partitions of this many ids each (see
+# archive.py)
+MESSAGE_PARTITION_SIZE = 1_000_000
+
+# Outcome of User.like_unlike_msg: owner_id is None if there's no such message
+LikeToggle = namedtuple("LikeToggle", ["owner_id", "liked", "like_count"])
+
 
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,6 +51,12 @@ class Follow(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint("user_being_followed_id", "user_following_id"),
+        # The primary key covers looking up followers; this covers following
+        db.Index(
+            "ix_follows_user_following_id",
+            "user_following_id",
+            "user_being_followed_id",
+        ),
     )
 
     user_being_followed_id = db.mapped_column(
@@ -55,6 +86,13 @@ class Follow(db.Model):
     )
 
 
+# For each direction of User._follows: (this user's column, the other user's)
+FOLLOW_DIRECTIONS = {
+    "following": (Follow.user_following_id, Follow.user_being_followed_id),
+    "followers": (Follow.user_being_followed_id, Follow.user_following_id),
+}
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -107,16 +145,34 @@ class User(db.Model):
         nullable=False,
     )
 
+    deleted_at = db.mapped_column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # Notifications in the inbox not seen yet, kept up to date by
+    # `collapse_notifications` so every page can show it without a query
+    unread_notifications = db.mapped_column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # passive_deletes lets the ON DELETE CASCADE foreign keys remove child
+    # rows instead of SQLAlchemy loading and deleting them one by one
     messages = db.relationship(
         "Message",
         back_populates="user",
         cascade="all, delete-orphan",
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         "Like",
         back_populates="user",
         cascade="all, delete-orphan",
+        passive_deletes=True,
     )
 
     following_users = db.relationship(
@@ -124,6 +180,7 @@ class User(db.Model):
         foreign_keys=[Follow.user_following_id],
         back_populates="followed_user",
         cascade="all, delete-orphan",
+        passive_deletes=True,
     )
 
     followers_users = db.relationship(
@@ -131,23 +188,121 @@ class User(db.Model):
         foreign_keys=[Follow.user_being_followed_id],
         back_populates="following_user",
         cascade="all, delete-orphan",
+        passive_deletes=True,
     )
 
     @property
     def liked_msgs(self):
-        return [like.message for like in self.likes]
+        # Messages, then their authors, with a query each
+        messages = entity_loader(Message).load_many(
+            like.message_id for like in self.likes)
+        entity_loader(User).load_many(message.user_id for message in messages)
+
+        return [
+            message for message in messages
+            if message.user.deleted_at is None
+        ]
 
     @property
     def num_likes(self):
         return len(self.liked_msgs)
 
+    # The counts below are COUNT queries, so showing them doesn't load the
+    # whole collection
+
+    @property
+    def num_messages(self):
+        q = db.select(db.func.count()).where(Message.user_id == self.id)
+        return dbx(q).scalar()
+
+    @property
+    def num_following(self):
+        q = (
+            db.select(db.func.count())
+            .select_from(Follow)
+            .join(User, User.id == Follow.user_being_followed_id)
+            .where(
+                Follow.user_following_id == self.id,
+                User.deleted_at.is_(None),
+            )
+        )
+        return dbx(q).scalar()
+
+    @property
+    def num_followers(self):
+        q = (
+            db.select(db.func.count())
+            .select_from(Follow)
+            .join(User, User.id == Follow.user_following_id)
+            .where(
+                Follow.user_being_followed_id == self.id,
+                User.deleted_at.is_(None),
+            )
+        )
+        return dbx(q).scalar()
+
+    # Optional per-worker cache of follow lists (a graph.GraphCache), set up
+    # by the app when GRAPH_CACHE_ENABLED is on
+    graph_cache = None
+
     @property
     def following(self):
-        return [follow.following_user for follow in self.following_users]
+        return self._follows("following")
 
     @property
     def followers(self):
-        return [follow.followed_user for follow in self.followers_users]
+        return self._follows("followers")
+
+    def _follows(self, direction):
+        """Active users this user is following / followed by."""
+
+        loader = entity_loader(User)
+
+        if User.graph_cache is not None:
+            users = loader.load_many(User.graph_cache.get(direction, self.id))
+
+            return [
+                user for user in users
+                if user is not None and user.deleted_at is None
+            ]
+
+        this, other = FOLLOW_DIRECTIONS[direction]
+        q = (
+            db.select(User)
+            .join(Follow, other == User.id)
+            .where(this == self.id, User.deleted_at.is_(None))
+        )
+        users = dbx(q).scalars().all()
+
+        for user in users:
+            loader.prime(user.id, user)
+
+        return users
+
+    @staticmethod
+    def select_follow_ids(direction, user_id):
+        """Select of the sorted ids of all users `user_id` is following /
+        followed by, soft-deleted users included."""
+
+        this, other = FOLLOW_DIRECTIONS[direction]
+        return db.select(other).where(this == user_id).order_by(other)
+
+    @staticmethod
+    def load_follow_ids(direction, user_id):
+        """Sorted ids of all users `user_id` is following / followed by.
+
+        Includes soft-deleted users. This is the graph cache's loader.
+        """
+
+        return dbx(User.select_follow_ids(direction, user_id)).scalars().all()
+
+    def following_ids(self):
+        """Sorted ids of everyone this user follows, deleted users included."""
+
+        if User.graph_cache is not None:
+            return User.graph_cache.following(self.id)
+
+        return User.load_follow_ids("following", self.id)
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
@@ -183,7 +338,7 @@ class User(db.Model):
         False.
         """
 
-        q = db.select(cls).filter_by(username=username)
+        q = db.select(cls).filter_by(username=username, deleted_at=None)
         user = dbx(q).scalar_one_or_none()
 
         if user:
@@ -193,39 +348,210 @@ class User(db.Model):
 
         return False
 
-    def follow(self, other_user):
-        """Follow another user."""
+    def soft_delete(self):
+        """Mark this user as deleted.
+
+        The user and their content are hidden right away; the rows themselves
+        are removed later, in batches, by `User.purge_deleted`.
+        """
+
+        self.deleted_at = db.func.current_timestamp()
+
+    @classmethod
+    def purge_deleted(cls, batch_size=1000):
+        """Remove soft-deleted users and everything that belongs to them.
+
+        Dependent rows are deleted at most `batch_size` at a time, committing
+        after every batch so no single transaction holds locks on the hot
+        tables for long. Likes on the user's messages go with the messages via
+        ON DELETE CASCADE.
+
+        Returns the number of users purged.
+        """
+
+        q = db.select(cls.id).where(cls.deleted_at.is_not(None))
+        user_ids = dbx(q).scalars().all()
+
+        for user_id in user_ids:
+            _delete_in_batches(
+                Like, Like.user_id == user_id, batch_size,
+                after_batch=_uncount_likes,
+            )
+
+            batches = [
+                (Follow, Follow.user_following_id == user_id),
+                (Follow, Follow.user_being_followed_id == user_id),
+                (Message, Message.user_id == user_id),
+            ]
+
+            for model, condition in batches:
+                _delete_in_batches(model, condition, batch_size)
+
+            dbx(db.delete(cls).filter_by(id=user_id))
+            db.session.commit()
+
+        return len(user_ids)
+
+    def follow(self, other_user_id):
+        """Follow user `other_user_id`.
+
+        Following someone already followed is a no-op, so retries and
+        double-clicks are safe. Returns False if there's no such user.
+        """
+
+        found, _followed = self._follow_ids([other_user_id])
+
+        if found:
+            self._graph_changed([other_user_id], followed=True)
+
+        return found == 1
+
+    def follow_many(self, user_ids):
+        """Follow every existing user in `user_ids` with a single INSERT.
+
+        Meant for onboarding/imports; unknown ids, this user's own id and
+        users already followed are skipped. Returns the number of new follows.
+        """
+
+        _found, followed = self._follow_ids(user_ids)
+
+        # Ids of missing users are harmless in the cache: nothing asks about
+        # them, and lists are reloaded from the database when they expire
+        if followed:
+            self._graph_changed(user_ids, followed=True)
+
+        return followed
 
-        follow = Follow(
-            user_being_followed_id=other_user.id,
-            user_following_id=self.id
+    def _follow_ids(self, user_ids):
+        """Insert follows of `user_ids`, recording them for those users'
+        notifications; returns (users found, follows added)."""
+
+        targets = (
+            db.select(User.id)
+            .where(User.id.in_(user_ids), User.deleted_at.is_(None))
+            .cte("targets")
+        )
+        rows = db.select(targets.c.id, db.literal(self.id, db.Integer)).where(
+            targets.c.id != self.id)
+        follow = (
+            dialect_insert(Follow)
+            .from_select(["user_being_followed_id", "user_following_id"], rows)
+            .on_conflict_do_nothing()
+        )
+        found = db.select(db.func.count()).select_from(targets)
+
+        follow = follow.returning(Follow.user_being_followed_id)
+
+        if _dialect() != "postgresql":
+            followed = dbx(follow).scalars().all()
+            if followed:
+                dbx(FollowChange.mark(self.id))
+                dbx(NotificationEvent.record("follow", self.id, db.select(
+                    User.id, db.null()).where(User.id.in_(followed))))
+            return dbx(found).scalar(), len(followed)
+
+        followed = follow.cte("followed")
+        marked = FollowChange.mark(self.id, followed.select()).cte("marked")
+        notified = NotificationEvent.record(
+            "follow",
+            self.id,
+            db.select(followed.c.user_being_followed_id, db.null()),
+        ).cte("notified")
+        q = db.select(
+            found.scalar_subquery(),
+            db.select(db.func.count()).select_from(followed).scalar_subquery(),
+        ).add_cte(marked, notified)
+
+        return tuple(dbx(q).one())
+
+    def unfollow(self, other_user_id):
+        """Stop following user `other_user_id`.
+
+        Unfollowing someone not followed is a no-op. Returns False if there's
+        no such user.
+        """
+
+        unfollow = (
+            db.delete(Follow.__table__)
+            .filter_by(
+                user_being_followed_id=other_user_id,
+                user_following_id=self.id)
         )
-        db.session.add(follow)
+        found = db.exists().where(
+            User.id == other_user_id, User.deleted_at.is_(None))
+
+        self._graph_changed([other_user_id], followed=False)
 
-    def unfollow(self, other_user):
-        """Stop following another user."""
+        if _dialect() != "postgresql":
+            if dbx(unfollow).rowcount:
+                dbx(FollowChange.mark(self.id))
+            return dbx(db.select(found)).scalar()
 
-        q = (db
-             .delete(Follow)
-             .filter_by(
-                 user_being_followed_id=other_user.id,
-                 user_following_id=self.id)
-             )
-        dbx(q)
+        unfollowed = unfollow.returning(Follow.user_following_id).cte(
+            "unfollowed")
+        marked = FollowChange.mark(self.id, unfollowed.select()).cte("marked")
+        q = db.select(found, db.exists(unfollowed.select())).add_cte(marked)
+
+        return dbx(q).one()[0]
 
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        if other_user.deleted_at is not None:
+            return False
+
+        return _is_following(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if other_user.deleted_at is not None:
+            return False
+
+        return _is_following(self.id, other_user.id)
+
+    def _graph_changed(self, user_ids, followed):
+        """Update the graph cache for this user's (un)follows, on commit."""
+
+        cache = User.graph_cache
+
+        if cache is None:
+            return
+
+        change = cache.add if followed else cache.remove
+
+        for user_id in user_ids:
+            if user_id != self.id:
+                on_commit(db.session, change, self.id, user_id)
+
+    def suggested_users(self, limit=5):
+        """Users suggested for this user to follow, best first.
+
+        Reads the stored suggestions, skipping anyone followed or deleted
+        since they were last refreshed.
+        """
+
+        q = User.select_suggested(db.select(User), self.id, limit)
+        return dbx(q).scalars().all()
+
+    @staticmethod
+    def select_suggested(q, user_id, limit=5):
+        """Narrow `q`, a select of users, to those suggested to `user_id`."""
+
+        followed = db.select(Follow.user_being_followed_id).where(
+            Follow.user_following_id == user_id)
+
+        return (
+            q.join(
+                FollowSuggestion, FollowSuggestion.suggested_user_id == User.id)
+            .where(
+                FollowSuggestion.user_id == user_id,
+                User.deleted_at.is_(None),
+                User.id.not_in(followed),
+            )
+            .order_by(FollowSuggestion.score.desc())
+            .limit(limit)
+        )
 
     def update_user(
             self,
@@ -246,28 +572,131 @@ class User(db.Model):
         self.header_image_url = header_image_url or DEFAULT_HEADER_IMAGE_URL
         self.bio = bio
 
-    def like_unlike_msg(self, msg):
-        """
-        Checks whether a user has liked a message and then likes/unlikes the
-        message
+    def like_unlike_msg(self, msg_id):
+        """Like message `msg_id`, or unlike it if this user already has.
+
+        The ownership check, the toggle and the new like count are done in a
+        single statement on PostgreSQL (and one transaction on SQLite), so
+        there's no window between checking for a like and inserting one.
+        Users can't like their own messages; nothing changes in that case.
+        A like (not an unlike) is recorded for the owner's notifications.
+
+        Returns a LikeToggle of (owner_id, liked, like_count).
         """
 
-        q = (
-            db.select(Like)
-            .where(
-                (Like.message_id == msg.id) &
-                (Like.user_id == self.id)
+        msg = (
+            db.select(Message.id, Message.user_id)
+            .join(User, User.id == Message.user_id)
+            .where(Message.id == msg_id, User.deleted_at.is_(None))
+            .cte("msg")
+        )
+        likeable = db.select(msg.c.id).where(msg.c.user_id != self.id)
+
+        unlike = (
+            db.delete(Like.__table__)
+            .where(Like.user_id == self.id, Like.message_id.in_(likeable))
+            .returning(Like.message_id)
+        )
+
+        def like(unliked):
+            rows = db.select(db.literal(self.id, db.Integer), msg.c.id).where(
+                msg.c.user_id != self.id)
+            if unliked is not None:
+                rows = rows.where(~db.exists(unliked.select()))
+
+            return (
+                dialect_insert(Like)
+                .from_select(["user_id", "message_id"], rows)
+                .on_conflict_do_nothing()
+                .returning(Like.message_id)
+            )
+
+        def count_like(delta):
+            return (
+                db.update(Message.__table__)
+                .where(Message.id == msg_id, delta != 0)
+                .values(like_count=Message.like_count + delta)
+                .returning(Message.like_count)
             )
+
+        owner_id = db.select(msg.c.user_id).scalar_subquery()
+        like_count = (
+            db.select(Message.like_count)
+            .where(Message.id == msg_id)
+            .scalar_subquery()
         )
 
-        liked_msg = dbx(q).scalar_one_or_none()
+        if _dialect() != "postgresql":
+            unliked = dbx(unlike).first()
+            liked = None if unliked else dbx(like(None)).first()
+            dbx(count_like(-1 if unliked else int(liked is not None)))
+            if liked:
+                dbx(NotificationEvent.record(
+                    "like", self.id, db.select(msg.c.user_id, msg.c.id)))
+            owner, count = dbx(db.select(owner_id, like_count)).one()
 
-        if liked_msg:
-            db.session.delete(liked_msg)
+            return LikeToggle(owner, liked is not None, count)
 
-        else:
-            liked_msg = Like(user_id=self.id, message_id=msg.id)
-            db.session.add(liked_msg)
+        unliked = unlike.cte("unliked")
+        liked = like(unliked).cte("liked")
+        counted = count_like(
+            db.select(db.func.count()).select_from(liked).scalar_subquery()
+            - db.select(db.func.count()).select_from(unliked)
+            .scalar_subquery()
+        ).cte("counted")
+        notified = NotificationEvent.record(
+            "like",
+            self.id,
+            db.select(msg.c.user_id, liked.c.message_id)
+            .join_from(liked, msg, msg.c.id == liked.c.message_id),
+        ).cte("notified")
+
+        # The statement's snapshot doesn't see its own writes, so the new
+        # count comes from the UPDATE's RETURNING when there was a change
+        q = db.select(
+            owner_id,
+            db.exists(liked.select()),
+            db.func.coalesce(
+                db.select(counted.c.like_count).scalar_subquery(),
+                like_count,
+            ),
+        ).add_cte(notified)
+
+        return LikeToggle(*dbx(q).one())
+
+
+def _is_following(follower_id, followed_id):
+    """Does user `follower_id` follow user `followed_id`?"""
+
+    if User.graph_cache is not None:
+        return User.graph_cache.is_following(follower_id, followed_id)
+
+    q = db.select(db.exists().where(
+        Follow.user_following_id == follower_id,
+        Follow.user_being_followed_id == followed_id,
+    ))
+
+    return dbx(q).scalar()
+
+
+@db.event.listens_for(Follow, "after_insert")
+def _cache_follow(mapper, connection, follow):
+    """Keep the graph cache up to date with follows added through the ORM."""
+
+    if User.graph_cache is not None:
+        on_commit(
+            object_session(follow), User.graph_cache.add,
+            follow.user_following_id, follow.user_being_followed_id)
+
+
+@db.event.listens_for(Follow, "after_delete")
+def _cache_unfollow(mapper, connection, follow):
+    """Keep the graph cache up to date with follows deleted through the ORM."""
+
+    if User.graph_cache is not None:
+        on_commit(
+            object_session(follow), User.graph_cache.remove,
+            follow.user_following_id, follow.user_being_followed_id)
 
 
 class Message(db.Model):
@@ -275,6 +704,17 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        # A user's messages newest first: profiles, and the home feed
+        db.Index("ix_messages_user_id_timestamp", "user_id", "timestamp"),
+        # Everyone's recent messages: trending
+        db.Index("ix_messages_timestamp", "timestamp"),
+        # By id rather than timestamp: likes and trending refer to messages
+        # by id, and PostgreSQL needs the partition key in the primary key.
+        # Ids only grow, so old messages still end up together.
+        {"postgresql_partition_by": "RANGE (id)"},
+    )
+
     id = db.mapped_column(
         db.Integer,
         db.Identity(),
@@ -298,6 +738,15 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Kept in step with the likes table by User.like_unlike_msg and the Like
+    # mapper events below, so cards never have to load Message.likes
+    like_count = db.mapped_column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     user = db.relationship(
         "User",
         back_populates="messages",
@@ -306,7 +755,8 @@ class Message(db.Model):
     likes = db.relationship(
         "Like",
         back_populates="message",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        passive_deletes=True,
     )
 
     @property
@@ -317,10 +767,75 @@ class Message(db.Model):
             like.user_id for like in self.likes
         ]
 
+    @classmethod
+    def recent(cls):
+        """Condition for messages that haven't been archived.
+
+        On PostgreSQL, queries filtered on it only read the partitions of
+        recent messages.
+        """
+
+        before_id = db.select(
+            db.func.coalesce(db.func.max(MessageArchive.before_id), 0)
+        ).scalar_subquery()
+
+        return cls.id >= before_id
+
     def is_liked_by_user(self, user_id):
         """Returns true if this messages is liked by user"""
 
-        return user_id in self.users_liked
+        session = object_session(self)
+
+        if session is None or "likes" not in db.inspect(self).unloaded:
+            return user_id in self.users_liked
+
+        # Rather than load each message's likes, ask which of the messages
+        # loaded so far the user likes, all at once
+        liked = batch_loader(
+            session,
+            ("liked", user_id),
+            lambda ids: _load_liked(session, user_id, ids),
+        )
+
+        if self.id not in liked:
+            liked.expect(
+                key[1][0] for key in session.identity_map.keys()
+                if key[0] is Message)
+
+        return liked.load(self.id) is not None
+
+
+@db.event.listens_for(Message.__table__, "after_create")
+def _create_message_partitions(table, connection, **kw):
+    """Give a new partitioned messages table its first partitions: one for
+    the first MESSAGE_PARTITION_SIZE ids, and a default one for any ids
+    beyond the partitions made so far."""
+
+    if (connection.dialect.name != "postgresql"
+            or not table.dialect_options["postgresql"]["partition_by"]):
+        return
+
+    # Unless there's already a messages_p0: the migration that partitions an
+    # existing messages table makes that its first partition
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS messages_p0 PARTITION OF messages"
+        f" FOR VALUES FROM (MINVALUE) TO ({MESSAGE_PARTITION_SIZE})")
+    connection.exec_driver_sql(
+        "CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+
+
+# Full-text index over message text, on PostgreSQL only (see search.py).
+# Searches must use this same expression for the planner to use the index.
+MESSAGE_TSVECTOR = db.func.to_tsvector(
+    db.text(f"'{SEARCH_CONFIG}'::regconfig"),
+    Message.__table__.c.text,
+)
+
+db.Index(
+    "ix_messages_text_search",
+    MESSAGE_TSVECTOR,
+    postgresql_using="gin",
+).ddl_if(dialect="postgresql")
 
 
 class Like(db.Model):
@@ -330,6 +845,8 @@ class Like(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint("user_id", "message_id"),
+        # The primary key covers a user's likes; this covers a message's
+        db.Index("ix_likes_message_id", "message_id"),
     )
 
     user_id = db.mapped_column(
@@ -346,6 +863,13 @@ class Like(db.Model):
         primary_key=True
     )
 
+    timestamp = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+        default=db.func.current_timestamp(),
+        server_default=db.func.current_timestamp(),
+    )
+
     user = db.relationship(
         "User",
         back_populates="likes"
@@ -355,3 +879,709 @@ class Like(db.Model):
         "Message",
         back_populates="likes"
     )
+
+
+@db.event.listens_for(Like, "after_insert")
+def _increment_like_count(mapper, connection, like):
+    """Count likes added through the ORM (e.g. `db.session.add(Like(...))`)."""
+
+    connection.execute(
+        db.update(Message.__table__)
+        .where(Message.id == like.message_id)
+        .values(like_count=Message.like_count + 1)
+    )
+
+
+@db.event.listens_for(Like, "after_delete")
+def _decrement_like_count(mapper, connection, like):
+    """Uncount likes deleted through the ORM."""
+
+    connection.execute(
+        db.update(Message.__table__)
+        .where(Message.id == like.message_id)
+        .values(like_count=Message.like_count - 1)
+    )
+
+
+class ServerSession(db.Model):
+    """A server-side session; the session cookie only holds its id."""
+
+    __tablename__ = 'sessions'
+
+    id = db.mapped_column(
+        db.String(64),
+        primary_key=True,
+    )
+
+    data = db.mapped_column(
+        db.Text,
+        nullable=False,
+    )
+
+    expires_at = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+        index=True,
+    )
+
+
+class RateLimitBucket(db.Model):
+    """Token bucket of the shared (database) rate limiter backend."""
+
+    __tablename__ = 'rate_limits'
+
+    key = db.mapped_column(
+        db.String(200),
+        primary_key=True,
+    )
+
+    tokens = db.mapped_column(
+        db.Float,
+        nullable=False,
+    )
+
+    # Seconds since the epoch, so buckets refill the same way in every dialect
+    updated_at = db.mapped_column(
+        db.Float,
+        nullable=False,
+    )
+
+    allowed = db.mapped_column(
+        db.Boolean,
+        nullable=False,
+    )
+
+
+class CachedPage(db.Model):
+    """A page in the shared (database) microcache backend."""
+
+    __tablename__ = 'cached_pages'
+
+    key = db.mapped_column(
+        db.String(200),
+        primary_key=True,
+    )
+
+    status = db.mapped_column(
+        db.Integer,
+        nullable=False,
+    )
+
+    content_type = db.mapped_column(
+        db.String(100),
+        nullable=False,
+    )
+
+    body = db.mapped_column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    # Seconds since the epoch, like the rate limit buckets'
+    expires_at = db.mapped_column(
+        db.Float,
+        nullable=False,
+    )
+
+
+class TrendingMessage(db.Model):
+    """Precomputed, time-decayed popularity score of a recent message.
+
+    Rebuilt incrementally by `TrendingMessage.refresh`, which is meant to run
+    as a background job; the trending page only reads this table.
+    """
+
+    __tablename__ = 'trending_messages'
+
+    message_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    score = db.mapped_column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
+    refreshed_at = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    message = db.relationship("Message")
+
+    @classmethod
+    def refresh(cls, window=TRENDING_WINDOW, half_life=TRENDING_HALF_LIFE,
+                lag=TRENDING_LIKE_LAG):
+        """Bring trending scores up to date.
+
+        A message's score is the sum over its likes of 2^(-age / half_life),
+        counting only messages posted within `window`. Since every term
+        decays by the same factor, existing scores are decayed in place and
+        only likes added since the last refresh are read; the first refresh
+        (or one after the table empties) scores the whole window.
+
+        A like's timestamp is when its transaction started, so it can commit
+        with a timestamp from before the last refresh. Each refresh reads the
+        likes from `lag` before the last refresh to `lag` before now, which
+        counts every like once as long as its transaction took less than
+        `lag`, at the cost of likes counting `lag` late.
+
+        Unlikes aren't subtracted; their contribution simply decays away.
+        """
+
+        # Database clock, as naive wall time to match the stored timestamps
+        now = dbx(db.select(db.func.current_timestamp(type_=db.DateTime)))
+        now = now.scalar().replace(tzinfo=None)
+        last = dbx(db.select(db.func.max(cls.refreshed_at))).scalar()
+        cutoff = now - window
+
+        def weight(timestamp):
+            return 0.5 ** ((now - timestamp) / half_life)
+
+        if last is not None:
+            dbx(db.update(cls).values(
+                score=cls.score * weight(last),
+                refreshed_at=now,
+            ))
+
+        stale = db.select(Message.id).where(Message.timestamp < cutoff)
+        dbx(
+            db.delete(cls)
+            .where(cls.message_id.in_(stale) | (cls.score < TRENDING_MIN_SCORE))
+            .execution_options(synchronize_session=False)
+        )
+
+        q = (
+            db.select(Like.message_id, Like.timestamp)
+            .join(Message, Message.id == Like.message_id)
+            .where(Message.timestamp >= cutoff, Like.timestamp <= now - lag)
+        )
+        if last is not None:
+            q = q.where(Like.timestamp > last - lag)
+
+        scores = {}
+        for message_id, timestamp in dbx(q):
+            scores[message_id] = scores.get(message_id, 0) + weight(timestamp)
+
+        if scores:
+            insert = dialect_insert(cls)
+            dbx(
+                insert.on_conflict_do_update(
+                    index_elements=[cls.message_id],
+                    set_={
+                        "score": cls.score + insert.excluded.score,
+                        "refreshed_at": insert.excluded.refreshed_at,
+                    },
+                ),
+                [
+                    {"message_id": msg_id, "score": score, "refreshed_at": now}
+                    for msg_id, score in scores.items()
+                ],
+            )
+
+        db.session.commit()
+
+
+class FollowSuggestion(db.Model):
+    """An account suggested for a user to follow, from friends-of-friends.
+
+    Computed in batch by `refresh-suggestions` (see suggestions.py).
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    __table_args__ = (
+        db.Index("ix_follow_suggestions_user_id_score", "user_id", "score"),
+    )
+
+    user_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    suggested_user_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    score = db.mapped_column(
+        db.Float,
+        nullable=False,
+    )
+
+
+class FollowChange(db.Model):
+    """A user whose follows changed since suggestions were last refreshed."""
+
+    __tablename__ = 'follow_changes'
+
+    user_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    changed_at = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def mark(cls, user_id, changed=None):
+        """Statement recording that `user_id`'s follows changed.
+
+        With `changed` (a subquery), only records it if that returns rows.
+        """
+
+        rows = db.select(
+            db.literal(user_id, db.Integer),
+            db.func.current_timestamp(type_=db.DateTime),
+        )
+        # (SQLite needs a WHERE here to parse the ON CONFLICT clause)
+        rows = rows.where(
+            db.exists(changed) if changed is not None else db.true())
+
+        insert = dialect_insert(cls).from_select(["user_id", "changed_at"], rows)
+
+        return insert.on_conflict_do_update(
+            index_elements=[cls.user_id],
+            set_={"changed_at": insert.excluded.changed_at},
+        )
+
+
+class MessageArchive(db.Model):
+    """A run of `archive.archive_messages`: messages with ids below
+    `before_id` are archived, as they're older than `horizon`."""
+
+    __tablename__ = 'message_archives'
+
+    id = db.mapped_column(
+        db.Integer,
+        db.Identity(),
+        primary_key=True,
+    )
+
+    before_id = db.mapped_column(
+        db.Integer,
+        nullable=False,
+    )
+
+    horizon = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    archived_at = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+        default=db.func.current_timestamp(),
+    )
+
+
+class NotificationEvent(db.Model):
+    """A like or follow not yet folded into its user's notifications.
+
+    Recorded by the statements that like messages and follow users, and
+    consumed by `notifications.collapse_notifications`.
+    """
+
+    __tablename__ = 'notification_events'
+
+    id = db.mapped_column(
+        db.Integer,
+        db.Identity(),
+        primary_key=True,
+    )
+
+    # Who's notified
+    user_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # 'like' or 'follow'
+    kind = db.mapped_column(
+        db.String(10),
+        nullable=False,
+    )
+
+    actor_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    message_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        nullable=True,
+    )
+
+    created_at = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+        default=db.func.current_timestamp(),
+    )
+
+    @classmethod
+    def record(cls, kind, actor_id, rows):
+        """Statement recording `kind` events by `actor_id`, for the
+        (user_id, message_id) pairs `rows` selects."""
+
+        rows = rows.add_columns(
+            db.literal(kind, db.String),
+            db.literal(actor_id, db.Integer),
+        )
+
+        return db.insert(cls).from_select(
+            ["user_id", "message_id", "kind", "actor_id"], rows)
+
+
+class Notification(db.Model):
+    """An entry in a user's inbox: everyone who liked one of their messages,
+    or followed them, since they last looked."""
+
+    __tablename__ = 'notifications'
+
+    __table_args__ = (
+        db.Index(
+            "ix_notifications_user_id_updated_at",
+            "user_id",
+            "updated_at",
+            "id",
+        ),
+    )
+
+    id = db.mapped_column(
+        db.Integer,
+        db.Identity(),
+        primary_key=True,
+    )
+
+    user_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    kind = db.mapped_column(
+        db.String(10),
+        nullable=False,
+    )
+
+    message_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        nullable=True,
+    )
+
+    actor_count = db.mapped_column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # The latest of them, to name
+    last_actor_id = db.mapped_column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='SET NULL'),
+        nullable=True,
+    )
+
+    updated_at = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    read_at = db.mapped_column(
+        db.DateTime,
+        nullable=True,
+    )
+
+
+class SchemaMigration(db.Model):
+    """A schema migration that has been applied (see migrations.py)."""
+
+    __tablename__ = 'schema_migrations'
+
+    version = db.mapped_column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.mapped_column(
+        db.String(100),
+        nullable=False,
+    )
+
+    applied_at = db.mapped_column(
+        db.DateTime,
+        nullable=False,
+        default=db.func.current_timestamp(),
+    )
+
+
+def _dialect():
+    """Name of the database dialect the session is bound to."""
+
+    return db.session.get_bind().dialect.name
+
+
+def dialect_insert(model, dialect=None):
+    """INSERT construct for `model` that supports ON CONFLICT clauses.
+
+    Uses the session's dialect unless a `dialect` name is given.
+    """
+
+    if (dialect or _dialect()) == "sqlite":
+        return sqlite_insert(model)
+
+    return pg_insert(model)
+
+
+def on_commit(session, fn, *args):
+    """Call `fn(*args)` once `session` commits; never, if it rolls back.
+
+    For keeping in-memory indexes in step with the database.
+    """
+
+    session.info.setdefault("on_commit", []).append((fn, args))
+
+
+@db.event.listens_for(Session, "after_commit")
+def _run_on_commit(session):
+    for fn, args in session.info.pop("on_commit", ()):
+        fn(*args)
+
+
+@db.event.listens_for(Session, "after_rollback")
+def _discard_on_commit(session):
+    session.info.pop("on_commit", None)
+
+
+class BatchLoader:
+    """Looks values up by key a batch at a time (the DataLoader pattern).
+
+    Keys noted with `expect()`, and the key asked for, are fetched together
+    by `batch(keys)` (which returns {key: value} for the keys it finds) the
+    first time one of them is asked for. Values, None for keys not found,
+    are kept until the session's transaction ends.
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+        self._values = {}
+        self._expected = set()
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def expect(self, keys):
+        """Fetch `keys` with the next batch."""
+
+        values = self._values
+        self._expected.update(key for key in keys if key not in values)
+
+    def prime(self, key, value):
+        """Keep `value`, loaded some other way, for `key`."""
+
+        self._values[key] = value
+        self._expected.discard(key)
+
+    def load(self, key):
+        if key not in self._values:
+            self._expected.add(key)
+            self.load_expected()
+
+        return self._values[key]
+
+    def load_many(self, keys):
+        keys = list(keys)
+        self.expect(keys)
+        self.load_expected()
+
+        return [self._values[key] for key in keys]
+
+    def load_expected(self, at_least=1):
+        """Fetch every key expected so far in one batch, if there are
+        `at_least` of them."""
+
+        if len(self._expected) < at_least:
+            return
+
+        keys, self._expected = self._expected, set()
+        found = self.batch(sorted(keys))
+
+        for key in keys:
+            self._values[key] = found.get(key)
+
+
+def batch_loader(session, key, batch):
+    """`session`'s BatchLoader for `key`, made with `batch` if it's new."""
+
+    loaders = session.info.setdefault("loaders", {})
+    loader = loaders.get(key)
+
+    if loader is None:
+        loader = loaders[key] = BatchLoader(batch)
+
+    return loader
+
+
+def entity_loader(model, session=None):
+    """The session's BatchLoader of `model` instances by id.
+
+    One is kept for each of User and Message, and the ids of the users and
+    messages every loaded object refers to (a message's author, a like's
+    message, ...) are expected by them. So the first time a template follows
+    one of those references (`message.user`), every object referred to so
+    far is loaded with one IN query, and the rest are found in the session.
+    Only objects loaded inside `batching()` are expected.
+    """
+
+    session = session or db.session()
+
+    return batch_loader(
+        session, model, lambda ids: _load_entities(session, model, ids))
+
+
+def _load_liked(session, user_id, message_ids):
+    q = db.select(Like.message_id).where(
+        Like.user_id == user_id, Like.message_id.in_(message_ids))
+
+    return {message_id: True for message_id in session.execute(q).scalars()}
+
+
+def _load_entities(session, model, ids):
+    found = {}
+    missing = []
+
+    for id in ids:
+        instance = session.identity_map.get(identity_key(model, id))
+
+        if instance is None:
+            missing.append(id)
+        else:
+            found[id] = instance
+
+    if missing:
+        q = db.select(model).where(model.id.in_(missing))
+        found.update((instance.id, instance) for instance in
+                     session.execute(q).scalars())
+
+    return found
+
+
+# For each model, the (id attribute, model) of the many-to-one references
+# its instances make, which entity loaders batch
+_REFERENCES = {
+    Message: [("user_id", User)],
+    Like: [("user_id", User), ("message_id", Message)],
+    Follow: [("user_following_id", User), ("user_being_followed_id", User)],
+    TrendingMessage: [("message_id", Message)],
+}
+
+
+@contextmanager
+def batching(session=None):
+    """Have the entity loaders expect the references of objects loaded by
+    `session` while in this block.
+
+    Requests are run in one (see app.py). Elsewhere, say in a job reading
+    rows a batch at a time, the expected ids and loaded values would pile up
+    until the transaction ended, keeping every object read alive.
+    """
+
+    session = session or db.session()
+    session.info["batching"] = session.info.get("batching", 0) + 1
+
+    try:
+        yield
+    finally:
+        session.info["batching"] -= 1
+
+
+def _expect_references(instance, context):
+    """Have the entity loaders expect the ids `instance` refers to."""
+
+    if not context.session.info.get("batching"):
+        return
+
+    for attribute, model in _REFERENCES[type(instance)]:
+        id = instance.__dict__.get(attribute)
+
+        if id is not None:
+            entity_loader(model, context.session).expect([id])
+
+
+for _model in _REFERENCES:
+    db.event.listen(_model, "load", _expect_references)
+
+
+@db.event.listens_for(Session, "do_orm_execute")
+def _load_expected_first(orm_execute_state):
+    """Before lazy loading a user / message, load all those expected.
+
+    The lazy load still runs its own query, so this only pays off when
+    there's more than one to load.
+    """
+
+    if not orm_execute_state.is_relationship_load:
+        return
+
+    loaders = orm_execute_state.session.info.get("loaders", {})
+
+    for mapper in orm_execute_state.all_mappers:
+        loader = loaders.get(mapper.class_)
+
+        if loader is not None:
+            loader.load_expected(at_least=2)
+
+
+@db.event.listens_for(Session, "after_commit")
+@db.event.listens_for(Session, "after_rollback")
+def _discard_loaders(session):
+    session.info.pop("loaders", None)
+
+
+def _delete_in_batches(model, condition, batch_size, after_batch=None):
+    """Delete rows of `model` matching `condition`, `batch_size` at a time.
+
+    `after_batch`, if given, is called with the deleted rows' primary keys
+    before each batch is committed.
+    """
+
+    pk_columns = model.__table__.primary_key.columns
+
+    while True:
+        batch = db.select(*pk_columns).where(condition).limit(batch_size)
+        q = (
+            db.delete(model.__table__)
+            .where(db.tuple_(*pk_columns).in_(batch))
+            .returning(*pk_columns)
+        )
+        deleted = dbx(q).all()
+
+        if after_batch and deleted:
+            after_batch(deleted)
+
+        db.session.commit()
+
+        if len(deleted) < batch_size:
+            return
+
+
+def _uncount_likes(likes):
+    """Take deleted `likes` back out of their messages' like counts."""
+
+    message_ids = [like.message_id for like in likes]
+    dbx(
+        db.update(Message.__table__)
+        .where(Message.id.in_(message_ids))
+        .values(like_count=Message.like_count - 1)
+    )
@@ -0,0 +1,230 @@
+"""Notifications of likes and follows, aggregated in batch.
+
+Liking a message or following a user records a NotificationEvent in the
+same statement. The `collapse-notifications` command (run every minute or
+so) folds those events into each user's inbox: all the likes of a message,
+or all the follows, since the user last read their notifications become a
+single Notification ("alice and 11 others liked your message"), and the
+events are deleted. Events for likes and follows undone since are dropped.
+Collapsers can run at once: each claims its own batches of events.
+
+Inbox pages just read notifications, newest first, a page at a time, and
+every page shows the count of unread ones from the user's row, which the
+collapser keeps up to date.
+
+A like undone and made again after its first event was collapsed is counted
+twice, since only the latest liker is remembered.
+"""
+
+from datetime import datetime
+
+from models import (
+    db, dbx, Follow, Like, Message, Notification, NotificationEvent, User)
+
+NOTIFICATIONS_PER_PAGE = 20
+
+
+def collapse_notifications(batch_size=10_000):
+    """Fold pending events into notifications, `batch_size` events at a
+    time, a transaction per batch; returns how many events were folded."""
+
+    # Whether the like or follow is still there
+    live = db.or_(
+        db.and_(
+            NotificationEvent.kind == "like",
+            db.exists().where(
+                Like.user_id == NotificationEvent.actor_id,
+                Like.message_id == NotificationEvent.message_id,
+            ),
+        ),
+        db.and_(
+            NotificationEvent.kind == "follow",
+            db.exists().where(
+                Follow.user_following_id == NotificationEvent.actor_id,
+                Follow.user_being_followed_id == NotificationEvent.user_id,
+            ),
+        ),
+    )
+
+    folded = 0
+
+    while True:
+        # Claimed until the batch commits: another collapser running at the
+        # same time skips them rather than folding them in twice
+        events = dbx(
+            db.select(NotificationEvent, live.label("live"))
+            .order_by(NotificationEvent.id)
+            .limit(batch_size)
+            .with_for_update(of=NotificationEvent, skip_locked=True)
+        ).all()
+
+        if not events:
+            return folded
+
+        # {(user_id, kind, message_id): {actor_id: created_at}}, each group's
+        # latest actor last
+        groups = {}
+
+        for event, is_live in events:
+            if is_live:
+                actors = groups.setdefault(
+                    (event.user_id, event.kind, event.message_id), {})
+                actors.pop(event.actor_id, None)
+                actors[event.actor_id] = event.created_at
+
+        _fold(groups)
+
+        # Just those read: events committed since may have smaller ids
+        dbx(
+            db.delete(NotificationEvent)
+            .where(NotificationEvent.id.in_(
+                [event.id for event, _is_live in events]))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        folded += len(events)
+
+
+def _fold(groups):
+    """Add each group of actors to its user's unread notification for the
+    same thing, or to a new one.
+
+    The users' rows are locked first, in id order, as `mark_read` does: so
+    their notifications can't be marked read between being found unread
+    here and counted.
+    """
+
+    user_ids = sorted({user_id for user_id, _kind, _message_id in groups})
+    dbx(
+        db.select(User.id)
+        .where(User.id.in_(user_ids))
+        .order_by(User.id)
+        .with_for_update()
+    )
+    unread = {
+        (n.user_id, n.kind, n.message_id): n
+        for n in dbx(
+            db.select(Notification)
+            .where(
+                Notification.user_id.in_(user_ids),
+                Notification.read_at.is_(None),
+            )
+            .with_for_update()
+        ).scalars()
+    }
+    new_unread = {}
+
+    for key, actors in groups.items():
+        last_actor_id, updated_at = list(actors.items())[-1]
+        notification = unread.get(key)
+
+        if notification is None:
+            user_id, kind, message_id = key
+            notification = Notification(
+                user_id=user_id,
+                kind=kind,
+                message_id=message_id,
+                actor_count=0,
+            )
+            db.session.add(notification)
+            new_unread[user_id] = new_unread.get(user_id, 0) + 1
+
+        notification.actor_count += len(actors)
+        notification.last_actor_id = last_actor_id
+        notification.updated_at = updated_at
+
+    if new_unread:
+        dbx(
+            db.update(User.__table__)
+            .where(User.id == db.bindparam("user_id"))
+            .values(
+                unread_notifications=(
+                    User.unread_notifications + db.bindparam("count"))),
+            [
+                {"user_id": user_id, "count": count}
+                for user_id, count in new_unread.items()
+            ],
+        )
+
+
+def select_inbox(user_id, before=None):
+    """Query for a page of `user_id`'s notifications, newest first, with
+    the latest actor's username and the text of the message liked; `before`
+    is (updated_at, id) from the previous page's cursor."""
+
+    actor = db.aliased(User)
+
+    q = (
+        db.select(
+            Notification.id,
+            Notification.kind,
+            Notification.message_id,
+            Notification.actor_count,
+            Notification.updated_at,
+            Notification.read_at,
+            actor.id.label("actor_id"),
+            actor.username.label("actor"),
+            Message.text,
+        )
+        .outerjoin(
+            actor,
+            db.and_(
+                actor.id == Notification.last_actor_id,
+                actor.deleted_at.is_(None),
+            ),
+        )
+        .outerjoin(Message, Message.id == Notification.message_id)
+        .where(Notification.user_id == user_id)
+        .order_by(Notification.updated_at.desc(), Notification.id.desc())
+        .limit(NOTIFICATIONS_PER_PAGE)
+    )
+
+    if before:
+        q = q.where(
+            db.tuple_(Notification.updated_at, Notification.id)
+            < db.tuple_(*before))
+
+    return q
+
+
+def encode_cursor(notification):
+    """Cursor for the notifications after `notification` (a row of
+    `select_inbox`)."""
+
+    return f"{notification.updated_at.isoformat()}_{notification.id}"
+
+
+def decode_cursor(cursor):
+    """(updated_at, id) from a cursor; ValueError if it's malformed."""
+
+    updated_at, _, notification_id = cursor.rpartition("_")
+
+    return datetime.fromisoformat(updated_at), int(notification_id)
+
+
+def mark_read(user_id):
+    """Mark all of `user_id`'s notifications read.
+
+    The user's row is updated, and so locked, first: a collapser folding
+    into their notifications meanwhile either finishes before this marks
+    them read, or waits and finds them read.
+    """
+
+    now = db.func.current_timestamp()
+
+    dbx(
+        db.update(User)
+        .where(User.id == user_id)
+        .values(unread_notifications=0)
+    )
+    dbx(
+        db.update(Notification)
+        .where(
+            Notification.user_id == user_id,
+            Notification.read_at.is_(None),
+        )
+        .values(read_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
@@ -0,0 +1,252 @@
+"""Read-through cache of the results of opt-in queries.
+
+Pages pass queries they're happy to see a few seconds stale through
+`QueryCache.all` (or `scalars`, `one_or_none`) instead of `dbx`. Results are
+kept per worker, keyed by the statement's SQLAlchemy cache key -- what its
+compiled SQL is cached under -- and its parameters, so equal queries share an
+entry however they were built.
+
+Each entry is tagged with the version of every table its query reads. A
+table's version goes up whenever this worker writes to it, by the ORM or by
+Core statements (including INSERT / UPDATE / DELETE in CTEs), and again once
+the write commits; an entry whose tables have moved on is a miss. Writes in
+raw SQL (`db.text`) aren't seen. Other workers' writes show up once an entry
+is older than QUERY_CACHE_TTL seconds.
+
+While a session has written to a table, its queries on that table bypass
+the cache, so it sees its own writes and never caches uncommitted rows.
+
+Only column queries can be cached; rows of ORM entities belong to a session.
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import Table
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.dml import UpdateBase
+
+from models import db, dbx
+
+
+class QueryCache:
+    """Per-worker LRU cache of query results, invalidated by table."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.max_bytes = 0
+        self.ttl = 0
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self._versions = {}
+        self._tables = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_CACHE_ENABLED', False)
+        app.config.setdefault('QUERY_CACHE_MAX_BYTES', 32 * 2**20)
+        app.config.setdefault('QUERY_CACHE_TTL', 30)
+
+        self.enabled = app.config['QUERY_CACHE_ENABLED']
+        self.max_bytes = app.config['QUERY_CACHE_MAX_BYTES']
+        self.ttl = app.config['QUERY_CACHE_TTL']
+
+        db.event.listen(Engine, "after_cursor_execute", self._executed)
+        db.event.listen(Session, "after_begin", self._began)
+        db.event.listen(Session, "after_commit", self._ended)
+        db.event.listen(Session, "after_rollback", self._ended)
+
+    def all(self, q):
+        """The rows of select `q`, from the cache if they're there."""
+
+        if not self.enabled:
+            return dbx(q).all()
+
+        # What SQLAlchemy caches the statement's compiled SQL under; None if
+        # it can't be cached
+        cache_key = q._generate_cache_key()
+        tables = self._tables_read(q, cache_key)
+
+        if cache_key is None or tables & _written(db.session):
+            self.bypasses += 1
+            return dbx(q).all()
+
+        key = (cache_key.key, _hashable(
+            [param.effective_value for param in cache_key.bindparams]))
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and self._fresh(entry):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            # Before running the query, so a write committed while it runs
+            # leaves the entry stale rather than wrong
+            versions = {table: self._versions.get(table, 0)
+                        for table in tables}
+
+        rows = dbx(q).all()
+
+        with self._lock:
+            self._store(key, rows, versions)
+
+        return rows
+
+    def scalars(self, q):
+        """The first column of the rows of `q`."""
+
+        return [row[0] for row in self.all(q)]
+
+    def one_or_none(self, q):
+        """The single row of `q`, or None."""
+
+        rows = self.all(q)
+
+        if len(rows) > 1:
+            raise ValueError("Query returned more than one row")
+
+        return rows[0] if rows else None
+
+    def invalidate(self, tables):
+        """Make entries that read any of `tables` stale."""
+
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Size and hit rate, e.g. for logging."""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _tables_read(self, q, cache_key):
+        """Names of the tables `q` reads; remembered per statement shape."""
+
+        shape = cache_key.key if cache_key is not None else None
+        tables = self._tables.get(shape)
+
+        if tables is None:
+            for desc in q.column_descriptions:
+                if isinstance(desc["type"], type):
+                    raise ValueError(
+                        "Only column queries can be cached, not entities")
+
+            tables = frozenset(
+                element.name for element in visitors.iterate(q)
+                if isinstance(element, Table)
+            )
+
+            if shape is not None:
+                self._tables[shape] = tables
+
+        return tables
+
+    def _fresh(self, entry):
+        _rows, versions, stored_at, _nbytes = entry
+
+        return time.monotonic() - stored_at < self.ttl and all(
+            self._versions.get(table, 0) == version
+            for table, version in versions.items()
+        )
+
+    def _store(self, key, rows, versions):
+        old = self._entries.pop(key, None)
+        if old:
+            self.nbytes -= old[3]
+
+        nbytes = sys.getsizeof(rows) + sum(
+            sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+            for row in rows
+        )
+
+        # One result that would push everything else out isn't worth it
+        if nbytes > self.max_bytes // 4:
+            return
+
+        self._entries[key] = (rows, versions, time.monotonic(), nbytes)
+        self.nbytes += nbytes
+
+        while self.nbytes > self.max_bytes and self._entries:
+            _key, (_rows, _versions, _at, size) = self._entries.popitem(
+                last=False)
+            self.nbytes -= size
+
+    def _executed(self, conn, cursor, statement, parameters, context,
+                  executemany):
+        """Note the tables a statement wrote to, and invalidate them."""
+
+        compiled = context.compiled
+        if compiled is None:
+            return
+
+        written = {
+            cte.element.table.name
+            for cte in getattr(compiled, "ctes", None) or ()
+            if isinstance(cte.element, UpdateBase)
+        }
+
+        if isinstance(compiled.statement, UpdateBase):
+            written.add(compiled.statement.table.name)
+
+        if written:
+            self.invalidate(written)
+            conn.info.setdefault("querycache_written", set()).update(written)
+
+    def _began(self, session, transaction, connection):
+        # Left by a connection used outside any session
+        connection.info.pop("querycache_written", None)
+
+        session.info.setdefault("querycache_connections", []).append(
+            connection)
+
+    def _ended(self, session):
+        """Invalidate what the transaction wrote again, now that other
+        sessions can see it."""
+
+        for connection in session.info.pop("querycache_connections", ()):
+            self.invalidate(connection.info.pop("querycache_written", ()))
+
+
+def _written(session):
+    """Tables `session`'s transaction has written to."""
+
+    return set().union(*(
+        connection.info.get("querycache_written", ())
+        for connection in session.info.get("querycache_connections", ())
+    ))
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+
+    return value
@@ -0,0 +1,177 @@
+"""EXPLAIN checks of the app's core queries, to catch lost indexes.
+
+Each core query is registered with the indexes it should be answered from.
+`check_plans()` asks PostgreSQL how it would run each one and reports those
+whose plan uses none of them, e.g. after an index was dropped or renamed, or
+a query was changed so it can no longer use one.
+
+The plans are made against empty, never analyzed copies of the tables, with
+the same indexes as the real ones (see `copy_tables`). On a small database,
+with statistics, the planner rightly picks whichever plan suits the rows
+there happen to be; without any, its choice comes down to the indexes. And
+sequential scans are switched off while explaining, as on an empty table the
+planner would rightly prefer them: so this checks that a query *can* use its
+index, whatever the amount of data.
+"""
+
+import re
+from datetime import datetime
+
+from models import db, Follow, Like, Message, User
+from notifications import select_inbox
+from readmodels import select_message_cards, select_user_cards
+
+CORE_QUERIES = {}
+
+
+def core_query(*indexes):
+    """Register the decorated function's query as using one of `indexes`."""
+
+    def register(fn):
+        CORE_QUERIES[fn.__name__] = (fn, set(indexes))
+        return fn
+
+    return register
+
+
+@core_query("ix_messages_user_id_timestamp")
+def profile_messages():
+    return (
+        select_message_cards(1)
+        .where(Message.user_id == 1)
+        .where(Message.recent())
+    )
+
+
+@core_query("ix_messages_user_id_timestamp", "ix_messages_timestamp")
+def home_feed():
+    return (
+        select_message_cards(1)
+        .where(Message.user_id.in_([1, 2, 3, 4]))
+        .where(Message.recent())
+        .limit(100)
+    )
+
+
+@core_query("ix_follows_user_following_id")
+def following_page():
+    return (
+        select_user_cards()
+        .join(Follow, Follow.user_being_followed_id == User.id)
+        .where(Follow.user_following_id == 1)
+    )
+
+
+@core_query("follows_pkey")
+def followers_page():
+    return (
+        select_user_cards()
+        .join(Follow, Follow.user_following_id == User.id)
+        .where(Follow.user_being_followed_id == 1)
+    )
+
+
+@core_query("ix_likes_message_id")
+def message_likes():
+    return db.select(Like).where(Like.message_id == 1)
+
+
+@core_query("ix_messages_timestamp")
+def trending_likes():
+    return (
+        db.select(Like.message_id, Like.timestamp)
+        .join(Message, Message.id == Like.message_id)
+        .where(Message.timestamp >= datetime(2024, 1, 1))
+    )
+
+
+@core_query("ix_notifications_user_id_updated_at")
+def notifications_page():
+    return select_inbox(1)
+
+
+def plan_indexes(plan):
+    """Names of the indexes used anywhere in an EXPLAIN (FORMAT JSON) plan."""
+
+    indexes = set()
+    nodes = [plan]
+
+    while nodes:
+        node = nodes.pop()
+        if "Index Name" in node:
+            indexes.add(node["Index Name"])
+        nodes.extend(node.get("Plans", []))
+
+    return indexes
+
+
+def copy_tables(conn):
+    """Shadow the models' tables with empty temporary copies, indexed alike.
+
+    Temporary tables come first in the search path, so queries on the
+    connection read the copies until its transaction ends. The copies'
+    indexes are built from the real tables' definitions and have the same
+    names. Messages' copy is a plain table, so plans use its indexes rather
+    than each partition's.
+    """
+
+    tables = set(db.inspect(conn).get_table_names())
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        name = conn.dialect.identifier_preparer.quote(table.name)
+        conn.exec_driver_sql(
+            f"CREATE TEMPORARY TABLE {name} (LIKE public.{name})"
+            " ON COMMIT DROP")
+
+        indexes = conn.execute(
+            db.text(
+                "SELECT indexdef FROM pg_indexes"
+                " WHERE schemaname = 'public' AND tablename = :name"
+            ),
+            {"name": table.name},
+        ).scalars()
+
+        # Partitioned tables' are "ON ONLY public.messages"
+        for definition in indexes:
+            conn.exec_driver_sql(re.sub(
+                rf" ON (ONLY )?public\.{re.escape(name)} ",
+                f" ON pg_temp.{name} ",
+                definition,
+                count=1,
+            ))
+
+
+def explain(conn, q):
+    """The top plan node of `q`, as EXPLAIN (FORMAT JSON) describes it."""
+
+    compiled = q.compile(
+        dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+
+    result = conn.exec_driver_sql(
+        f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params)
+
+    return result.scalar()[0]["Plan"]
+
+
+def check_plans():
+    """{query name: indexes its plan used} of core queries that don't use
+    their expected indexes. Empty if all is well. PostgreSQL only."""
+
+    problems = {}
+
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        copy_tables(conn)
+
+        for name, (fn, expected) in CORE_QUERIES.items():
+            used = plan_indexes(explain(conn, fn()))
+
+            if not used & expected:
+                problems[name] = used
+
+        conn.rollback()
+
+    return problems
@@ -0,0 +1,180 @@
+"""Token-bucket rate limiting for Warbler's write and auth endpoints.
+
+Every limited endpoint has a bucket per client IP and, for logged-in users,
+one per user. A bucket holds up to `capacity` tokens and refills at `rate`
+tokens a second; each request takes a token, and a request that finds its
+bucket empty gets a 429 with a Retry-After header. Behind reverse proxies,
+set TRUSTED_PROXIES (see app.py) so client IPs aren't all the proxy's.
+
+Limits are set per endpoint in the RATELIMITS config, e.g.:
+
+    app.config['RATELIMITS'] = {'login': '10/minute'}
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request
+from werkzeug.exceptions import TooManyRequests
+
+from models import db
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_limit(limit):
+    """Turn a limit like "10/minute" into (capacity, tokens per second)."""
+
+    count, period = limit.split("/")
+    count = int(count)
+
+    return count, count / PERIODS[period.strip()]
+
+
+class MemoryRateLimitBackend:
+    """Buckets in a dict. Per process, so each worker limits separately.
+
+    Holds at most `max_keys` buckets; the least recently used are dropped,
+    which only ever errs on the side of letting a request through.
+    """
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, capacity, rate, now=None):
+        """Take a token from bucket `key`.
+
+        Returns (allowed, seconds until a token is available).
+        """
+
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+# Written out by hand because SQLAlchemy doesn't cache compiled ON CONFLICT DO
+# UPDATE statements, and compiling this one cost as much as running it. The
+# syntax is the same on PostgreSQL and SQLite.
+_REFILLED = (
+    "CASE WHEN rate_limits.tokens + (:now - rate_limits.updated_at) * :rate"
+    " > :capacity THEN :capacity"
+    " ELSE rate_limits.tokens + (:now - rate_limits.updated_at) * :rate END"
+)
+
+_HIT = db.text(f"""
+    INSERT INTO rate_limits (key, tokens, updated_at, allowed)
+    VALUES (:key, :capacity - 1, :now, true)
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = CASE WHEN {_REFILLED} >= 1
+            THEN {_REFILLED} - 1 ELSE {_REFILLED} END,
+        allowed = {_REFILLED} >= 1,
+        updated_at = :now
+    RETURNING tokens, allowed
+""").columns(tokens=db.Float, allowed=db.Boolean)
+
+
+class DatabaseRateLimitBackend:
+    """Buckets in the `rate_limits` table, shared by all workers.
+
+    A hit is one upsert that refills, takes a token and reports the result,
+    so concurrent workers can't both spend the last token.
+    """
+
+    def hit(self, key, capacity, rate, now=None):
+        """Take a token from bucket `key`.
+
+        Returns (allowed, seconds until a token is available).
+        """
+
+        now = time.time() if now is None else now
+
+        with db.engine.begin() as conn:
+            # Losing the last few hits in a crash is harmless, so don't wait
+            # for the commit to reach disk
+            if conn.dialect.name == "postgresql":
+                conn.exec_driver_sql("SET LOCAL synchronous_commit TO OFF")
+
+            tokens, allowed = conn.execute(_HIT, {
+                "key": key,
+                "capacity": float(capacity),
+                "rate": float(rate),
+                "now": float(now),
+            }).one()
+
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+RATELIMIT_BACKENDS = {
+    "memory": MemoryRateLimitBackend,
+    "database": DatabaseRateLimitBackend,
+}
+
+
+class RateLimiter:
+    """Applies the RATELIMITS config to views decorated with `limit`."""
+
+    def __init__(self, app=None):
+        self.backend = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_BACKEND', 'memory')
+        app.config.setdefault('RATELIMITS', {})
+
+        self.backend = RATELIMIT_BACKENDS[app.config['RATELIMIT_BACKEND']]()
+
+    def check(self, endpoint):
+        """Take a token for this request, raising a 429 if there isn't one."""
+
+        limit = current_app.config['RATELIMITS'].get(endpoint)
+
+        if not limit or not current_app.config['RATELIMIT_ENABLED']:
+            return
+
+        capacity, rate = parse_limit(limit)
+        keys = [f"{endpoint}:ip:{request.remote_addr}"]
+
+        if g.get("user"):
+            keys.append(f"{endpoint}:user:{g.user.id}")
+
+        for key in keys:
+            allowed, retry_after = self.backend.hit(key, capacity, rate)
+
+            if not allowed:
+                raise TooManyRequests(retry_after=math.ceil(retry_after))
+
+    def limit(self, methods=("POST",)):
+        """Decorate a view to rate limit its `methods` requests."""
+
+        def decorator(view):
+            @wraps(view)
+            def limited_view(*args, **kwargs):
+                if request.method in methods:
+                    self.check(request.endpoint)
+
+                return view(*args, **kwargs)
+
+            return limited_view
+
+        return decorator
@@ -0,0 +1,163 @@
+"""Read-only views of users and messages for list and feed pages.
+
+A card on a list page shows a handful of columns and never changes them.
+Loading full User / Message entities for cards fetches every column (password
+hashes included), registers each object in the session's identity map, and
+lazily loads authors and likes card by card. Instead these queries select
+just the columns cards show, in one query, and rows come back as named
+tuples that the ORM doesn't track.
+
+Templates read cards the same way as entities (`user.username`,
+`message.user.image_url`, `message.is_liked_by_user(...)`), so a card
+template works with either.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy.orm import aliased
+
+from models import db, Follow, Like, Message, User
+
+USER_CARD_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+)
+
+
+class UserCard(namedtuple("UserCard", [c.key for c in USER_CARD_COLUMNS])):
+    """What a user card shows."""
+
+    __slots__ = ()
+
+    # Cards are only made for active users
+    deleted_at = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """UserCards of rows from `select_user_cards`."""
+
+        return map(cls._make, rows)
+
+
+class UserDetail(namedtuple("UserDetail", [
+    *UserCard._fields,
+    "location", "num_messages", "num_following", "num_followers", "num_likes",
+])):
+    """What a profile, or the home page's sidebar, shows of a user."""
+
+    __slots__ = ()
+
+    deleted_at = None
+
+
+class Viewer(namedtuple("Viewer", [*UserDetail._fields, "following_ids"])):
+    """The logged-in user, as templates use `g.user`.
+
+    `following_ids` is a set of the ids of everyone they follow.
+    """
+
+    __slots__ = ()
+
+    deleted_at = None
+
+    def is_following(self, other_user):
+        return other_user.id in self.following_ids
+
+
+class MessageCard(namedtuple("MessageCard", [
+    "id", "text", "timestamp", "user_id", "like_count", "liked", "user",
+])):
+    """What a message card shows; `liked` is whether the viewer likes it."""
+
+    __slots__ = ()
+
+    def is_liked_by_user(self, user_id):
+        """Does the viewer like this message? Only knows about the viewer."""
+
+        return self.liked
+
+    @classmethod
+    def from_rows(cls, rows):
+        """MessageCards of rows from `select_message_cards`.
+
+        Messages by the same author share one UserCard.
+        """
+
+        authors = {}
+
+        for row in rows:
+            author = authors.get(row.user_id)
+
+            if author is None:
+                author = authors[row.user_id] = UserCard._make(row[6:])
+
+            yield cls(*row[:6], author)
+
+
+def select_user_cards():
+    """Select of active users' card columns, to narrow down and order."""
+
+    return db.select(*USER_CARD_COLUMNS).where(User.deleted_at.is_(None))
+
+
+def select_user_detail(user_id):
+    """Select of an active user's UserDetail columns."""
+
+    other = aliased(User)
+
+    def count(q):
+        return q.with_only_columns(db.func.count()).scalar_subquery()
+
+    # Counts leave out deleted users, like the User.num_* properties
+    num_following = count(
+        db.select(Follow)
+        .join(other, other.id == Follow.user_being_followed_id)
+        .where(Follow.user_following_id == User.id)
+        .where(other.deleted_at.is_(None))
+    )
+    num_followers = count(
+        db.select(Follow)
+        .join(other, other.id == Follow.user_following_id)
+        .where(Follow.user_being_followed_id == User.id)
+        .where(other.deleted_at.is_(None))
+    )
+    num_likes = count(
+        db.select(Like)
+        .join(Message, Message.id == Like.message_id)
+        .join(other, other.id == Message.user_id)
+        .where(Like.user_id == User.id, other.deleted_at.is_(None))
+    )
+
+    return select_user_cards().add_columns(
+        User.location,
+        count(db.select(Message).where(Message.user_id == User.id)),
+        num_following,
+        num_followers,
+        num_likes,
+    ).where(User.id == user_id)
+
+
+def select_message_cards(viewer_id):
+    """Select of card columns of active users' messages, as `viewer_id`
+    sees them, newest first."""
+
+    liked = db.exists().where(
+        Like.message_id == Message.id, Like.user_id == viewer_id)
+
+    return (
+        db.select(
+            Message.id,
+            Message.text,
+            Message.timestamp,
+            Message.user_id,
+            Message.like_count,
+            liked.label("liked"),
+            *USER_CARD_COLUMNS,
+        )
+        .join(Message.user)
+        .where(User.deleted_at.is_(None))
+        .order_by(Message.timestamp.desc())
+    )
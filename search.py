@@ -0,0 +1,248 @@
+"""Full-text search over messages.
+
+On PostgreSQL, searches use a GIN index over the messages' tsvector, which
+the database keeps up to date as messages come and go. Other databases (e.g.
+SQLite for local development) get an inverted index held in memory: built
+from the messages table on the first search, then updated as messages are
+added and deleted through the ORM.
+
+Results are ranked best match first and paged with a cursor (the rank and id
+of the last result) rather than an offset, so deep pages cost the same as
+the first.
+"""
+
+import heapq
+import math
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy.orm import object_session
+
+from models import (
+    db, dbx, on_commit, Message, User, MESSAGE_TSVECTOR, SEARCH_CONFIG)
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Split text into lowercase search terms."""
+
+    return TOKEN_RE.findall(text.lower())
+
+
+def encode_cursor(rank, message_id):
+    """Cursor for the results after the one with `rank` and `message_id`."""
+
+    return f"{rank!r}_{message_id}"
+
+
+def decode_cursor(cursor):
+    """(rank, message_id) from a cursor; ValueError if it's malformed."""
+
+    rank, _, message_id = cursor.rpartition("_")
+
+    return float(rank), int(message_id)
+
+
+class MemorySearchIndex:
+    """Inverted index of message text in a dict. Per process.
+
+    All the query's terms must match; results are ranked by TF-IDF.
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._terms = {}
+        self._built = False
+        self._lock = threading.Lock()
+
+    def add(self, message_id, text):
+        with self._lock:
+            if not self._built:
+                return
+
+            self._add(message_id, text)
+
+    def _add(self, message_id, text):
+        terms = tokenize(text)
+        self._terms[message_id] = set(terms)
+
+        for term in terms:
+            postings = self._postings[term]
+            postings[message_id] = postings.get(message_id, 0) + 1
+
+    def remove(self, message_id):
+        with self._lock:
+            for term in self._terms.pop(message_id, ()):
+                postings = self._postings[term]
+                postings.pop(message_id, None)
+
+                if not postings:
+                    del self._postings[term]
+
+    def rebuild(self):
+        """Index every message from scratch; returns how many there are."""
+
+        q = db.select(Message.id, Message.text).execution_options(
+            yield_per=1000)
+
+        with self._lock:
+            self._postings.clear()
+            self._terms.clear()
+
+            for message_id, text in dbx(q):
+                self._add(message_id, text)
+
+            self._built = True
+
+            return len(self._terms)
+
+    def search(self, text, limit, after=None):
+        """Best `limit` (rank, message_id) matches, after cursor `after`."""
+
+        if not self._built:
+            self.rebuild()
+
+        with self._lock:
+            postings = sorted(
+                (self._postings.get(term, {}) for term in set(tokenize(text))),
+                key=len,
+            )
+
+            if not postings or not postings[0]:
+                return []
+
+            total = len(self._terms)
+            weights = [math.log(1 + total / len(p)) for p in postings]
+            hits = (
+                (sum(p[message_id] * w for p, w in zip(postings, weights)),
+                 message_id)
+                for message_id in set(postings[0]).intersection(*postings[1:])
+            )
+
+            if after:
+                hits = (hit for hit in hits if hit < after)
+
+            return heapq.nlargest(limit, hits)
+
+
+class DatabaseSearchIndex:
+    """PostgreSQL full-text search over the GIN-indexed message tsvector.
+
+    Queries use websearch_to_tsquery, so quoted phrases, "or" and -excluded
+    words work; results are ranked by ts_rank.
+    """
+
+    def add(self, message_id, text):
+        """Nothing to do: the database maintains the index."""
+
+    def remove(self, message_id):
+        """Nothing to do: the database maintains the index."""
+
+    def rebuild(self):
+        """Rebuild the GIN index; returns how many messages there are."""
+
+        dbx(db.text("REINDEX INDEX ix_messages_text_search"))
+        db.session.commit()
+
+        return dbx(db.select(db.func.count(Message.id))).scalar()
+
+    def search(self, text, limit, after=None):
+        """Best `limit` (rank, message_id) matches, after cursor `after`."""
+
+        query = db.func.websearch_to_tsquery(
+            db.text(f"'{SEARCH_CONFIG}'::regconfig"), text)
+        rank = db.cast(db.func.ts_rank(MESSAGE_TSVECTOR, query), db.Float)
+
+        q = (
+            db.select(rank, Message.id)
+            .join(Message.user)
+            .where(
+                MESSAGE_TSVECTOR.bool_op("@@")(query),
+                User.deleted_at.is_(None),
+            )
+            .order_by(rank.desc(), Message.id.desc())
+            .limit(limit)
+        )
+
+        if after:
+            q = q.where(db.tuple_(rank, Message.id) < db.tuple_(*after))
+
+        return [tuple(hit) for hit in dbx(q)]
+
+
+SEARCH_INDEXES = {
+    "memory": MemorySearchIndex,
+    "database": DatabaseSearchIndex,
+}
+
+
+class MessageSearch:
+    """Searches messages with the index chosen by SEARCH_BACKEND.
+
+    With no backend configured, PostgreSQL databases use their own full-text
+    index and anything else the memory one.
+    """
+
+    def __init__(self, app=None):
+        self.index = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_BACKEND', None)
+        app.config.setdefault('SEARCH_PAGE_SIZE', 20)
+
+        backend = app.config['SEARCH_BACKEND']
+
+        if not backend:
+            uri = app.config['SQLALCHEMY_DATABASE_URI']
+            backend = "database" if uri.startswith("postgresql") else "memory"
+
+        self.index = SEARCH_INDEXES[backend]()
+        self.page_size = app.config['SEARCH_PAGE_SIZE']
+
+        db.event.listen(Message, "after_insert", self._message_added)
+        db.event.listen(Message, "after_delete", self._message_deleted)
+
+    def _message_added(self, mapper, connection, message):
+        on_commit(
+            object_session(message), self.index.add, message.id, message.text)
+
+    def _message_deleted(self, mapper, connection, message):
+        on_commit(object_session(message), self.index.remove, message.id)
+
+    def search(self, text, after=None):
+        """A page of messages matching `text`, and the next page's cursor.
+
+        `after` is a cursor from a previous page (ValueError if malformed).
+        The next cursor is None on the last page.
+        """
+
+        hits = self.index.search(
+            text,
+            limit=self.page_size,
+            after=decode_cursor(after) if after else None,
+        )
+
+        # The memory index doesn't know about bulk deletes or deleted users
+        q = (
+            db.select(Message)
+            .join(Message.user)
+            .where(
+                Message.id.in_([message_id for _rank, message_id in hits]),
+                User.deleted_at.is_(None),
+            )
+        )
+        found = {message.id: message for message in dbx(q).scalars()}
+
+        messages = [
+            found[message_id] for _rank, message_id in hits
+            if message_id in found
+        ]
+        next_cursor = (
+            encode_cursor(*hits[-1]) if len(hits) == self.page_size else None)
+
+        return messages, next_cursor
@@ -2,12 +2,13 @@
 
 from csv import DictReader
 from app import app
+from migrations import upgrade
 from models import db, User, Message, Follow
 
 app.app_context().push()
 
 db.drop_all()
-db.create_all()
+upgrade()
 
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
@@ -0,0 +1,260 @@
+"""Server-side sessions for Warbler.
+
+The session cookie only carries a short random id; the session itself lives
+in a store (a database table, or a dict for local development). The store is
+only read when the session is actually used, so requests that never touch
+it -- anonymous visitors without a cookie, static files -- cost nothing.
+"""
+
+import secrets
+import threading
+import time
+from datetime import datetime
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from models import db, dialect_insert, ServerSession
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session whose contents are loaded from the store on first use."""
+
+    def __init__(self, sid=None, loader=None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(None, on_update)
+        self.sid = sid
+        self.old_sid = None
+        self.modified = False
+        self.accessed = False
+        self._loader = loader
+
+    @property
+    def loaded(self):
+        """Whether the store has been read (or didn't need to be)."""
+
+        return self._loader is None
+
+    def load(self):
+        """Read this session's data from the store, if not done yet."""
+
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            dict.update(self, loader() or {})
+            self.accessed = True
+
+    def fill(self, data):
+        """Use `data`, read from the store elsewhere, as the contents."""
+
+        self._loader = None
+        dict.update(self, data or {})
+        self.accessed = True
+
+    def regenerate(self):
+        """Move this session to a fresh id, e.g. on login."""
+
+        self.load()
+        self.old_sid = self.old_sid or self.sid
+        self.sid = None
+        self.modified = True
+
+
+def _loads_first(name):
+    def method(self, *args, **kwargs):
+        self.load()
+        return getattr(super(ServerSideSession, self), name)(*args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+for _name in (
+    "__getitem__", "__setitem__", "__delitem__", "__contains__", "__iter__",
+    "__len__", "__eq__", "__repr__", "get", "setdefault", "pop", "popitem",
+    "update", "clear", "keys", "values", "items", "copy",
+):
+    setattr(ServerSideSession, _name, _loads_first(_name))
+
+
+class MemorySessionStore:
+    """Sessions in a dict. Per process, so only for development/tests."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        data, expires_at = self._sessions.get(sid, (None, None))
+
+        if data is None or expires_at < datetime.now():
+            return None
+
+        return data
+
+    def save(self, sid, data, expires_at):
+        with self._lock:
+            self._sessions[sid] = (data, expires_at)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def purge_expired(self, batch_size=1000):
+        """Delete expired sessions, `batch_size` at a time."""
+
+        now = datetime.now()
+        purged = 0
+
+        with self._lock:
+            expired = [
+                sid for sid, (_data, expires_at) in self._sessions.items()
+                if expires_at < now
+            ]
+
+        for start in range(0, len(expired), batch_size):
+            with self._lock:
+                for sid in expired[start:start + batch_size]:
+                    self._sessions.pop(sid, None)
+            purged += len(expired[start:start + batch_size])
+
+        return purged
+
+
+class DatabaseSessionStore:
+    """Sessions in the `sessions` table, shared by all workers.
+
+    Uses its own short transactions, so saving a session never commits (or
+    rolls back) whatever the request did in `db.session`.
+    """
+
+    @staticmethod
+    def select_data(sid):
+        """Select of the stored data of unexpired session `sid`."""
+
+        return db.select(ServerSession.data).where(
+            ServerSession.id == sid,
+            ServerSession.expires_at >= datetime.now(),
+        )
+
+    def load(self, sid):
+        with db.engine.connect() as conn:
+            return conn.execute(self.select_data(sid)).scalar()
+
+    def save(self, sid, data, expires_at):
+        with db.engine.begin() as conn:
+            insert = dialect_insert(ServerSession, conn.dialect.name).values(
+                id=sid, data=data, expires_at=expires_at)
+            conn.execute(insert.on_conflict_do_update(
+                index_elements=[ServerSession.id],
+                set_={
+                    "data": insert.excluded.data,
+                    "expires_at": insert.excluded.expires_at,
+                },
+            ))
+
+    def delete(self, sid):
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.delete(ServerSession.__table__).filter_by(id=sid))
+
+    def purge_expired(self, batch_size=1000):
+        """Delete expired sessions, a transaction per `batch_size` rows."""
+
+        purged = 0
+
+        while True:
+            batch = (
+                db.select(ServerSession.id)
+                .where(ServerSession.expires_at < datetime.now())
+                .limit(batch_size)
+            )
+
+            with db.engine.begin() as conn:
+                deleted = conn.execute(
+                    db.delete(ServerSession.__table__)
+                    .where(ServerSession.id.in_(batch))
+                ).rowcount
+
+            purged += deleted
+
+            if deleted < batch_size:
+                return purged
+
+
+SESSION_STORES = {
+    "memory": MemorySessionStore,
+    "database": DatabaseSessionStore,
+}
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps sessions in `store`; the cookie holds an opaque session id."""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+
+    def _loader(self, sid):
+        def load():
+            start = time.perf_counter()
+            data = self.store.load(sid)
+            self.lookups += 1
+            self.lookup_seconds += time.perf_counter() - start
+
+            return self.serializer.loads(data) if data else None
+
+        return load
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+
+        if not sid:
+            return ServerSideSession()
+
+        return ServerSideSession(sid, loader=self._loader(sid))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.old_sid:
+            self.store.delete(session.old_sid)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session.loaded or not session.modified:
+            return
+
+        if not session:
+            if session.sid:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        expires = self.get_expiration_time(app, session)
+        stored_until = datetime.now() + app.permanent_session_lifetime
+        is_new = session.sid is None
+        sid = session.sid or secrets.token_urlsafe(18)
+
+        self.store.save(sid, self.serializer.dumps(dict(session)), stored_until)
+
+        if is_new or session.permanent:
+            response.set_cookie(
+                name,
+                sid,
+                expires=expires,
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
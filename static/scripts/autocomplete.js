@@ -0,0 +1,34 @@
+// Suggest usernames in the nav search box as the user types.
+
+const search = document.getElementById("search");
+const suggestions = document.getElementById("search-suggestions");
+let pending = null;
+
+search.addEventListener("input", async () => {
+  const prefix = search.value.trim();
+
+  if (pending) pending.abort();
+
+  if (!prefix) {
+    suggestions.replaceChildren();
+    return;
+  }
+
+  pending = new AbortController();
+
+  try {
+    const resp = await fetch(
+      `/users/autocomplete?q=${encodeURIComponent(prefix)}`,
+      { signal: pending.signal },
+    );
+    const users = await resp.json();
+
+    suggestions.replaceChildren(...users.map(user => {
+      const option = document.createElement("option");
+      option.value = user.username;
+      return option;
+    }));
+  } catch (err) {
+    if (err.name !== "AbortError") throw err;
+  }
+});
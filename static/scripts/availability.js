@@ -0,0 +1,38 @@
+// Tell the user a username or e-mail is taken as soon as they've typed it,
+// rather than after submitting the signup form.
+
+for (const field of ["username", "email"]) {
+  const input = document.getElementById(field);
+  let pending = null;
+
+  input.addEventListener("change", async () => {
+    const value = input.value.trim();
+
+    if (pending) pending.abort();
+    input.setCustomValidity("");
+
+    if (!value) return;
+
+    pending = new AbortController();
+
+    try {
+      const resp = await fetch(
+        `/signup/availability?${field}=${encodeURIComponent(value)}`,
+        { signal: pending.signal },
+      );
+      if (!resp.ok) return;
+
+      const available = await resp.json();
+
+      if (available[field] === false) {
+        input.setCustomValidity(
+          field === "username"
+            ? "Username already taken"
+            : "E-mail already in use");
+        input.reportValidity();
+      }
+    } catch (err) {
+      if (err.name !== "AbortError") throw err;
+    }
+  });
+}
@@ -0,0 +1,39 @@
+// Add messages to the top of the home timeline as they're posted.
+
+const timeline = document.getElementById("messages");
+const template = document.getElementById("message-template");
+const viewerId = Number(timeline.dataset.userId);
+
+// Start after the newest message shown, so none posted since are missed
+const newest = timeline.querySelector("li[data-id]");
+const after = newest ? newest.dataset.id : "";
+const events = new EventSource(`/timeline/events?after=${after}`);
+
+events.addEventListener("message", event => {
+  const message = JSON.parse(event.data);
+
+  if (timeline.querySelector(`li[data-id="${message.id}"]`)) return;
+
+  const item = template.content.firstElementChild.cloneNode(true);
+  const author = `/users/${message.user.id}`;
+
+  item.dataset.id = message.id;
+  item.querySelector(".message-link").href = `/messages/${message.id}`;
+  item.querySelector(".message-author-image").href = author;
+  item.querySelector(".timeline-image").src = message.user.image_url;
+  item.querySelector(".message-author").href = author;
+  item.querySelector(".message-author").textContent =
+    `@${message.user.username}`;
+  item.querySelector(".text-muted").textContent = message.date;
+  item.querySelector("p").textContent = message.text;
+  item.querySelector("form").action = `/messages/${message.id}/like`;
+
+  // Only others' messages can be liked
+  if (message.user.id === viewerId) {
+    item.querySelector("form").remove();
+  } else {
+    item.querySelector(".btn.disabled").remove();
+  }
+
+  timeline.prepend(item);
+});
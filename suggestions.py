@@ -0,0 +1,108 @@
+"""Who-to-follow suggestions, computed in batch.
+
+A user is suggested the accounts followed by the people they follow
+("friends of friends"), scored by how many of those people follow the account
+and boosted if the account has posted recently:
+
+    score = mutuals * (1 + 2^(-days since last message / half-life))
+
+Suggestions are stored in the follow_suggestions table by the
+`refresh-suggestions` command, so pages just read them. Follows and unfollows
+mark the follower in follow_changes; a refresh recomputes only those users
+and their followers, whose friends-of-friends are the ones that can change.
+"""
+
+import heapq
+from datetime import timedelta
+
+from graph import FollowGraph
+from models import db, dbx, FollowChange, FollowSuggestion, Message
+
+SUGGESTIONS_PER_USER = 10
+ACTIVITY_HALF_LIFE = timedelta(days=7)
+
+
+def activity_boosts(now, half_life=ACTIVITY_HALF_LIFE):
+    """{user_id: boost} of users who have posted, from their latest post."""
+
+    q = db.select(Message.user_id, db.func.max(Message.timestamp)).group_by(
+        Message.user_id)
+
+    return {
+        user_id: 0.5 ** ((now - latest) / half_life)
+        for user_id, latest in dbx(q)
+    }
+
+
+def suggest(graph, node, boosts, limit=SUGGESTIONS_PER_USER):
+    """Top `limit` (score, node) suggestions for `node` in `graph`."""
+
+    mutuals = graph.friends_of_friends(node)
+
+    return heapq.nlargest(
+        limit,
+        (
+            (count * (1 + boosts.get(graph.user_id(candidate), 0)), candidate)
+            for candidate, count in mutuals.items()
+        ),
+    )
+
+
+def refresh_suggestions(full=False, batch_size=1000):
+    """Recompute stored suggestions; returns how many users were refreshed.
+
+    Only users affected by follow changes since the last refresh are
+    recomputed, unless `full`. Users are written `batch_size` at a time, a
+    transaction per batch.
+    """
+
+    # Database clock, as naive wall time to match the stored timestamps
+    now = dbx(db.select(db.func.current_timestamp(type_=db.DateTime)))
+    now = now.scalar().replace(tzinfo=None)
+
+    changed = dbx(
+        db.select(FollowChange.user_id).where(FollowChange.changed_at <= now)
+    ).scalars().all()
+
+    graph = FollowGraph.load()
+    boosts = activity_boosts(now)
+
+    if full:
+        nodes = range(len(graph))
+
+    else:
+        nodes = set()
+        for user_id in changed:
+            node = graph.node(user_id)
+            if node is not None:
+                nodes.add(node)
+                nodes.update(graph.followers(node))
+        nodes = sorted(nodes)
+
+    for start in range(0, len(nodes), batch_size):
+        batch = nodes[start:start + batch_size]
+        user_ids = [graph.user_id(node) for node in batch]
+
+        dbx(db.delete(FollowSuggestion).where(
+            FollowSuggestion.user_id.in_(user_ids)))
+
+        rows = [
+            {
+                "user_id": graph.user_id(node),
+                "suggested_user_id": graph.user_id(candidate),
+                "score": score,
+            }
+            for node in batch
+            for score, candidate in suggest(graph, node, boosts)
+        ]
+        if rows:
+            dbx(db.insert(FollowSuggestion), rows)
+
+        db.session.commit()
+
+    # Follows changed since `now` stay marked for the next refresh
+    dbx(db.delete(FollowChange).where(
+        FollowChange.user_id.in_(changed), FollowChange.changed_at <= now))
+    db.session.commit()
+
+    return len(nodes)
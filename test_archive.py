@@ -0,0 +1,156 @@
+"""Message partition and archive tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from app import app, CURR_USER_KEY
+from archive import add_partitions, archive_messages, message_partitions
+from models import db, dbx, Message, MessageArchive, User
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+POSTGRESQL = app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgresql")
+
+# Partitions of a handful of ids, rather than a million
+SIZE = 10
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        with patch("models.MESSAGE_PARTITION_SIZE", SIZE):
+            db.drop_all()
+            db.create_all()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        # 15 messages from two years ago, then 10 from today
+        old = datetime.now() - timedelta(days=730)
+        self.ids = [
+            self.post(f"old {i}", old + timedelta(minutes=i))
+            for i in range(15)
+        ] + [self.post(f"new {i}") for i in range(10)]
+
+    def tearDown(self):
+        # Ids start again from 1 in the new tables
+        db.session.remove()
+
+        # Back to full-size partitions for the other tests
+        db.drop_all()
+        db.create_all()
+
+    def post(self, text, timestamp=None):
+        if POSTGRESQL:
+            add_partitions(SIZE)
+
+        message = Message(text=text, user_id=self.user_id)
+        if timestamp:
+            message.timestamp = timestamp
+
+        db.session.add(message)
+        db.session.commit()
+
+        return message.id
+
+    def recent_texts(self):
+        q = (
+            db.select(Message.text)
+            .where(Message.user_id == self.user_id, Message.recent())
+            .order_by(Message.id)
+        )
+        return dbx(q).scalars().all()
+
+    @skipUnless(POSTGRESQL, "Partitions need PostgreSQL")
+    def test_add_partitions(self):
+        partitions = message_partitions()
+
+        self.assertEqual(
+            [(p.start, p.end) for p in partitions],
+            [(None, 10), (10, 20), (20, 30), (30, 40)])
+
+        # Room for SIZE more messages already
+        self.assertEqual(add_partitions(SIZE), [])
+
+        in_default = dbx(db.text("SELECT count(*) FROM messages_default"))
+        self.assertEqual(in_default.scalar(), 0)
+
+    def test_archive(self):
+        archive = archive_messages(timedelta(days=365), size=SIZE)
+
+        if POSTGRESQL:
+            # Whole partitions only: ids 10 - 19 share one, old and new
+            self.assertEqual(archive.before_id, 10)
+        else:
+            self.assertEqual(archive.before_id, self.ids[15])
+
+        texts = self.recent_texts()
+        self.assertNotIn("old 0", texts)
+        self.assertIn("new 0", texts)
+
+        # Nothing more to archive
+        self.assertIsNone(
+            archive_messages(timedelta(days=365), size=SIZE))
+        self.assertEqual(
+            dbx(db.select(db.func.count(MessageArchive.id))).scalar(), 1)
+
+    def test_archived_still_shown(self):
+        archive_messages(timedelta(days=365), size=SIZE)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertNotIn("old 0<", resp.get_data(as_text=True))
+            self.assertIn("new 0<", resp.get_data(as_text=True))
+
+            resp = c.get(f"/messages/{self.ids[0]}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("old 0", resp.get_data(as_text=True))
+
+    @skipUnless(POSTGRESQL, "Partitions need PostgreSQL")
+    def test_archived_partitions_not_read(self):
+        archive_messages(timedelta(days=365), size=SIZE)
+
+        q = (
+            db.select(Message.id)
+            .where(Message.user_id == self.user_id, Message.recent())
+            .order_by(Message.timestamp.desc())
+        )
+        compiled = q.compile(
+            dialect=db.engine.dialect,
+            compile_kwargs={"literal_binds": True})
+        plan = "\n".join(dbx(db.text(
+            f"EXPLAIN (ANALYZE, COSTS OFF, TIMING OFF) {compiled}"
+        )).scalars())
+
+        archived = [
+            line for line in plan.splitlines()
+            if "on messages_p0 " in line
+        ]
+        self.assertTrue(archived)
+        self.assertTrue(all("never executed" in line for line in archived))
@@ -0,0 +1,172 @@
+"""ASGI serving mode tests."""
+
+import asyncio
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, dbx, Message, User, Like
+import asgi
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+def get(path, sid=None, method="GET"):
+    """(status, body) of a request to the ASGI app."""
+
+    headers = [(b"host", b"localhost")]
+    if sid:
+        headers.append((b"cookie", f"session={sid}".encode()))
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "headers": headers,
+        "http_version": "1.1",
+        "scheme": "http",
+        "server": ("localhost", 80),
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        await asgi.application(scope, receive, send)
+        # Connections belong to this event loop, which is about to close
+        await asgi.engine.dispose()
+
+    asyncio.run(run())
+
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return sent[0]["status"], body.decode()
+
+
+class ASGITestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="hello from u2", user_id=u2.id)
+        m2 = Message(text="hello from u3", user_id=u3.id)
+        db.session.add_all([m1, m2])
+        db.session.flush()
+
+        u1.follow(u2.id)
+        u3.follow(u1.id)
+        db.session.add(Like(user_id=u1.id, message_id=m1.id))
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.u3_id = u1.id, u2.id, u3.id
+
+        self.sid = "test-session"
+        self.save_session({CURR_USER_KEY: u1.id, "csrf_token": "token"})
+
+    def tearDown(self):
+        app.session_interface.store.delete(self.sid)
+        db.session.rollback()
+
+    def save_session(self, data):
+        interface = app.session_interface
+        interface.store.save(
+            self.sid,
+            interface.serializer.dumps(data),
+            datetime.now() + timedelta(hours=1),
+        )
+
+    def test_home(self):
+        lookups = app.session_interface.lookups
+
+        status, html = get("/", self.sid)
+
+        self.assertEqual(status, 200)
+        self.assertIn("hello from u2", html)
+        self.assertNotIn("hello from u3", html)
+        self.assertIn("bi-star-fill", html)
+        self.assertIn(f'href="/users/{self.u1_id}/following"', html)
+
+        # Served without the Flask app reading the session
+        self.assertEqual(app.session_interface.lookups, lookups)
+
+    def test_follow_lists(self):
+        status, html = get(f"/users/{self.u1_id}/followers", self.sid)
+
+        self.assertEqual(status, 200)
+        self.assertIn("@u3", html)
+        self.assertIn(f'action="/users/follow/{self.u3_id}"', html)
+
+        status, html = get(f"/users/{self.u1_id}/following", self.sid)
+
+        self.assertIn("@u2", html)
+        self.assertIn(f'action="/users/stop-following/{self.u2_id}"', html)
+
+    def test_falls_back_to_flask(self):
+        lookups = app.session_interface.lookups
+
+        # Logged out
+        status, html = get("/")
+        self.assertEqual(status, 200)
+        self.assertIn("Sign up", html)
+
+        # No such user: Flask's 404
+        status, _html = get("/users/0/followers", self.sid)
+        self.assertEqual(status, 404)
+
+        # Other pages
+        status, html = get(f"/users/{self.u2_id}", self.sid)
+        self.assertEqual(status, 200)
+        self.assertIn("hello from u2", html)
+
+        # Flashed messages are shown (and cleared) by Flask
+        self.save_session({
+            CURR_USER_KEY: self.u1_id,
+            "csrf_token": "token",
+            "_flashes": [("success", "Hello, u1!")],
+        })
+        status, html = get("/", self.sid)
+        self.assertIn("Hello, u1!", html)
+        self.assertIn("hello from u2", html)
+
+        self.assertGreater(app.session_interface.lookups, lookups)
+
+    def test_create_engine(self):
+        engine = asgi.create_engine("postgresql:///warbler_test")
+        self.assertEqual(engine.url.drivername, "postgresql+asyncpg")
+        self.assertEqual(
+            engine.pool.size(), app.config['ASYNC_DB_POOL_SIZE'])
+
+        # SQLite engines don't take a pool size
+        engine = asgi.create_engine("sqlite:///warbler.db")
+        self.assertEqual(engine.url.drivername, "sqlite+aiosqlite")
@@ -0,0 +1,138 @@
+"""Username autocomplete tests."""
+
+import os
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY, usernames
+from autocomplete import UsernameIndex
+from models import db, dbx, User
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class AutocompleteTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("alice", "alice@email.com", "password", None)
+        u2 = User.signup("Alfred", "alfred@email.com", "password", None)
+        u3 = User.signup("bob", "bob@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+
+        usernames.index.rebuild()
+
+    def complete(self, prefix):
+        return [username for _id, username in usernames.index.complete(
+            prefix, limit=10)]
+
+    def test_index(self):
+        index = UsernameIndex()
+        index.rebuild()
+
+        self.assertEqual(
+            index.complete("AL", limit=10),
+            [(self.u2_id, "Alfred"), (self.u1_id, "alice")],
+        )
+        self.assertEqual(index.complete("al", limit=1), [(self.u2_id, "Alfred")])
+        self.assertEqual(index.complete("z", limit=10), [])
+
+        index.add(self.u3_id, "alan")
+        self.assertEqual(
+            [username for _id, username in index.complete("al", limit=10)],
+            ["alan", "Alfred", "alice"],
+        )
+        self.assertEqual(index.complete("bob", limit=10), [])
+
+        index.remove(self.u1_id)
+        self.assertEqual(
+            [username for _id, username in index.complete("al", limit=10)],
+            ["alan", "Alfred"],
+        )
+
+    def test_follows_user_changes(self):
+        User.signup("alfie", "alfie@email.com", "password", None)
+        db.session.commit()
+        self.assertEqual(self.complete("alf"), ["alfie", "Alfred"])
+
+        u1 = db.session.get(User, self.u1_id)
+        u1.update_user("carol", "alice@email.com", None, None, "")
+        db.session.commit()
+        self.assertEqual(self.complete("alice"), [])
+        self.assertEqual(self.complete("car"), ["carol"])
+
+        u2 = db.session.get(User, self.u2_id)
+        u2.soft_delete()
+        db.session.commit()
+        self.assertEqual(self.complete("alf"), ["alfie"])
+
+    def test_reloads_after_ttl(self):
+        index = UsernameIndex(ttl=60)
+        index.rebuild()
+
+        # Changes made by another worker: no ORM events here
+        dbx(db.insert(User).values(
+            username="alfie", email="alfie@email.com", password="x"))
+        dbx(db.update(User).where(User.id == self.u1_id).values(
+            username="carol"))
+        db.session.commit()
+
+        self.assertEqual(
+            [username for _id, username in index.complete("al", limit=10)],
+            ["Alfred", "alice"],
+        )
+
+        index._built_at -= 60
+        self.assertEqual(
+            [username for _id, username in index.complete("al", limit=10)],
+            ["alfie", "Alfred"],
+        )
+
+    def test_ignores_rollbacks(self):
+        User.signup("bobby", "bobby@email.com", "password", None)
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(self.complete("bob"), ["bob"])
+
+    def test_autocomplete_view(self):
+        with app.test_client() as c:
+            resp = c.get("/users/autocomplete", query_string={"q": "al"})
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u3_id
+
+            resp = c.get("/users/autocomplete", query_string={"q": "al"})
+            self.assertEqual(resp.json, [
+                {"id": self.u2_id, "username": "Alfred"},
+                {"id": self.u1_id, "username": "alice"},
+            ])
+
+            resp = c.get("/users/autocomplete", query_string={"q": " "})
+            self.assertEqual(resp.json, [])
@@ -0,0 +1,156 @@
+"""Username and e-mail availability tests."""
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import app, availability
+from availability import BloomFilter, TakenValues
+from models import db, dbx, bcrypt, User
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class BloomFilterTestCase(TestCase):
+    def test_membership(self):
+        bloom = BloomFilter(1000, 0.01)
+
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        # No false negatives, and about 1% false positives
+        self.assertTrue(all(f"user{i}" in bloom for i in range(1000)))
+
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class AvailabilityTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("alice", "alice@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        availability.taken.rebuild()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_unavailable(self):
+        self.assertEqual(
+            availability.unavailable(
+                username="alice", email="alice@email.com"),
+            {"username", "email"})
+        self.assertEqual(
+            availability.unavailable(username="bob", email="alice@email.com"),
+            {"email"})
+
+        # Not taken by someone else
+        self.assertEqual(
+            availability.unavailable(
+                self.u1_id, username="alice", email="alice@email.com"),
+            set())
+
+    def test_kept_up_to_date(self):
+        taken = availability.taken
+
+        User.signup("bob", "bob@email.com", "password", None)
+        db.session.flush()
+        self.assertFalse(taken.may_contain("username", "bob"))
+
+        db.session.commit()
+        self.assertTrue(taken.may_contain("username", "bob"))
+        self.assertTrue(taken.may_contain("email", "bob@email.com"))
+
+        alice = db.session.get(User, self.u1_id)
+        alice.update_user("alicia", "alice@email.com", None, None, "")
+        db.session.commit()
+
+        self.assertTrue(taken.may_contain("username", "alicia"))
+        self.assertEqual(availability.unavailable(username="alice"), set())
+
+    def test_filter_dropped_while_checking(self):
+        taken = TakenValues(1, 0.01)
+        load = taken._load
+
+        def load_and_fill():
+            bloom = load()
+
+            # Meanwhile, signups committed by other threads fill it up,
+            # and it's dropped to be rebuilt
+            for i in range(bloom.capacity):
+                taken.add("username", f"user{i}")
+
+            return bloom
+
+        with patch.object(taken, "_load", load_and_fill):
+            self.assertTrue(taken.may_contain("username", "alice"))
+
+        self.assertIsNone(taken._filter)
+
+    def test_reloads_after_ttl(self):
+        taken = TakenValues(100, 0.01, ttl=60)
+        taken.rebuild()
+
+        # Taken through another worker: no ORM events here
+        dbx(db.insert(User).values(
+            username="carol", email="carol@email.com", password="x"))
+        db.session.commit()
+
+        self.assertFalse(taken.may_contain("username", "carol"))
+
+        taken._built_at -= 60
+        self.assertTrue(taken.may_contain("username", "carol"))
+
+    def test_signup_rejected_before_hashing(self):
+        with patch.object(
+                bcrypt,
+                "generate_password_hash",
+                wraps=bcrypt.generate_password_hash) as hashed:
+            with app.test_client() as c:
+                resp = c.post("/signup", data={
+                    "username": "alice2",
+                    "email": "alice@email.com",
+                    "password": "password",
+                    "image_url": "",
+                })
+                html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("E-mail already in use", html)
+        hashed.assert_not_called()
+
+    def test_availability_view(self):
+        with app.test_client() as c:
+            resp = c.get("/signup/availability", query_string={
+                "username": "alice",
+                "email": "new@email.com",
+            })
+            self.assertEqual(resp.json, {"username": False, "email": True})
+
+            resp = c.get("/signup/availability")
+            self.assertEqual(resp.json, {})
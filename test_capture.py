@@ -0,0 +1,166 @@
+"""Traffic capture and replay tests."""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY, traffic_capture
+from capture import (
+    client_sender, compare_latency, login_sessions, read_capture, replay)
+from models import db, dbx, Like, Message, User
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class TrafficCaptureTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="hello", user_id=u2.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.m1_id = u1.id, u2.id, m1.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        traffic_capture.directory = self.directory.name
+
+    def tearDown(self):
+        traffic_capture.close()
+        traffic_capture.directory = None
+        self.directory.cleanup()
+        db.session.rollback()
+
+    def capture(self):
+        with app.test_client() as c:
+            c.get("/login").close()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.u2_id}").close()
+            c.get("/messages/search", query_string={"q": "hello"}).close()
+            c.post(
+                f"/messages/{self.m1_id}/like",
+                data={"request_url": "/"},
+            ).close()
+
+        traffic_capture.close()
+
+        return read_capture(self.directory.name)
+
+    def test_capture(self):
+        entries = self.capture()
+
+        # Not the login page
+        self.assertEqual(
+            [entry["endpoint"] for entry in entries],
+            ["show_user", "search_messages", "like_unlike_message"])
+
+        show, search, like = entries
+        self.assertEqual(show["path"], f"/users/{self.u2_id}")
+        self.assertEqual(show["user"], self.u1_id)
+        self.assertEqual(show["status"], 200)
+        self.assertGreater(show["ms"], 0)
+
+        # Search text is hashed
+        ((name, value),) = search["args"]
+        self.assertEqual(name, "q")
+        self.assertEqual(len(value), len("hello"))
+        self.assertNotEqual(value, "hello")
+        self.assertEqual(value, traffic_capture.pseudonym("hello"))
+
+        self.assertEqual(like["method"], "POST")
+        self.assertEqual(like["status"], 302)
+
+    def test_rotation(self):
+        # Logs of 200 bytes, about two entries each
+        traffic_capture.max_bytes = 1600
+
+        # Other workers' logs, written earlier
+        for name in ["traffic-1.log", "traffic-2.log.1"]:
+            path = os.path.join(self.directory.name, name)
+            with open(path, "w") as f:
+                f.write(" " * 1000)
+            os.utime(path, (0, 0))
+
+        try:
+            for i in range(30):
+                traffic_capture.write({"t": i, "padding": "x" * 50})
+
+                sizes = [
+                    entry.stat().st_size
+                    for entry in os.scandir(self.directory.name)
+                ]
+                self.assertLessEqual(sum(sizes), 1600)
+
+            # A log deleted by another worker is started again
+            os.remove(traffic_capture._path)
+            traffic_capture.write({"t": 30, "padding": ""})
+        finally:
+            traffic_capture.max_bytes = app.config[
+                'TRAFFIC_CAPTURE_MAX_BYTES']
+
+        traffic_capture.close()
+
+        names = os.listdir(self.directory.name)
+        self.assertNotIn("traffic-1.log", names)
+        self.assertNotIn("traffic-2.log.1", names)
+
+        # The latest entries are kept, less those in the deleted log
+        times = [entry["t"] for entry in read_capture(self.directory.name)]
+        self.assertLess(len(times), 30)
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(times[-1], 30)
+        self.assertNotIn(29, times)
+
+    def test_replay(self):
+        entries = self.capture()
+        traffic_capture.directory = None
+
+        # Replayed against the database as it was captured
+        dbx(db.delete(Like))
+        db.session.commit()
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            sessions = login_sessions(app, [self.u1_id], CURR_USER_KEY)
+            results = replay(
+                entries, client_sender(app), sessions, speed=0)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+        self.assertEqual(
+            [status for status, _ms in results], [200, 200, 302])
+        self.assertEqual(
+            db.session.scalar(db.select(db.func.count(Like.message_id))), 1)
+
+        report = compare_latency(entries, results)
+        self.assertEqual(report["show_user"][0], 1)
+        self.assertEqual(report["show_user"][-1], 0)
@@ -0,0 +1,165 @@
+"""Follow graph cache tests."""
+
+import os
+import sys
+from array import array
+from unittest import TestCase
+
+from app import app
+from graph import GraphCache
+from models import db, dbx, User, Follow
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class GraphCacheTestCase(TestCase):
+    def setUp(self):
+        # 1 follows 2 and 3; 2 follows 3
+        self.follows = {(1, 2), (1, 3), (2, 3)}
+        self.loads = []
+
+        def loader(direction, user_id):
+            self.loads.append((direction, user_id))
+            if direction == "following":
+                return sorted(b for a, b in self.follows if a == user_id)
+            return sorted(a for a, b in self.follows if b == user_id)
+
+        self.loader = loader
+
+    def test_lookups(self):
+        cache = GraphCache(self.loader)
+
+        self.assertTrue(cache.is_following(1, 3))
+        self.assertFalse(cache.is_following(3, 1))
+        self.assertEqual(list(cache.followers(3)), [1, 2])
+        self.assertTrue(cache.is_following(1, 2))
+
+        self.assertEqual(len(self.loads), 3)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["hit_rate"], 0.25)
+
+    def test_add_and_remove(self):
+        cache = GraphCache(self.loader)
+        cache.following(3)
+        cache.followers(1)
+
+        cache.add(3, 1)
+        self.assertTrue(cache.is_following(3, 1))
+        self.assertEqual(list(cache.followers(1)), [3])
+
+        cache.add(3, 1)
+        self.assertEqual(list(cache.following(3)), [1])
+
+        cache.remove(3, 1)
+        self.assertFalse(cache.is_following(3, 1))
+        self.assertEqual(list(cache.followers(1)), [])
+        self.assertEqual(len(self.loads), 2)
+
+    def test_memory_budget(self):
+        one_list = sys.getsizeof(array("i", [2, 3]))
+        cache = GraphCache(self.loader, max_bytes=one_list * 2)
+
+        cache.following(1)
+        cache.following(2)
+        cache.following(1)
+        cache.following(4)
+
+        # 2 was least recently used
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertLessEqual(cache.stats()["bytes"], one_list * 2)
+
+        cache.following(1)
+        cache.following(2)
+        self.assertEqual(self.loads[-1], ("following", 2))
+        self.assertEqual(cache.stats()["hits"], 2)
+
+    def test_ttl(self):
+        cache = GraphCache(self.loader, ttl=0)
+
+        cache.following(1)
+        cache.following(1)
+
+        self.assertEqual(len(self.loads), 2)
+
+
+class UserGraphCacheTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        users = [
+            User.signup(name, f"{name}@email.com", "password", None)
+            for name in ["u1", "u2", "u3"]
+        ]
+        db.session.commit()
+
+        self.u1, self.u2, self.u3 = users
+        self.cache = GraphCache(User.load_follow_ids)
+        User.graph_cache = self.cache
+
+    def tearDown(self):
+        User.graph_cache = None
+        db.session.rollback()
+
+    def test_follow_and_unfollow(self):
+        self.assertFalse(self.u1.is_following(self.u2))
+
+        self.u1.follow(self.u2.id)
+        self.assertFalse(self.u1.is_following(self.u2))
+        db.session.commit()
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertTrue(self.u2.is_followed_by(self.u1))
+
+        self.u1.follow_many([self.u2.id, self.u3.id])
+        db.session.commit()
+        self.assertEqual(
+            list(self.u1.following_ids()), sorted([self.u2.id, self.u3.id]))
+        self.assertEqual(
+            [u.id for u in self.u3.followers], [self.u1.id])
+
+        self.u1.unfollow(self.u2.id)
+        db.session.commit()
+        self.assertFalse(self.u1.is_following(self.u2))
+        self.assertFalse(self.u2.is_followed_by(self.u1))
+
+        # Only u1's following and u3's followers were ever loaded
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_orm_follows(self):
+        self.assertFalse(self.u2.is_following(self.u3))
+
+        db.session.add(Follow(
+            user_following_id=self.u2.id,
+            user_being_followed_id=self.u3.id,
+        ))
+        db.session.commit()
+        self.assertTrue(self.u2.is_following(self.u3))
+
+    def test_rollback(self):
+        self.assertFalse(self.u1.is_following(self.u3))
+
+        self.u1.follow(self.u3.id)
+        db.session.rollback()
+
+        self.assertFalse(self.u1.is_following(self.u3))
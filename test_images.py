@@ -0,0 +1,242 @@
+"""Image proxy tests."""
+
+import os
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+from app import app, CURR_USER_KEY, image_proxy
+from cachedirs import UnsafeCacheDir
+from images import HTTPFetcher, ImageFetchError, ThumbnailCache, IMAGE_SIZES
+from models import db, dbx, User
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+def png(width, height):
+    out = BytesIO()
+    Image.new("RGBA", (width, height), (200, 0, 0, 128)).save(out, "PNG")
+    return out.getvalue()
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Stand-in for the sites images are on: /big.png is an image."""
+
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+
+        if self.path == "/big.png":
+            body = png(1200, 900)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+        else:
+            body = b"not found"
+            self.send_response(404)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.origin = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        OriginHandler.hits.clear()
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.fetcher = image_proxy.fetcher
+        self.cache = image_proxy.cache
+
+        image_proxy.fetcher = HTTPFetcher(allow_private=True)
+        image_proxy.cache = ThumbnailCache(self.cache_dir.name, 2**20)
+        image_proxy._failed.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        image_proxy.fetcher = self.fetcher
+        image_proxy.cache = self.cache
+        self.cache_dir.cleanup()
+
+    def proxy_url(self, url, size):
+        with app.test_request_context():
+            return image_proxy.thumbnail_url(url, size)
+
+    def test_serves_resized_copies(self):
+        url = f"{self.origin}/big.png"
+
+        for size in ["avatar", "hero", "avatar"]:
+            resp = self.client.get(self.proxy_url(url, size))
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "image/jpeg")
+            self.assertTrue(resp.cache_control.public)
+            self.assertTrue(resp.cache_control.immutable)
+            self.assertEqual(resp.cache_control.max_age, 365 * 24 * 60 * 60)
+            self.assertNotIn("Set-Cookie", resp.headers)
+
+            with Image.open(BytesIO(resp.data)) as image:
+                self.assertEqual(image.size, IMAGE_SIZES[size])
+
+            resp.close()
+
+        # Every size was made from one fetch
+        self.assertEqual(OriginHandler.hits, ["/big.png"])
+
+    def test_serves_evicted_thumbnails(self):
+        # Too small for even one image: every put evicts what it wrote
+        image_proxy.cache = ThumbnailCache(self.cache_dir.name, max_bytes=1)
+
+        url = f"{self.origin}/big.png"
+        resp = self.client.get(self.proxy_url(url, "avatar"))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        with Image.open(BytesIO(resp.data)) as image:
+            self.assertEqual(image.size, IMAGE_SIZES["avatar"])
+
+    def test_refuses_unsigned_urls(self):
+        url = f"{self.origin}/big.png"
+        proxy_url = self.proxy_url(url, "avatar")
+
+        resp = self.client.get(f"/images/avatar?src={url}")
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get(proxy_url.replace("avatar", "huge", 1))
+        self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(OriginHandler.hits, [])
+
+    def test_redirects_to_unfetchable_images(self):
+        url = f"{self.origin}/missing.png"
+
+        for _ in range(2):
+            resp = self.client.get(self.proxy_url(url, "avatar"))
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, url)
+            self.assertTrue(resp.cache_control.no_store)
+
+        # The failure is remembered for a while
+        self.assertEqual(OriginHandler.hits, ["/missing.png"])
+
+        # By default, local addresses are off limits
+        image_proxy.fetcher = HTTPFetcher()
+        image_proxy._failed.clear()
+
+        url = f"{self.origin}/big.png"
+        resp = self.client.get(self.proxy_url(url, "avatar"))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(OriginHandler.hits, ["/missing.png"])
+
+    def test_refuses_rebound_names(self):
+        """A name that resolves to a public address when it's first looked
+        up and to a local one when it's connected to isn't fetched."""
+
+        port = self.server.server_port
+        answers = iter(["93.184.215.14"])
+
+        def getaddrinfo(host, *args, **kwargs):
+            address = next(answers, "127.0.0.1")
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                     (address, port))]
+
+        with patch("socket.getaddrinfo", getaddrinfo):
+            with self.assertRaises(ImageFetchError):
+                HTTPFetcher()(f"http://images.example.com:{port}/big.png")
+
+        self.assertEqual(OriginHandler.hits, [])
+
+    def test_pages_link_to_thumbnails(self):
+        dbx(db.delete(User))
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = u1.id
+
+        html = self.client.get(f"/users/{u1.id}/followers").get_data(True)
+
+        self.assertIn(self.proxy_url(u1.image_url, "avatar"), html)
+        self.assertIn(self.proxy_url(u1.image_url, "profile"), html)
+
+        # Local images aren't proxied
+        self.assertEqual(
+            self.proxy_url("/static/x.png", "avatar"), "/static/x.png")
+
+
+class ThumbnailCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_evicts_least_recently_used(self):
+        cache = ThumbnailCache(self.cache_dir.name, max_bytes=2500)
+
+        cache.put("aa1", {"avatar": b"x" * 1000})
+        cache.put("bb2", {"avatar": b"x" * 1000})
+
+        # Use aa1 more recently than bb2
+        path = cache.get("bb2", "avatar")
+        os.utime(path, (0, 0))
+        self.assertIsNotNone(cache.get("aa1", "avatar"))
+
+        cache.put("cc3", {"avatar": b"x" * 1000})
+
+        self.assertIsNotNone(cache.get("aa1", "avatar"))
+        self.assertIsNone(cache.get("bb2", "avatar"))
+        self.assertIsNotNone(cache.get("cc3", "avatar"))
+        self.assertIsNone(cache.get("dd4", "avatar"))
+
+    def test_private_directory(self):
+        path = os.path.join(self.cache_dir.name, "thumbs")
+        ThumbnailCache(path, max_bytes=1000)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+
+        os.chmod(path, 0o777)
+        with self.assertRaises(UnsafeCacheDir):
+            ThumbnailCache(path, max_bytes=1000)
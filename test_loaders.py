@@ -0,0 +1,163 @@
+"""Batch loader tests."""
+
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from app import app
+from models import (
+    db, dbx, BatchLoader, batching, entity_loader, Like, Message, User,
+    Follow,
+)
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+@contextmanager
+def count_queries():
+    """Count the statements run in the block: `with ... as queries`."""
+
+    queries = []
+
+    def count(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    db.event.listen(db.engine, "before_cursor_execute", count)
+
+    try:
+        yield queries
+    finally:
+        db.event.remove(db.engine, "before_cursor_execute", count)
+
+
+class BatchLoaderTestCase(TestCase):
+    def test_batches_expected_keys(self):
+        batches = []
+
+        def batch(keys):
+            batches.append(keys)
+            return {key: key * 10 for key in keys if key != 3}
+
+        loader = BatchLoader(batch)
+        loader.expect([2, 1, 3])
+
+        self.assertEqual(loader.load(1), 10)
+        self.assertIsNone(loader.load(3))
+        self.assertEqual(loader.load_many([2, 4]), [20, 40])
+
+        loader.prime(5, 55)
+        self.assertEqual(loader.load(5), 55)
+
+        self.assertEqual(batches, [[1, 2, 3], [4]])
+
+
+class EntityLoaderTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        viewer = User.signup("viewer", "viewer@email.com", "password", None)
+        authors = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(5)
+        ]
+        db.session.flush()
+
+        messages = [
+            Message(text=f"message {i}", user_id=author.id)
+            for i, author in enumerate(authors)
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        for message in messages[:3]:
+            db.session.add(Like(user_id=viewer.id, message_id=message.id))
+
+        for author in authors:
+            viewer.follow(author.id)
+
+        db.session.commit()
+        self.viewer_id = viewer.id
+
+        # Start from an empty session, as a request does
+        db.session.expunge_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_references_load_together(self):
+        with batching(), count_queries() as queries:
+            follows = dbx(db.select(Follow)).scalars().all()
+            usernames = {follow.following_user.username for follow in follows}
+
+        self.assertEqual(usernames, {f"u{i}" for i in range(5)})
+
+        # The follows, then the users in one query, plus the first lazy load
+        self.assertEqual(len(queries), 3)
+
+    def test_not_batching(self):
+        # Outside batching(), as in a job reading rows a batch at a time,
+        # nothing is kept for the objects loaded
+        for follow in dbx(db.select(Follow).execution_options(yield_per=2)):
+            self.assertIsNotNone(follow)
+
+        self.assertNotIn("loaders", db.session.info)
+
+    def test_liked_msgs(self):
+        viewer = db.session.get(User, self.viewer_id)
+
+        with count_queries() as queries:
+            messages = viewer.liked_msgs
+            authors = [message.user.username for message in messages]
+
+        self.assertEqual(sorted(authors), ["u0", "u1", "u2"])
+
+        # Likes, messages, authors
+        self.assertEqual(len(queries), 3)
+
+    def test_is_liked_by_user(self):
+        messages = dbx(
+            db.select(Message).order_by(Message.id)).scalars().all()
+
+        with count_queries() as queries:
+            liked = [m.is_liked_by_user(self.viewer_id) for m in messages]
+
+        self.assertEqual(liked, [True, True, True, False, False])
+        self.assertEqual(len(queries), 1)
+
+    def test_following_primes_users(self):
+        viewer = db.session.get(User, self.viewer_id)
+        following = viewer.following
+
+        with count_queries() as queries:
+            users = entity_loader(User).load_many(u.id for u in following)
+
+        self.assertEqual(users, following)
+        self.assertEqual(queries, [])
+
+    def test_discarded_at_end_of_transaction(self):
+        loader = entity_loader(User)
+        user = loader.load(self.viewer_id)
+        self.assertEqual(user.username, "viewer")
+
+        db.session.commit()
+
+        self.assertIsNot(entity_loader(User), loader)
@@ -1,10 +1,11 @@
 """User model tests."""
 
 import os
+from datetime import timedelta
 from unittest import TestCase
 
 from app import app
-from models import db, dbx, User, Message, Like
+from models import db, dbx, User, Message, Like, TrendingMessage
 
 # To run the tests, you must provide a "test database", since these tests
 # delete & recreate the tables & data. In your shell:
@@ -117,3 +118,89 @@ class UserModelTestCase(TestCase):
         self.assertIsNone(like)
 
         self.assertEqual(u1.num_likes, 0)
+
+    def test_like_unlike_msg(self):
+        u2 = db.session.get(User, self.u2_id)
+
+        toggle = u2.like_unlike_msg(self.m2_id)
+        self.assertEqual(toggle, (self.u1_id, False, 0))
+        db.session.commit()
+
+        self.assertIsNone(db.session.get(Like, (self.u2_id, self.m2_id)))
+
+        toggle = u2.like_unlike_msg(self.m2_id)
+        self.assertEqual(toggle, (self.u1_id, True, 1))
+
+    def test_like_unlike_own_or_missing_msg(self):
+        u1 = db.session.get(User, self.u1_id)
+
+        toggle = u1.like_unlike_msg(self.m2_id)
+        self.assertEqual(toggle, (self.u1_id, False, 1))
+
+        toggle = u1.like_unlike_msg(0)
+        self.assertIsNone(toggle.owner_id)
+        self.assertFalse(toggle.liked)
+
+    def test_like_count(self):
+        msg = db.session.get(Message, self.m1_id)
+        self.assertEqual(msg.like_count, 1)
+
+        db.session.delete(db.session.get(Like, (self.u1_id, self.m1_id)))
+        db.session.commit()
+
+        self.assertEqual(msg.like_count, 0)
+
+    def test_trending_refresh(self):
+        # No lag: count likes as soon as they're committed
+        TrendingMessage.refresh(lag=timedelta(0))
+
+        trending = dbx(db.select(TrendingMessage)).scalars().all()
+        self.assertEqual(
+            {t.message_id for t in trending}, {self.m1_id, self.m2_id})
+        first_score = db.session.get(TrendingMessage, self.m1_id).score
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+        u3.like_unlike_msg(self.m1_id)
+        db.session.commit()
+
+        TrendingMessage.refresh(lag=timedelta(0))
+
+        trending = db.session.get(TrendingMessage, self.m1_id)
+        self.assertGreater(trending.score, first_score)
+
+    def test_trending_late_likes(self):
+        """A like committed after a refresh, by a transaction that started
+        before it, is counted once."""
+
+        dbx(db.update(Like).values(
+            timestamp=db.func.current_timestamp() - timedelta(minutes=10)))
+        db.session.commit()
+
+        TrendingMessage.refresh(lag=timedelta(minutes=1))
+        first_score = db.session.get(TrendingMessage, self.m1_id).score
+
+        # As if that refresh ran two minutes ago, while the transaction
+        # adding this like (started half a minute before) was still open
+        last = dbx(db.select(db.func.max(TrendingMessage.refreshed_at)))
+        last = last.scalar() - timedelta(minutes=2)
+        dbx(db.update(TrendingMessage).values(refreshed_at=last))
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+        db.session.add(Like(
+            user_id=u3.id,
+            message_id=self.m1_id,
+            timestamp=last - timedelta(seconds=30),
+        ))
+        db.session.commit()
+
+        scores = []
+        for _ in range(2):
+            TrendingMessage.refresh(lag=timedelta(minutes=1))
+            db.session.expire_all()
+            scores.append(db.session.get(TrendingMessage, self.m1_id).score)
+
+        self.assertGreater(scores[0], first_score)
+        # and isn't counted again
+        self.assertLessEqual(scores[1], scores[0])
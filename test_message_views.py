@@ -1,10 +1,11 @@
 """Message View tests."""
 
 import os
+from datetime import timedelta
 from unittest import TestCase
 
 from app import app, CURR_USER_KEY
-from models import db, dbx, Message, User
+from models import db, dbx, Message, User, TrendingMessage
 
 # To run the tests, you must provide a "test database", since these tests
 # delete & recreate the tables & data. In your shell:
@@ -128,6 +129,22 @@ class MessageViewTestCase(MessageBaseViewTestCase):
             msg = db.session.get(Message, self.m2_id)
             self.assertTrue(msg.is_liked_by_user(self.u1_id))
 
+    def test_show_trending(self):
+        u1 = db.session.get(User, self.u1_id)
+        u1.like_unlike_msg(self.m2_id)
+        db.session.commit()
+        TrendingMessage.refresh(lag=timedelta(0))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/trending")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Other Message", html)
+            self.assertNotIn("Test Message", html)
+
     def test_no_logged_in_user(self):
         with app.test_client() as c:
 
@@ -0,0 +1,149 @@
+"""Microcache tests."""
+
+import os
+import re
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import app, CURR_USER_KEY, microcache
+from microcache import DatabasePageStore, MemoryPageStore, Page
+from models import db, dbx, CachedPage, User
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class PageStoreTestCase(TestCase):
+    def test_stores(self):
+        dbx(db.delete(CachedPage))
+        db.session.commit()
+
+        page = Page(200, "text/html; charset=utf-8", b"<p>Hi</p>")
+
+        for store in (MemoryPageStore(), DatabasePageStore()):
+            self.assertIsNone(store.get("/", 100))
+
+            store.set("/", page, 110)
+            self.assertEqual(store.get("/", 100), page)
+            self.assertIsNone(store.get("/", 110))
+
+            # Stored again once it's expired
+            store.set("/", page._replace(body=b"<p>Bye</p>"), 120)
+            self.assertEqual(store.get("/", 115).body, b"<p>Bye</p>")
+
+
+class MicrocacheTestCase(TestCase):
+    def setUp(self):
+        microcache.store = MemoryPageStore()
+
+    def tearDown(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_anonymous_pages_cached(self):
+        with app.test_client() as c:
+            resp = c.get("/")
+            self.assertEqual(resp.headers["X-Microcache"], "MISS")
+
+            resp = c.get("/")
+            self.assertEqual(resp.headers["X-Microcache"], "HIT")
+            self.assertIn("What's Happening?", resp.get_data(as_text=True))
+            self.assertIn("no-store", resp.headers["Cache-Control"])
+
+            # Query strings aren't cached
+            resp = c.get("/?utm_source=mail")
+            self.assertNotIn("X-Microcache", resp.headers)
+
+    def test_logged_in_bypass(self):
+        dbx(db.delete(User))
+        db.session.commit()
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        with app.test_client() as c:
+            c.get("/")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+
+            resp = c.get("/")
+            self.assertNotIn("X-Microcache", resp.headers)
+            self.assertNotIn("What's Happening?", resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+                sess["_flashes"] = [("message", "Logged out!")]
+
+            resp = c.get("/")
+            self.assertNotIn("X-Microcache", resp.headers)
+            self.assertIn("Logged out!", resp.get_data(as_text=True))
+
+    def test_own_csrf_token(self):
+        app.config['WTF_CSRF_ENABLED'] = True
+        tokens = []
+
+        for _ in range(2):
+            # A fresh app context, so a fresh g: Flask-WTF keeps the token
+            # it made there
+            with app.app_context(), app.test_client() as c:
+                resp = c.get("/login")
+                html = resp.get_data(as_text=True)
+                token = re.search(
+                    r'name="csrf_token" type="hidden" value="([^"]+)"',
+                    html).group(1)
+                tokens.append((resp.headers["X-Microcache"], token))
+
+                # The token is this visitor's own
+                resp = c.post("/login", data={
+                    "csrf_token": token,
+                    "username": "nobody",
+                    "password": "password",
+                })
+                self.assertIn(
+                    "Invalid credentials", resp.get_data(as_text=True))
+
+        (first, token1), (second, token2) = tokens
+        self.assertEqual((first, second), ("MISS", "HIT"))
+        self.assertNotEqual(token1, token2)
+
+    def test_coalesced_render(self):
+        renders = []
+
+        def slow_login():
+            renders.append(1)
+            time.sleep(0.2)
+            return "Log in"
+
+        def visit():
+            with app.test_client() as c:
+                self.assertEqual(c.get("/login").text, "Log in")
+
+        with patch.dict(app.view_functions, {"login": slow_login}):
+            visitors = [threading.Thread(target=visit) for _ in range(5)]
+            for visitor in visitors:
+                visitor.start()
+            for visitor in visitors:
+                visitor.join()
+
+        self.assertEqual(len(renders), 1)
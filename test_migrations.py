@@ -0,0 +1,204 @@
+"""Schema migration and query plan tests."""
+
+import os
+from datetime import datetime
+from unittest import TestCase, skipUnless
+
+from app import app
+from migrations import BASELINE, MIGRATIONS, create_index, pending, upgrade
+from models import db, dbx, Like, Message, SchemaMigration, User
+from queryplans import check_plans
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+POSTGRESQL = app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgresql")
+
+
+def index_names(table_name):
+    return {i["name"] for i in db.inspect(db.engine).get_indexes(table_name)}
+
+
+class MigrationTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(SchemaMigration))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+        # Migrations are safe to re-run: this puts back any dropped index
+        dbx(db.delete(SchemaMigration))
+        db.session.commit()
+        upgrade()
+
+    def test_upgrade(self):
+        self.assertEqual(upgrade(), sorted(MIGRATIONS))
+        self.assertEqual(pending(), [])
+        self.assertEqual(upgrade(), [])
+
+        names = dbx(
+            db.select(SchemaMigration.name).order_by(SchemaMigration.version)
+        ).scalars().all()
+        self.assertEqual(names, [MIGRATIONS[v].__name__ for v in sorted(MIGRATIONS)])
+
+    def assert_models_schema(self):
+        inspector = db.inspect(db.engine)
+
+        for table in db.metadata.sorted_tables:
+            columns = {
+                column["name"]: column["nullable"]
+                for column in inspector.get_columns(table.name)
+            }
+            self.assertEqual(
+                columns,
+                {column.name: column.nullable for column in table.columns},
+                table.name)
+            self.assertLessEqual(
+                {index.name for index in table.indexes},
+                index_names(table.name),
+                table.name)
+
+    @skipUnless(POSTGRESQL, "The full-text index needs PostgreSQL")
+    def test_upgrade_empty(self):
+        db.drop_all()
+        upgrade()
+        self.assert_models_schema()
+
+    @skipUnless(POSTGRESQL, "The full-text index needs PostgreSQL")
+    def test_upgrade_baseline(self):
+        # A database as the app first shipped, with some rows
+        db.drop_all()
+        BASELINE.create_all(db.engine)
+        users, messages, likes = (
+            BASELINE.tables[name] for name in ("users", "messages", "likes"))
+
+        with db.engine.begin() as conn:
+            user_ids = conn.execute(
+                db.insert(users).returning(users.c.id),
+                [
+                    {"email": f"u{i}@email.com", "username": f"u{i}",
+                     "image_url": "", "header_image_url": "", "bio": "",
+                     "location": "", "password": "password"}
+                    for i in range(2)
+                ],
+            ).scalars().all()
+            message_ids = conn.execute(
+                db.insert(messages).returning(messages.c.id),
+                [
+                    {"text": f"m{i}", "user_id": user_ids[0],
+                     "timestamp": datetime(2024, 1, i + 1)}
+                    for i in range(2)
+                ],
+            ).scalars().all()
+            conn.execute(
+                db.insert(likes),
+                {"user_id": user_ids[1], "message_id": message_ids[0]})
+
+        upgrade()
+        self.assert_models_schema()
+
+        counts = dbx(
+            db.select(Message.like_count).order_by(Message.id)
+        ).scalars().all()
+        self.assertEqual(counts, [1, 0])
+        self.assertEqual(
+            dbx(db.select(Like.timestamp)).scalar(), datetime(2024, 1, 1))
+
+        # New rows get the new columns' defaults
+        db.session.add(Like(user_id=user_ids[0], message_id=message_ids[1]))
+        db.session.commit()
+        self.assertEqual(
+            dbx(
+                db.select(Message.like_count)
+                .where(Message.id == message_ids[1])
+            ).scalar(),
+            1)
+
+    def test_create_index(self):
+        upgrade()
+        dbx(db.text("DROP INDEX ix_likes_message_id"))
+        db.session.commit()
+        self.assertNotIn("ix_likes_message_id", index_names("likes"))
+
+        create_index("likes", "ix_likes_message_id")
+        self.assertIn("ix_likes_message_id", index_names("likes"))
+
+        # Already there: nothing to do
+        create_index("likes", "ix_likes_message_id")
+
+    @skipUnless(POSTGRESQL, "EXPLAIN checks need PostgreSQL")
+    def test_check_plans(self):
+        upgrade()
+        self.assertEqual(check_plans(), {})
+
+        dbx(db.text("DROP INDEX ix_messages_user_id_timestamp"))
+        db.session.commit()
+
+        problems = check_plans()
+        self.assertIn("profile_messages", problems)
+        self.assertNotIn("following_page", problems)
+
+    @skipUnless(POSTGRESQL, "Partitions need PostgreSQL")
+    def test_partition_messages(self):
+        # A messages table from before partitioning
+        options = Message.__table__.dialect_options["postgresql"]
+        options["partition_by"] = None
+        try:
+            db.drop_all()
+            db.create_all()
+        finally:
+            options["partition_by"] = "RANGE (id)"
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        messages = [Message(text=f"m{i}", user_id=u1.id) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        db.session.add(Like(user_id=u2.id, message_id=messages[0].id))
+        db.session.commit()
+
+        newest = messages[-1].id
+        upgrade()
+
+        partitions = dbx(db.text(
+            "SELECT c.relname FROM pg_inherits i"
+            " JOIN pg_class c ON c.oid = i.inhrelid"
+            " WHERE i.inhparent = 'messages'::regclass ORDER BY 1"
+        )).scalars().all()
+        self.assertEqual(partitions, ["messages_default", "messages_p0"])
+        self.assertEqual(
+            index_names("messages"),
+            {i.name for i in Message.__table__.indexes})
+
+        # New ids carry on from the old ones; likes still follow messages
+        message = Message(text="new", user_id=u1.id)
+        db.session.add(message)
+        db.session.commit()
+        self.assertEqual(message.id, newest + 1)
+
+        dbx(db.delete(Message).where(Message.id == messages[0].id))
+        db.session.commit()
+        self.assertEqual(
+            dbx(db.select(db.func.count()).select_from(Like)).scalar(), 0)
@@ -0,0 +1,211 @@
+"""Notification tests."""
+
+import os
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from app import app, CURR_USER_KEY
+from models import (
+    db, dbx, Like, Message, Notification, NotificationEvent, User)
+import notifications
+from notifications import collapse_notifications
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+POSTGRESQL = app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgresql")
+
+
+class NotificationTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(4)
+        ]
+        db.session.flush()
+
+        messages = [
+            Message(text=f"Message {i}", user_id=users[0].id)
+            for i in range(3)
+        ]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.user_ids = [u.id for u in users]
+        self.message_ids = [m.id for m in messages]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def user(self, i):
+        return db.session.get(User, self.user_ids[i])
+
+    def notifications(self):
+        q = db.select(Notification).order_by(Notification.id)
+        return dbx(q).scalars().all()
+
+    def test_events_recorded(self):
+        owner_id, message_id = self.user_ids[0], self.message_ids[0]
+
+        self.user(1).like_unlike_msg(message_id)
+        self.user(0).like_unlike_msg(message_id)
+        self.user(1).follow(owner_id)
+        db.session.commit()
+
+        events = dbx(
+            db.select(NotificationEvent).order_by(NotificationEvent.id)
+        ).scalars().all()
+        self.assertEqual(
+            [(e.user_id, e.kind, e.actor_id, e.message_id) for e in events],
+            [
+                (owner_id, "like", self.user_ids[1], message_id),
+                (owner_id, "follow", self.user_ids[1], None),
+            ])
+
+    def test_collapse(self):
+        owner_id, message_id = self.user_ids[0], self.message_ids[0]
+
+        for i in (1, 2, 3):
+            self.user(i).like_unlike_msg(message_id)
+            self.user(i).follow(owner_id)
+        # Undone before it's collapsed
+        self.user(3).unfollow(owner_id)
+        db.session.commit()
+
+        self.assertEqual(collapse_notifications(batch_size=4), 6)
+        self.assertEqual(
+            dbx(db.select(db.func.count(NotificationEvent.id))).scalar(), 0)
+
+        like, follow = self.notifications()
+        self.assertEqual(
+            (like.kind, like.message_id, like.actor_count, like.last_actor_id),
+            ("like", message_id, 3, self.user_ids[3]))
+        self.assertEqual(
+            (follow.kind, follow.actor_count, follow.last_actor_id),
+            ("follow", 2, self.user_ids[2]))
+        self.assertEqual(self.user(0).unread_notifications, 2)
+
+        # More likes join the unread notification
+        self.user(1).like_unlike_msg(self.message_ids[1])
+        db.session.commit()
+        collapse_notifications()
+        self.assertEqual(len(self.notifications()), 3)
+        self.assertEqual(self.user(0).unread_notifications, 3)
+
+    def test_inbox(self):
+        owner_id = self.user_ids[0]
+
+        for i in (1, 2, 3):
+            self.user(i).like_unlike_msg(self.message_ids[0])
+        self.user(1).like_unlike_msg(self.message_ids[1])
+        self.user(1).like_unlike_msg(self.message_ids[2])
+        db.session.commit()
+        collapse_notifications()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = owner_id
+
+            resp = c.get("/")
+            self.assertIn('badge bg-primary">3<', resp.get_data(as_text=True))
+
+            with patch("app.NOTIFICATIONS_PER_PAGE", 2), \
+                    patch("notifications.NOTIFICATIONS_PER_PAGE", 2):
+                resp = c.get("/notifications")
+                html = resp.get_data(as_text=True)
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("Message 2", html)
+                self.assertIn("Message 1", html)
+                self.assertNotIn("Message 0", html)
+                self.assertIn("Older notifications", html)
+
+                cursor = html.split("before=")[1].split('"')[0]
+                resp = c.get(f"/notifications?before={cursor}")
+                html = resp.get_data(as_text=True)
+                self.assertIn("and 2 others", html)
+                self.assertIn("Message 0", html)
+                self.assertNotIn("Message 1", html)
+
+            self.assertEqual(self.user(0).unread_notifications, 0)
+            self.assertNotIn("badge", c.get("/").get_data(as_text=True))
+
+            resp = c.get("/notifications?before=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+        # A like after they've been read starts a new notification
+        self.user(2).like_unlike_msg(self.message_ids[1])
+        db.session.commit()
+        collapse_notifications()
+        self.assertEqual(len(self.notifications()), 4)
+        self.assertEqual(self.user(0).unread_notifications, 1)
+
+    @skipUnless(POSTGRESQL, "Row locks need PostgreSQL")
+    def test_concurrent_events(self):
+        owner_id, message_id = self.user_ids[0], self.message_ids[0]
+        dbx(db.insert(Like), [
+            {"user_id": self.user_ids[i], "message_id": message_id}
+            for i in (1, 2, 3)
+        ])
+        db.session.commit()
+
+        def record_like(conn, i):
+            conn.execute(NotificationEvent.record(
+                "like", self.user_ids[i],
+                db.select(db.literal(owner_id), db.literal(message_id))))
+
+        with db.engine.connect() as other, db.engine.connect() as late:
+            record_like(other, 1)
+            other.commit()
+
+            # Given its id now, but only committed once the collapser has
+            # read its batch
+            record_like(late, 2)
+
+            record_like(other, 3)
+            other.commit()
+
+            # Another collapser has claimed the first event
+            other.execute(
+                db.select(NotificationEvent.id)
+                .where(NotificationEvent.actor_id == self.user_ids[1])
+                .with_for_update())
+
+            fold = notifications._fold
+
+            def commit_then_fold(groups):
+                late.commit()
+                fold(groups)
+
+            with patch("notifications._fold", commit_then_fold):
+                self.assertEqual(collapse_notifications(), 2)
+
+            other.rollback()
+
+        left = dbx(db.select(NotificationEvent.actor_id)).scalars().all()
+        self.assertEqual(left, [self.user_ids[1]])
+
+        (like,) = self.notifications()
+        self.assertEqual(like.actor_count, 2)
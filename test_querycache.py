@@ -0,0 +1,168 @@
+"""Query cache tests."""
+
+import os
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY, query_cache
+from models import db, dbx, Like, Message, User
+from querycache import QueryCache
+from readmodels import select_user_cards
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class QueryCacheTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        msg = Message(text="Hello", user_id=u1.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.msg_id = msg.id
+
+        query_cache.enabled = True
+        query_cache.clear()
+        query_cache.hits = query_cache.misses = query_cache.bypasses = 0
+
+    def tearDown(self):
+        db.session.rollback()
+        query_cache.enabled = app.config['QUERY_CACHE_ENABLED']
+        query_cache.clear()
+
+    def likers(self):
+        return query_cache.scalars(
+            db.select(Like.user_id).where(Like.message_id == self.msg_id))
+
+    def test_hit_after_miss(self):
+        self.assertEqual(self.likers(), [])
+        self.assertEqual(self.likers(), [])
+        self.assertEqual(
+            (query_cache.misses, query_cache.hits), (1, 1))
+
+        # Other parameters are another entry
+        query_cache.scalars(
+            db.select(Like.user_id).where(Like.message_id == -1))
+        self.assertEqual(query_cache.misses, 2)
+
+    def test_core_write_invalidates(self):
+        self.likers()
+
+        # Liking is a Core INSERT in a CTE
+        db.session.get(User, self.u2_id).like_unlike_msg(self.msg_id)
+        db.session.commit()
+
+        self.assertEqual(self.likers(), [self.u2_id])
+        self.assertEqual(query_cache.hits, 0)
+
+    def test_orm_write_invalidates(self):
+        q = select_user_cards().order_by(User.id)
+        query_cache.all(q)
+
+        db.session.get(User, self.u1_id).username = "renamed"
+        db.session.commit()
+
+        self.assertEqual(query_cache.all(q)[0].username, "renamed")
+        self.assertEqual(query_cache.hits, 0)
+
+    def test_own_writes_bypass(self):
+        q = select_user_cards().order_by(User.id)
+        query_cache.all(q)
+
+        db.session.get(User, self.u1_id).username = "renamed"
+        db.session.flush()
+
+        # Seen by this session, but not cached for the others
+        self.assertEqual(query_cache.all(q)[0].username, "renamed")
+        self.assertEqual(query_cache.bypasses, 1)
+
+        db.session.rollback()
+        self.assertEqual(query_cache.all(q)[0].username, "u1")
+        self.assertEqual(query_cache.hits, 0)
+
+    def test_eviction(self):
+        cache = QueryCache()
+        cache.enabled = True
+        cache.ttl = 30
+        cache.max_bytes = 400
+
+        for message_id in range(20):
+            cache.all(db.select(Like.user_id, db.literal(message_id)))
+
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+        self.assertLess(cache.stats()["entries"], 20)
+
+        # The most recent is still there
+        cache.all(db.select(Like.user_id, db.literal(19)))
+        self.assertEqual(cache.hits, 1)
+
+    def test_entities_refused(self):
+        with self.assertRaises(ValueError):
+            query_cache.all(db.select(User))
+
+    def test_views(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for _ in range(2):
+                resp = c.get("/users")
+                self.assertIn("@u2", resp.get_data(as_text=True))
+
+                resp = c.get(f"/users/{self.u2_id}")
+                self.assertIn("@u2", resp.get_data(as_text=True))
+
+            self.assertEqual(query_cache.hits, 2)
+
+            self.assertEqual(c.get("/users/0").status_code, 404)
+
+    def test_views_stream_when_disabled(self):
+        query_cache.enabled = False
+        yield_per = []
+
+        def executed(conn, cursor, statement, parameters, context, many):
+            if "FROM users" in statement:
+                yield_per.append(context.execution_options.get("yield_per"))
+
+        db.event.listen(db.engine, "after_cursor_execute", executed)
+
+        try:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = c.get("/users")
+                self.assertIn("@u2", resp.get_data(as_text=True))
+        finally:
+            db.event.remove(db.engine, "after_cursor_execute", executed)
+
+        # The list was read a batch at a time, not all at once
+        self.assertIn(app.config['STREAM_BATCH_SIZE'], yield_per)
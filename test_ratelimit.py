@@ -0,0 +1,152 @@
+"""Rate limiting tests."""
+
+import os
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY, limiter
+from models import db, dbx, User, RateLimitBucket
+from ratelimit import (
+    parse_limit,
+    MemoryRateLimitBackend,
+    DatabaseRateLimitBackend,
+)
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class RateLimitBackendTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(RateLimitBucket))
+        db.session.commit()
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit("10/minute"), (10, 10 / 60))
+        self.assertEqual(parse_limit("2/second"), (2, 2))
+
+    def check_backend(self, backend):
+        # 2 tokens, refilling one a second
+        self.assertEqual(backend.hit("k", 2, 1, now=100), (True, 0))
+        self.assertEqual(backend.hit("k", 2, 1, now=100), (True, 0))
+
+        allowed, retry_after = backend.hit("k", 2, 1, now=100.25)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 0.75)
+
+        self.assertEqual(backend.hit("k", 2, 1, now=101.5), (True, 0))
+        self.assertEqual(backend.hit("other", 2, 1, now=101.5), (True, 0))
+
+    def test_memory_backend(self):
+        self.check_backend(MemoryRateLimitBackend())
+
+    def test_database_backend(self):
+        self.check_backend(DatabaseRateLimitBackend())
+
+    def test_memory_backend_is_bounded(self):
+        backend = MemoryRateLimitBackend(max_keys=2)
+
+        for key in "abc":
+            backend.hit(key, 1, 1, now=0)
+
+        self.assertEqual(backend.hit("a", 1, 1, now=0), (True, 0))
+
+
+class RateLimitViewTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.limits = app.config['RATELIMITS']
+        self.backend = limiter.backend
+        limiter.backend = MemoryRateLimitBackend()
+
+    def tearDown(self):
+        app.config['RATELIMITS'] = self.limits
+        limiter.backend = self.backend
+
+    def test_login_throttled(self):
+        app.config['RATELIMITS'] = {'login': '2/minute'}
+
+        with app.test_client() as c:
+            for _ in range(2):
+                resp = c.post(
+                    "/login", data={"username": "u1", "password": "wrong"})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post(
+                "/login", data={"username": "u1", "password": "wrong"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers["Retry-After"], "30")
+
+            resp = c.get("/login")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_throttled_per_user(self):
+        app.config['RATELIMITS'] = {'add_message': '1/hour'}
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/messages/new", data={"text": "Hello"})
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.post(
+                "/messages/new",
+                data={"text": "Hello again"},
+                environ_base={"REMOTE_ADDR": "10.0.0.2"},
+            )
+            self.assertEqual(resp.status_code, 429)
+
+    def test_throttled_per_client_behind_proxy(self):
+        app.config['RATELIMITS'] = {'login': '1/minute'}
+        proxy_fix = app.wsgi_app
+
+        def login(c, forwarded_for):
+            return c.post(
+                "/login",
+                data={"username": "u1", "password": "wrong"},
+                environ_base={"REMOTE_ADDR": "10.0.0.1"},
+                headers={"X-Forwarded-For": forwarded_for},
+            ).status_code
+
+        with app.test_client() as c:
+            # Without trusted proxies the header is ignored
+            self.assertEqual(login(c, "203.0.113.1"), 200)
+            self.assertEqual(login(c, "203.0.113.2"), 429)
+
+            limiter.backend = MemoryRateLimitBackend()
+            proxy_fix.x_for = 1
+
+            try:
+                self.assertEqual(login(c, "203.0.113.1"), 200)
+                self.assertEqual(login(c, "203.0.113.2"), 200)
+
+                # Only the address the proxy added counts
+                self.assertEqual(login(c, "198.51.100.7, 203.0.113.1"), 429)
+            finally:
+                proxy_fix.x_for = app.config['TRUSTED_PROXIES']
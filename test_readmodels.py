@@ -0,0 +1,137 @@
+"""Read model (user and message card) tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, dbx, Message, User, Like
+from readmodels import (
+    MessageCard, UserCard, select_message_cards, select_user_cards)
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class ReadModelTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        now = datetime.now()
+        m1 = Message(text="first", user_id=u2.id, timestamp=now)
+        m2 = Message(
+            text="second", user_id=u2.id, timestamp=now + timedelta(1))
+        m3 = Message(text="gone", user_id=u3.id)
+        db.session.add_all([m1, m2, m3])
+        db.session.flush()
+
+        db.session.add(Like(user_id=u1.id, message_id=m1.id))
+        u3.soft_delete()
+        db.session.commit()
+
+        self.u1_id, self.u2_id = u1.id, u2.id
+        self.m1_id, self.m2_id = m1.id, m2.id
+
+        db.session.expunge_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_user_cards(self):
+        q = select_user_cards().order_by(User.id)
+        cards = list(UserCard.from_rows(dbx(q)))
+
+        self.assertEqual([c.username for c in cards], ["u1", "u2"])
+        self.assertEqual(cards[0].id, self.u1_id)
+        self.assertIsNone(cards[0].deleted_at)
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_message_cards(self):
+        q = select_message_cards(self.u1_id)
+        cards = list(MessageCard.from_rows(dbx(q)))
+
+        # Newest first, and none by the deleted user
+        self.assertEqual([c.id for c in cards], [self.m2_id, self.m1_id])
+        self.assertEqual([c.like_count for c in cards], [0, 1])
+        self.assertEqual(
+            [c.is_liked_by_user(self.u1_id) for c in cards], [False, True])
+
+        self.assertEqual(cards[0].user.username, "u2")
+        self.assertIs(cards[0].user, cards[1].user)
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_pages(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("@u2", html)
+            self.assertNotIn("@u3", html)
+
+            html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+            self.assertIn("second", html)
+            self.assertIn("bi-star-fill", html)
+
+            c.post(f"/users/follow/{self.u2_id}")
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn(f'href="/users/{self.u2_id}">@u2', html)
+            self.assertIn("second", html)
+
+    def test_follow_buttons(self):
+        users = [
+            User(username=f"x{i}", email=f"x{i}@email.com", password="x")
+            for i in range(20)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+        u1 = db.session.get(User, self.u1_id)
+        u1.follow_many([users[0].id, users[1].id])
+        db.session.commit()
+
+        queries = []
+
+        def count(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            db.event.listen(db.engine, "before_cursor_execute", count)
+            try:
+                html = c.get("/users").get_data(as_text=True)
+            finally:
+                db.event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(html.count("Unfollow"), 2)
+        self.assertEqual(html.count("Follow\n"), 20)
+
+        # Not a query per card
+        self.assertLess(len(queries), 10)
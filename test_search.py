@@ -0,0 +1,167 @@
+"""Message search tests."""
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY, message_search
+from models import db, dbx, Message, User
+from search import (
+    decode_cursor,
+    encode_cursor,
+    DatabaseSearchIndex,
+    MemorySearchIndex,
+)
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        texts = [
+            (u1, "Birds sing in the morning"),
+            (u1, "Morning coffee, then birds, then more birds"),
+            (u2, "Evening walk"),
+            (u2, "Birds at dusk"),
+        ]
+        messages = [Message(text=text, user_id=u.id) for u, text in texts]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m_ids = [m.id for m in messages]
+        self.index = message_search.index
+        self.page_size = message_search.page_size
+
+    def tearDown(self):
+        message_search.index = self.index
+        message_search.page_size = self.page_size
+
+    def test_cursor(self):
+        self.assertEqual(decode_cursor(encode_cursor(0.1, 5)), (0.1, 5))
+
+        with self.assertRaises(ValueError):
+            decode_cursor("nonsense")
+
+    def check_index(self, index):
+        hits = index.search("birds", limit=10)
+        ids = [message_id for _rank, message_id in hits]
+
+        # Repeated words rank higher
+        self.assertEqual(ids[0], self.m_ids[1])
+        self.assertCountEqual(ids, [self.m_ids[0], self.m_ids[1], self.m_ids[3]])
+
+        # Every term has to match
+        hits = index.search("morning birds", limit=10)
+        self.assertCountEqual(
+            [message_id for _rank, message_id in hits],
+            [self.m_ids[0], self.m_ids[1]],
+        )
+
+        # Pages pick up after the cursor
+        first = index.search("birds", limit=2)
+        rest = index.search("birds", limit=2, after=first[-1])
+        self.assertEqual(first + rest, index.search("birds", limit=10))
+        self.assertEqual(len(rest), 1)
+
+        self.assertEqual(index.search("nothing", limit=10), [])
+
+    def test_memory_index(self):
+        index = MemorySearchIndex()
+        self.check_index(index)
+
+        index.remove(self.m_ids[1])
+        hits = index.search("coffee", limit=10)
+        self.assertEqual(hits, [])
+
+    def test_database_index(self):
+        self.check_index(DatabaseSearchIndex())
+
+    def test_memory_index_follows_commits(self):
+        message_search.index = MemorySearchIndex()
+        message_search.index.rebuild()
+
+        db.session.add(Message(text="Rolled back owl", user_id=self.u1_id))
+        db.session.flush()
+        db.session.rollback()
+
+        msg = Message(text="Committed owl", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        hits = message_search.index.search("owl", limit=10)
+        self.assertEqual([message_id for _r, message_id in hits], [msg.id])
+
+        db.session.delete(msg)
+        db.session.commit()
+
+        self.assertEqual(message_search.index.search("owl", limit=10), [])
+
+    def test_search_page(self):
+        message_search.page_size = 2
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/search", query_string={"q": "birds"})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("then more birds", html)
+            self.assertIn("More results", html)
+
+            _rank, message_id = message_search.index.search("birds", 2)[-1]
+            resp = c.get("/messages/search", query_string={
+                "q": "birds",
+                "after": encode_cursor(_rank, message_id),
+            })
+            html = resp.get_data(as_text=True)
+
+            self.assertNotIn("then more birds", html)
+            self.assertNotIn("More results", html)
+
+            resp = c.get(
+                "/messages/search", query_string={"q": "x", "after": "bad"})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_deleted_users_hidden(self):
+        u2 = db.session.get(User, self.u2_id)
+        u2.deleted_at = datetime.now()
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/search", query_string={"q": "dusk"})
+            self.assertIn("No warbles match", resp.get_data(as_text=True))
@@ -0,0 +1,112 @@
+"""Server-side session tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, dbx, User, ServerSession
+from sessions import MemorySessionStore, DatabaseSessionStore
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class SessionStoreTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(ServerSession))
+        db.session.commit()
+
+    def check_store(self, store):
+        later = datetime.now() + timedelta(hours=1)
+        earlier = datetime.now() - timedelta(hours=1)
+
+        store.save("live", '{"a": 1}', later)
+        store.save("stale", '{"b": 2}', earlier)
+
+        self.assertEqual(store.load("live"), '{"a": 1}')
+        self.assertIsNone(store.load("stale"))
+        self.assertIsNone(store.load("missing"))
+
+        store.save("live", '{"a": 2}', later)
+        self.assertEqual(store.load("live"), '{"a": 2}')
+
+        self.assertEqual(store.purge_expired(batch_size=1), 1)
+
+        store.delete("live")
+        self.assertIsNone(store.load("live"))
+
+    def test_memory_store(self):
+        self.check_store(MemorySessionStore())
+
+    def test_database_store(self):
+        self.check_store(DatabaseSessionStore())
+
+
+class SessionInterfaceTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        dbx(db.delete(ServerSession))
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.interface = app.session_interface
+
+    def test_cookie_holds_only_session_id(self):
+        with app.test_client() as c:
+            c.post("/login", data={"username": "u1", "password": "password"})
+
+            cookie = c.get_cookie(app.config['SESSION_COOKIE_NAME'])
+            self.assertLess(len(cookie.value), 32)
+
+            stored = db.session.get(ServerSession, cookie.value)
+            self.assertIn(CURR_USER_KEY, stored.data)
+
+            resp = c.get("/")
+            self.assertIn("@u1", resp.get_data(as_text=True))
+
+    def test_login_regenerates_session_id(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess["visited"] = True
+
+            before = c.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+
+            c.post("/login", data={"username": "u1", "password": "password"})
+
+            after = c.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+            self.assertNotEqual(before, after)
+            self.assertIsNone(db.session.get(ServerSession, before))
+
+    def test_no_lookup_without_session_use(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            lookups = self.interface.lookups
+            c.get("/static/stylesheets/style.css").close()
+
+            self.assertEqual(self.interface.lookups, lookups)
@@ -0,0 +1,156 @@
+"""Follow graph and who-to-follow suggestion tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from graph import FollowGraph
+from models import db, dbx, User, Message, FollowChange, FollowSuggestion
+from suggestions import refresh_suggestions, suggest
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    def setUp(self):
+        # 10 follows 20 and 30; 20 follows 30 and 40; 30 follows 40.
+        # 99 isn't a user, so its follows are dropped
+        self.graph = FollowGraph(
+            [40, 10, 30, 20],
+            [10, 20, 10, 20, 30, 99, 10],
+            [30, 40, 20, 30, 40, 10, 99],
+        )
+
+    def test_nodes(self):
+        self.assertEqual(len(self.graph), 4)
+        self.assertEqual(self.graph.num_follows, 5)
+        self.assertEqual(self.graph.node(30), 2)
+        self.assertEqual(self.graph.user_id(2), 30)
+        self.assertIsNone(self.graph.node(99))
+
+    def test_adjacency(self):
+        node = self.graph.node
+
+        self.assertEqual(list(self.graph.following(node(10))), [1, 2])
+        self.assertEqual(list(self.graph.followers(node(40))), [1, 2])
+        self.assertEqual(list(self.graph.following(node(40))), [])
+
+    def test_friends_of_friends(self):
+        node = self.graph.node
+
+        # 30 is already followed; 40 is followed by both of 10's friends
+        self.assertEqual(self.graph.friends_of_friends(node(10)), {3: 2})
+
+        boosts = {30: 1.0}
+        self.assertEqual(
+            suggest(self.graph, node(20), boosts), [])
+        self.assertEqual(
+            suggest(self.graph, node(10), boosts), [(2, node(40))])
+
+
+class SuggestionRefreshTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        users = [
+            User.signup(name, f"{name}@email.com", "password", None)
+            for name in ["a", "b", "c", "d", "e"]
+        ]
+        db.session.commit()
+
+        self.a, self.b, self.c, self.d, self.e = [u.id for u in users]
+
+        a, b = users[:2]
+        a.follow(self.b)
+        b.follow_many([self.c, self.d])
+
+        # c posted just now, d a long time ago
+        db.session.add_all([
+            Message(text="new", user_id=self.c),
+            Message(
+                text="old",
+                user_id=self.d,
+                timestamp=datetime.now() - timedelta(days=365),
+            ),
+        ])
+        db.session.commit()
+
+    def suggestions(self, user_id):
+        q = (
+            db.select(FollowSuggestion.suggested_user_id)
+            .filter_by(user_id=user_id)
+            .order_by(FollowSuggestion.score.desc())
+        )
+        return dbx(q).scalars().all()
+
+    def test_full_refresh(self):
+        self.assertEqual(refresh_suggestions(full=True), 5)
+
+        # Both are followed by b, but c is more active
+        self.assertEqual(self.suggestions(self.a), [self.c, self.d])
+        self.assertEqual(dbx(db.select(FollowChange)).all(), [])
+
+    def test_incremental_refresh(self):
+        refresh_suggestions(full=True)
+
+        e = db.session.get(User, self.e)
+        e.follow(self.a)
+        db.session.commit()
+
+        # e changed, and has no followers whose suggestions depend on it
+        self.assertEqual(refresh_suggestions(), 1)
+        self.assertEqual(self.suggestions(self.e), [self.b])
+
+        a = db.session.get(User, self.a)
+        a.follow(self.c)
+        db.session.commit()
+
+        # a and its follower e
+        self.assertEqual(refresh_suggestions(), 2)
+        self.assertEqual(self.suggestions(self.a), [self.d])
+        # One mutual each, but c has posted recently
+        self.assertEqual(self.suggestions(self.e), [self.c, self.b])
+
+        self.assertEqual(refresh_suggestions(), 0)
+
+    def test_suggested_users(self):
+        refresh_suggestions(full=True)
+
+        a = db.session.get(User, self.a)
+        a.follow(self.c)
+        db.session.commit()
+
+        # Followed since the refresh, so not suggested any more
+        self.assertEqual([u.id for u in a.suggested_users()], [self.d])
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.a
+
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("Who to follow", html)
+            self.assertIn(f'action="/users/follow/{self.d}"', html)
@@ -0,0 +1,281 @@
+"""Live timeline tests."""
+
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+
+from app import app, CURR_USER_KEY, live_timeline
+from models import db, dbx, Message, User
+from timeline import DatabasePubSub, TimelineHub
+import asgi
+
+# To run the tests, you must provide a "test database", since these tests
+# delete & recreate the tables & data. In your shell:
+#
+# Do this only once:
+#   $ createdb warbler_test
+#
+# To run the tests using that test data:
+#   $ DATABASE_URL=postgresql:///warbler_test python3 -m unittest
+
+if not app.config['SQLALCHEMY_DATABASE_URI'].endswith("_test"):
+    raise Exception(
+        "\n\nMust set DATABASE_URL env var to db ending with _test")
+
+# NOW WE KNOW WE'RE IN THE RIGHT DATABASE, SO WE CAN CONTINUE
+os.environ['FLASK_DEBUG'] = '0'
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+app.app_context().push()
+db.drop_all()
+db.create_all()
+
+POSTGRESQL = app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgresql")
+
+
+class Stream:
+    """A request for the timeline stream, running on the ASGI app."""
+
+    def __init__(self, sid=None, query=b"", headers=()):
+        self.sent = asyncio.Queue()
+        self.disconnected = asyncio.Event()
+        self.body_sent = False
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/timeline/events",
+            "query_string": query,
+            "headers": [
+                (b"host", b"localhost"),
+                *([(b"cookie", f"session={sid}".encode())] if sid else []),
+                *headers,
+            ],
+            "http_version": "1.1",
+            "scheme": "http",
+            "server": ("localhost", 80),
+        }
+        self.task = asyncio.ensure_future(
+            asgi.application(scope, self.receive, self.send))
+
+    async def receive(self):
+        if not self.body_sent:
+            self.body_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        await self.disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        await self.sent.put(message)
+
+    async def next(self):
+        """The next message the app sends."""
+
+        return await asyncio.wait_for(self.sent.get(), 5)
+
+    async def next_event(self):
+        """The next event sent, as (id, data); skips comments."""
+
+        while True:
+            body = (await self.next())["body"].decode()
+
+            if not body.startswith(":"):
+                fields = dict(
+                    line.split(": ", 1) for line in body.strip().split("\n"))
+                return int(fields["id"]), json.loads(fields["data"])
+
+    async def close(self):
+        self.disconnected.set()
+        await asyncio.wait_for(self.task, 5)
+
+
+def run(coroutine):
+    async def main():
+        try:
+            await coroutine
+        finally:
+            # Connections belong to this event loop, which is about to close
+            await asgi.engine.dispose()
+
+    asyncio.run(main())
+
+
+class LiveTimelineTestCase(TestCase):
+    def setUp(self):
+        dbx(db.delete(User))
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="before the page", user_id=u2.id)
+        db.session.add(m1)
+        db.session.flush()
+
+        u1.follow(u2.id)
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.u3_id = u1.id, u2.id, u3.id
+        self.m1_id = m1.id
+
+        self.sid = "test-session"
+        interface = app.session_interface
+        interface.store.save(
+            self.sid,
+            interface.serializer.dumps({CURR_USER_KEY: u1.id}),
+            datetime.now() + timedelta(hours=1),
+        )
+
+    def tearDown(self):
+        app.session_interface.store.delete(self.sid)
+        live_timeline.keepalive = app.config['LIVE_TIMELINE_KEEPALIVE']
+        db.session.rollback()
+
+    def post(self, user_id, text):
+        """Post a message as `user_id` through the Flask app."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = client.post("/messages/new", data={"text": text})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_streams_new_messages(self):
+        async def main():
+            stream = Stream(self.sid, f"after={self.m1_id - 1}".encode())
+
+            start = await stream.next()
+            self.assertEqual(start["status"], 200)
+            self.assertIn(
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                start["headers"])
+
+            # Missed since the page was made
+            message_id, data = await stream.next_event()
+            self.assertEqual(message_id, self.m1_id)
+            self.assertEqual(data["text"], "before the page")
+
+            # Not followed, then followed
+            await asyncio.to_thread(self.post, self.u3_id, "from u3")
+            await asyncio.to_thread(self.post, self.u2_id, "from u2")
+
+            message_id, data = await stream.next_event()
+            self.assertGreater(message_id, self.m1_id)
+            self.assertEqual(data["text"], "from u2")
+            self.assertEqual(data["user"]["username"], "u2")
+            self.assertTrue(data["user"]["image_url"].startswith("/images/"))
+
+            await stream.close()
+            self.assertEqual(stream.sent.qsize(), 0)
+
+        run(main())
+
+        # Unsubscribed when the client went away
+        self.assertEqual(live_timeline.hub._subscriptions, {})
+
+    def test_reconnect_resumes_after_last_event(self):
+        self.post(self.u2_id, "while disconnected")
+        missed_id = db.session.scalar(
+            db.select(db.func.max(Message.id)))
+
+        live_timeline.keepalive = 0.05
+
+        async def main():
+            stream = Stream(
+                self.sid,
+                b"after=0",
+                [(b"last-event-id", str(self.m1_id).encode())],
+            )
+            await stream.next()
+
+            message_id, data = await stream.next_event()
+            self.assertEqual(message_id, missed_id)
+            self.assertEqual(data["text"], "while disconnected")
+
+            # Comments keep the connection open while nothing's posted
+            self.assertEqual(
+                (await stream.next())["body"], b": keepalive\n\n")
+
+            await stream.close()
+
+        run(main())
+
+    def test_ends_stream_when_behind(self):
+        async def main():
+            stream = Stream(self.sid)
+            await stream.next()
+
+            (subscription,) = live_timeline.hub._subscriptions[self.u2_id]
+
+            for i in range(live_timeline.max_queued + 1):
+                live_timeline.hub.dispatch(self.u2_id, 1000 + i, "{}")
+
+            bodies = []
+            while True:
+                message = await stream.next()
+                bodies.append(message["body"])
+
+                if not message.get("more_body"):
+                    break
+
+            # Ended rather than skip any: the client reconnects from the
+            # last one it got
+            self.assertTrue(subscription.overflowed)
+            self.assertLess(len(bodies), live_timeline.max_queued)
+            self.assertEqual(bodies[-1], b"")
+
+            await stream.close()
+
+        run(main())
+
+    def test_logged_out(self):
+        async def main():
+            stream = Stream()
+            start = await stream.next()
+
+            # Flask's No Content, which stops the EventSource
+            self.assertEqual(start["status"], 204)
+            await stream.close()
+
+        run(main())
+
+    @skipUnless(POSTGRESQL, "LISTEN / NOTIFY needs PostgreSQL")
+    def test_database_pubsub(self):
+        hub = TimelineHub()
+        pubsub = DatabasePubSub(hub)
+
+        async def main():
+            ready = asyncio.Event()
+            listener = asyncio.ensure_future(pubsub.listen(asgi.engine, ready))
+            await asyncio.wait_for(ready.wait(), 5)
+
+            subscription = hub.subscribe([self.u2_id], 10)
+
+            def publish(message_id, commit):
+                pubsub.publish(db.session, self.u2_id, message_id, "{}")
+
+                if commit:
+                    db.session.commit()
+                else:
+                    db.session.rollback()
+
+            await asyncio.to_thread(publish, 1, False)
+            await asyncio.to_thread(publish, 2, True)
+
+            # Only the committed one
+            self.assertEqual(
+                await asyncio.wait_for(subscription.queue.get(), 5),
+                (2, "{}"))
+
+            listener.cancel()
+            hub.unsubscribe(subscription)
+
+        run(main())
@@ -115,3 +115,39 @@ class UserModelTestCase(TestCase):
         self.assertTrue(User.authenticate("u1", "password"))
         self.assertFalse(User.authenticate("u3", "password"))
         self.assertFalse(User.authenticate("u1", "wrong_password"))
+
+    def test_follow_is_idempotent(self):
+        u1 = db.session.get(User, self.u1_id)
+
+        self.assertTrue(u1.follow(self.u2_id))
+        self.assertTrue(u1.follow(self.u2_id))
+        db.session.commit()
+
+        self.assertEqual([u.id for u in u1.following], [self.u2_id])
+        self.assertFalse(u1.follow(0))
+
+    def test_unfollow(self):
+        u1 = db.session.get(User, self.u1_id)
+        u1.follow(self.u2_id)
+        db.session.commit()
+
+        self.assertTrue(u1.unfollow(self.u2_id))
+        self.assertTrue(u1.unfollow(self.u2_id))
+        db.session.commit()
+
+        self.assertEqual(u1.following, [])
+        self.assertFalse(u1.unfollow(0))
+
+    def test_follow_many(self):
+        u1 = db.session.get(User, self.u1_id)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+
+        followed = u1.follow_many([self.u1_id, self.u2_id, u3.id, 0])
+        self.assertEqual(followed, 2)
+
+        followed = u1.follow_many([self.u2_id, u3.id])
+        self.assertEqual(followed, 0)
+        db.session.commit()
+
+        self.assertEqual(len(u1.following), 2)
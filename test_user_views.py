@@ -1,8 +1,11 @@
 """Message View tests."""
 
 import os
+import re
 from unittest import TestCase
 
+from flask import g
+
 from app import app, CURR_USER_KEY
 from models import (
     db,
@@ -109,6 +112,78 @@ class UserViewTestCase(UserBaseViewTestCase):
 
             self.assertIn(f"{u1.username}", html)
 
+    def test_streamed_pages(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u1_id}/followers")
+            self.assertTrue(resp.is_streamed)
+            self.assertIn("@userTwo", resp.get_data(as_text=True))
+
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertIn(
+                "Sample message text", resp.get_data(as_text=True))
+
+            resp = c.get("/users?q=nobody")
+            self.assertIn(
+                "Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_streamed_page_session(self):
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            with app.app_context(), app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+                    sess["_flashes"] = [("success", "Hello again!")]
+
+                # The flash is shown once, not on every page after
+                pages = [
+                    c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+                    for _ in range(2)
+                ]
+                self.assertIn("Hello again!", pages[0])
+                self.assertNotIn("Hello again!", pages[1])
+
+                # The page's CSRF token was kept in the session
+                token = re.search(
+                    r'name="csrf_token" value="([^"]+)"', pages[1]).group(1)
+                resp = c.post("/logout", data={"csrf_token": token})
+                self.assertEqual(resp.status_code, 302)
+
+                with c.session_transaction() as sess:
+                    self.assertNotIn(CURR_USER_KEY, sess)
+
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_csrf_token_checked(self):
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = c.post("/logout")
+                self.assertEqual(resp.status_code, 401)
+
+                # The tests share one app context, so drop any token that
+                # Flask-WTF memoised in g for an earlier request
+                g.pop("csrf_token", None)
+
+                resp = c.get(f"/users/{self.u2_id}")
+                html = resp.get_data(as_text=True)
+                token = re.search(
+                    r'name="csrf_token" value="([^"]+)"', html).group(1)
+
+                resp = c.post("/logout", data={"csrf_token": token})
+                self.assertEqual(resp.status_code, 302)
+
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
     def test_show_likes(self):
         with app.test_client() as c:
             with c.session_transaction() as sess:
@@ -132,7 +207,36 @@ class UserViewTestCase(UserBaseViewTestCase):
 
             u1 = db.session.get(User, self.u1_id)
 
-            self.assertIsNone(u1)
+            self.assertIsNotNone(u1.deleted_at)
+            self.assertFalse(User.authenticate("u1", "password"))
+
+            User.purge_deleted(batch_size=1)
+
+            self.assertIsNone(db.session.get(User, self.u1_id))
+            self.assertIsNone(db.session.get(Message, self.m1_id))
+            self.assertIsNone(
+                db.session.get(Follow, (self.u2_id, self.u1_id)))
+
+    def test_deleted_user_hidden(self):
+        u1 = db.session.get(User, self.u1_id)
+        u1.soft_delete()
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.get("/users")
+            html = resp.get_data(as_text=True)
+
+            self.assertNotIn("@u1<", html)
+            self.assertIn("@userTwo", html)
 
     # TODO: break this apart into multiple functions testing each part
     def test_edit_profile(self):
@@ -140,6 +244,8 @@ class UserViewTestCase(UserBaseViewTestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
+            # Buffered: the redirect lands on a streamed page, which the
+            # test client can't otherwise follow while it keeps contexts
             resp = c.post(
                 "/users/profile",
                 data={
@@ -150,7 +256,7 @@ class UserViewTestCase(UserBaseViewTestCase):
                     "bio": "Test bio",
                     "password": "password"
                 },
-                follow_redirects=True)
+                follow_redirects=True, buffered=True)
             html = resp.get_data(as_text=True)
 
             u1 = db.session.get(User, self.u1_id)
@@ -0,0 +1,256 @@
+"""Live timeline: new messages pushed to open home pages.
+
+A home page opens an EventSource on /timeline/events, which asgi.py serves
+as a Server-Sent Events stream of new messages by the viewer and whom they
+follow; the page's script adds each one to the top of the timeline. A
+waiting stream is a coroutine and a queue, holding no database connection,
+so a worker can keep many thousands open.
+
+`add_message()` publishes each new message through a pub/sub backend:
+
+    memory      to this process only: viewers connected to the same worker
+    database    PostgreSQL NOTIFY, which each worker LISTENs for
+
+Either way a message is only announced once it's committed, and its event
+(JSON of what its card shows) is made once, by the publisher, rather than
+for each viewer it goes to.
+
+Events carry their message's id. A stream starts after the newest message
+its page shows, and a reconnecting EventSource sends the last id it saw, so
+messages posted in between are sent from the database first.
+"""
+
+import asyncio
+import json
+import threading
+
+from flask import current_app
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import object_session
+
+from models import db, on_commit
+
+CHANNEL = "new_messages"
+
+# Seconds between attempts to LISTEN again after losing the connection
+RECONNECT_DELAY = 5
+
+
+def message_event(message):
+    """JSON of what a new message's card shows, for the page's script.
+
+    Needs a request context, for the image link.
+    """
+
+    thumbnail = current_app.jinja_env.filters['thumbnail']
+
+    return json.dumps({
+        "id": message.id,
+        "text": message.text,
+        "date": message.timestamp.strftime('%d %B %Y'),
+        "user": {
+            "id": message.user.id,
+            "username": message.user.username,
+            "image_url": thumbnail(message.user.image_url, "avatar"),
+        },
+    })
+
+
+class Subscription:
+    """A stream's queue of (message id, event) for new messages by some
+    authors, on the stream's event loop; None once the client's gone."""
+
+    def __init__(self, author_ids, max_queued):
+        self.author_ids = frozenset(author_ids)
+        self.queue = asyncio.Queue(max_queued)
+        self.loop = asyncio.get_running_loop()
+
+        # Set if an event was dropped because the queue was full
+        self.overflowed = False
+
+    def put(self, message_id, event):
+        self._put((message_id, event))
+
+    def end(self):
+        """Wake the stream up to end: its client has gone."""
+
+        self._put(None)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class TimelineHub:
+    """This process's subscriptions, by author."""
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, author_ids, max_queued):
+        """Subscribe to new messages by `author_ids`. Call in the stream's
+        event loop."""
+
+        subscription = Subscription(author_ids, max_queued)
+
+        with self._lock:
+            for author_id in subscription.author_ids:
+                self._subscriptions.setdefault(author_id, set()).add(
+                    subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for author_id in subscription.author_ids:
+                subscriptions = self._subscriptions[author_id]
+                subscriptions.discard(subscription)
+
+                if not subscriptions:
+                    del self._subscriptions[author_id]
+
+    def dispatch(self, author_id, message_id, event):
+        """Queue a new message's event for its author's subscribers. Can be
+        called from any thread."""
+
+        by_loop = {}
+
+        with self._lock:
+            for subscription in self._subscriptions.get(author_id, ()):
+                by_loop.setdefault(subscription.loop, []).append(subscription)
+
+        # One wake-up per event loop, rather than one per subscription
+        for loop, subscriptions in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(
+                    _put_all, subscriptions, message_id, event)
+
+            except RuntimeError:
+                # It's closed
+                pass
+
+
+def _put_all(subscriptions, message_id, event):
+    for subscription in subscriptions:
+        subscription.put(message_id, event)
+
+
+class MemoryPubSub:
+    """Publishes to this process's hub. For a single worker."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, session, author_id, message_id, event):
+        on_commit(session, self.hub.dispatch, author_id, message_id, event)
+
+    async def listen(self, engine, ready=None):
+        """Nothing to listen for: publishing goes straight to the hub."""
+
+        if ready is not None:
+            ready.set()
+
+
+class DatabasePubSub:
+    """PostgreSQL NOTIFY / LISTEN, so every worker hears of every message.
+
+    Each worker holds one connection of its async engine to LISTEN on.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, session, author_id, message_id, event):
+        # PostgreSQL sends the notification when the transaction commits
+        session.execute(db.select(db.func.pg_notify(
+            CHANNEL, f"{author_id}:{message_id}:{event}")))
+
+    def _notified(self, connection, pid, channel, payload):
+        author_id, message_id, event = payload.split(":", 2)
+        self.hub.dispatch(int(author_id), int(message_id), event)
+
+    async def listen(self, engine, ready=None):
+        """Pass notifications on to the hub until cancelled.
+
+        Sets asyncio.Event `ready`, if given, once listening.
+        """
+
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    try:
+                        await self._listen(conn, ready)
+
+                    finally:
+                        # Don't return a listening connection to the pool
+                        await conn.invalidate()
+
+            except (OSError, DBAPIError):
+                pass
+
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _listen(self, conn, ready):
+        """Listen on `conn` until it's lost."""
+
+        raw = (await conn.get_raw_connection()).driver_connection
+        lost = asyncio.get_running_loop().create_future()
+
+        raw.add_termination_listener(
+            lambda connection: lost.done() or lost.set_result(None))
+        await raw.add_listener(CHANNEL, self._notified)
+
+        if ready is not None:
+            ready.set()
+
+        await lost
+
+
+PUBSUB_BACKENDS = {
+    "memory": MemoryPubSub,
+    "database": DatabasePubSub,
+}
+
+
+class LiveTimeline:
+    """Publishes new messages to the streams of home pages showing them."""
+
+    def __init__(self, app=None):
+        self.hub = None
+        self.backend = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LIVE_TIMELINE_BACKEND', 'memory')
+        app.config.setdefault('LIVE_TIMELINE_MAX_QUEUED', 100)
+        app.config.setdefault('LIVE_TIMELINE_KEEPALIVE', 15)
+
+        self.hub = TimelineHub()
+        self.backend = PUBSUB_BACKENDS[app.config['LIVE_TIMELINE_BACKEND']](
+            self.hub)
+        self.max_queued = app.config['LIVE_TIMELINE_MAX_QUEUED']
+        self.keepalive = app.config['LIVE_TIMELINE_KEEPALIVE']
+
+    def publish(self, message):
+        """Announce a new message (added and flushed) once it's committed."""
+
+        self.backend.publish(
+            object_session(message),
+            message.user_id,
+            message.id,
+            message_event(message),
+        )
+
+    def subscribe(self, author_ids):
+        """Subscription to new messages by `author_ids`, for a stream."""
+
+        return self.hub.subscribe(author_ids, self.max_queued)
+
+    def unsubscribe(self, subscription):
+        self.hub.unsubscribe(subscription)